@@ -0,0 +1,149 @@
+# bench_db.py
+"""
+Бенчмарки слоя данных (db.py) на временной БД.
+
+Запуск:
+    python bench_db.py pool      # соединение на каждый вызов vs пул
+    python bench_db.py turns     # два add_to_chat_history vs один record_turn
+    python bench_db.py fts       # поиск заметок: LIKE vs FTS5 (по умолчанию 1M заметок)
+"""
+import argparse
+import itertools
+import os
+import random
+import tempfile
+import threading
+import time
+
+import db
+
+
+def _run_threads(threads: int, ops: int, work) -> float:
+    """Запускает work(thread_idx, op_idx) в threads потоках, возвращает время в секундах."""
+    barrier = threading.Barrier(threads + 1)
+
+    def runner(idx: int):
+        barrier.wait()
+        for i in range(ops):
+            work(idx, i)
+
+    pool = [threading.Thread(target=runner, args=(i,)) for i in range(threads)]
+    for t in pool:
+        t.start()
+    barrier.wait()
+    t0 = time.perf_counter()
+    for t in pool:
+        t.join()
+    return time.perf_counter() - t0
+
+
+def _fresh_db(tmpdir: str, name: str) -> None:
+    db.DB_PATH = os.path.join(tmpdir, name)
+    db.close_all()
+    db.init_db()
+
+
+def bench_pool(threads: int, ops: int) -> None:
+    """Сравнивает add_to_chat_history/get_chat_history без пула и с пулом."""
+    def handler_turn(uid: int, i: int):
+        db.get_chat_history(uid)
+        db.add_to_chat_history(uid, "user", f"сообщение {i}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for label, size in (("connect-per-call", 0), ("pooled", max(threads, 1))):
+            _fresh_db(tmpdir, f"bench_{label}.db")
+            db.configure_pool(size=size)
+            dt = _run_threads(threads, ops, handler_turn)
+            total = threads * ops
+            print(f"{label:>17}: {total} ходов за {dt:.3f} с -> {total / dt:,.0f} ходов/с "
+                  f"({dt / total * 1e6:.0f} мкс/ход)")
+        db.close_all()
+
+
+def bench_turns(threads: int, ops: int) -> None:
+    """Пропускная способность записи истории: много пользователей пишут одновременно."""
+    def two_inserts(uid: int, i: int):
+        db.add_to_chat_history(uid, "user", f"вопрос {i}")
+        db.add_to_chat_history(uid, "assistant", f"ответ {i}")
+
+    def one_turn(uid: int, i: int):
+        db.record_turn(uid, f"вопрос {i}", f"ответ {i}", {"model_key": "bench", "latency_ms": 1})
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db.configure_pool(size=max(threads, 1))
+        for label, work in (("2x add_to_chat_history", two_inserts), ("record_turn", one_turn)):
+            _fresh_db(tmpdir, f"bench_{work.__name__}.db")
+            dt = _run_threads(threads, ops, work)
+            total = threads * ops
+            print(f"{label:>22}: {total} ходов за {dt:.3f} с -> {total / dt:,.0f} ходов/с")
+        db.close_all()
+
+
+_SYLLABLES = "ба ве ги до жу зо ка ли мо ну па ре си то фу ха це чи ша ле ро на ми ко ту".split()
+
+
+def _vocabulary(rnd: random.Random, size: int = 20000) -> list[str]:
+    """Синтетический словарь из "кириллических" слов разной длины."""
+    return ["".join(rnd.choices(_SYLLABLES, k=rnd.randint(2, 4))) for _ in range(size)]
+
+
+# Исходный запрос find_notes до перехода на FTS5 — для сравнения
+_LIKE_SQL = """SELECT id, text, created_at FROM notes
+WHERE user_id = ? AND LOWER(text) LIKE LOWER(?)
+ORDER BY id DESC LIMIT ?"""
+
+
+def bench_fts(notes: int, users: int, queries: int) -> None:
+    """Латентность поиска заметок: LOWER(text) LIKE '%q%' против FTS5 (bm25)."""
+    rnd = random.Random(42)
+    words = _vocabulary(rnd)
+    # Частоты слов по закону Ципфа, как в естественном языке; накопленные веса
+    # считаем один раз, иначе choices() пересчитывает их на каждую заметку
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(words))))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _fresh_db(tmpdir, "bench_fts.db")
+        t0 = time.perf_counter()
+        with db._connect() as conn:
+            conn.executemany(
+                "INSERT INTO notes(user_id, text) VALUES (?, ?)",
+                ((rnd.randrange(users), " ".join(rnd.choices(words, cum_weights=cum_weights, k=rnd.randint(3, 12))))
+                 for _ in range(notes))
+            )
+        print(f"Заполнение: {notes:,} заметок, {users} пользователей за {time.perf_counter() - t0:.1f} с")
+
+        cases = [(rnd.randrange(users), rnd.choice(words)) for _ in range(queries)]
+        with db._connect() as conn:
+            for label, run in (
+                ("LIKE", lambda uid, q: conn.execute(_LIKE_SQL, (uid, f"%{q}%", 50)).fetchall()),
+                ("FTS5", lambda uid, q: db.find_notes(uid, q)),
+            ):
+                samples = []
+                for uid, q in cases:
+                    t0 = time.perf_counter()
+                    run(uid, q)
+                    samples.append((time.perf_counter() - t0) * 1000)
+                samples.sort()
+                print(f"{label}: avg {sum(samples) / len(samples):.2f} мс, "
+                      f"p50 {samples[len(samples) // 2]:.2f} мс, p95 {samples[int(len(samples) * 0.95)]:.2f} мс")
+        db.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bench", choices=["pool", "turns", "fts"])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=500)
+    parser.add_argument("--notes", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    if args.bench == "pool":
+        bench_pool(args.threads, args.ops)
+    elif args.bench == "turns":
+        bench_turns(args.threads, args.ops)
+    elif args.bench == "fts":
+        bench_fts(args.notes, args.users, args.queries)
+
+
+if __name__ == "__main__":
+    main()
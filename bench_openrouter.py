@@ -0,0 +1,96 @@
+# bench_openrouter.py
+"""
+Накладные расходы HTTP-вызова к LLM на локальной заглушке OpenRouter.
+
+Сравнивает исходный вызов (requests.post на каждый запрос: новое соединение)
+с OpenRouterClient (requests.Session + пул keep-alive соединений).
+Заглушка отвечает мгновенно, поэтому замер — это чистая стоимость клиента и соединения;
+в проде к ней добавляются DNS и TLS-рукопожатие, которые пул тоже экономит.
+
+Запуск:
+    python bench_openrouter.py --calls 500 --threads 8
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from bench_db import _run_threads
+from openrouter_client import OpenRouterClient
+
+_RESPONSE = json.dumps({
+    "choices": [{"message": {"content": "ok"}}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 1},
+}).encode()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """Заглушка /chat/completions с поддержкой HTTP/1.1 keep-alive."""
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело уходят отдельными записями: без TCP_NODELAY keep-alive упирается в delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(_RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+class _CountingServer(ThreadingHTTPServer):
+    """Считает принятые TCP-соединения."""
+    daemon_threads = True
+    connections = 0
+
+    def get_request(self):
+        self.connections += 1
+        return super().get_request()
+
+
+def _report(label: str, total: int, dt: float, connections: int) -> None:
+    print(f"{label:>14}: {total} вызовов за {dt:.3f} с -> {dt / total * 1e6:.0f} мкс/вызов, "
+          f"TCP-соединений: {connections}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=500, help="вызовов на поток")
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    server = _CountingServer(("127.0.0.1", 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/v1/chat/completions"
+    msgs = [{"role": "user", "content": "ping"}]
+    headers = {"Authorization": "Bearer bench", "Content-Type": "application/json"}
+    total = args.calls * args.threads
+
+    def post_per_call(_thread: int, _op: int):
+        payload = {"model": "bench", "messages": msgs, "temperature": 0.7, "max_tokens": 16}
+        requests.post(url, headers=headers, json=payload, timeout=5).json()
+
+    client = OpenRouterClient(api_key="bench", url=url, pool_size=args.threads)
+
+    def pooled(_thread: int, _op: int):
+        client.chat(msgs, "bench", max_tokens=16)
+
+    try:
+        for label, work in (("requests.post", post_per_call), ("Session+pool", pooled)):
+            server.connections = 0
+            dt = _run_threads(args.threads, args.calls, work)
+            _report(label, total, dt, server.connections)
+    finally:
+        client.close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+# cluster.py
+"""
+Многопроцессный режим: фронт-процесс и N процессов-обработчиков.
+
+Фронт получает обновления (long polling через getUpdates или webhook, по
+BOT_MODE) и раскладывает их JSON по очередям multiprocessing по id
+пользователя: обновления одного пользователя всегда попадают в один процесс и
+обрабатываются по порядку. Каждый обработчик импортирует приложение (main.py)
+со своими кэшами, пулом соединений SQLite и клиентом OpenRouter, а внутри
+распределяет обновления по потокам диспетчером (dispatcher.py). Общий лимит
+отправки Telegram (OUTBOUND_GLOBAL_RPS) делится между обработчиками поровну.
+
+Обработчики раз в CLUSTER_METRICS_INTERVAL_S присылают снимок метрик, фронт
+сводит их в Cluster.metrics(). Перезапуск мягкий: старый процесс дорабатывает
+принятые обновления и выходит, и только затем на той же очереди стартует новый.
+SIGHUP — поочерёдный перезапуск всех обработчиков; упавший процесс
+поднимается автоматически.
+
+Запуск: python cluster.py
+"""
+import importlib
+import logging
+import multiprocessing as mp
+import os
+import queue
+import signal
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from dispatcher import payload_key
+from metrics import merge_snapshots, metric
+
+log = logging.getLogger(__name__)
+
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "4"))
+# Модуль приложения: атрибут bot и, по желанию, функции startup()/shutdown()
+CLUSTER_APP = os.getenv("CLUSTER_APP", "main")
+CLUSTER_QUEUE_SIZE = int(os.getenv("CLUSTER_QUEUE_SIZE", "1000"))
+CLUSTER_METRICS_INTERVAL_S = float(os.getenv("CLUSTER_METRICS_INTERVAL_S", "5"))
+# Сколько ждать, пока обработчик доработает очередь при остановке
+CLUSTER_STOP_TIMEOUT_S = float(os.getenv("CLUSTER_STOP_TIMEOUT_S", "30"))
+
+_EMPTY = object()
+
+
+def _worker_main(index: int, updates, events, app: str, metrics_interval_s: float, workers: int = 1) -> None:
+    """Точка входа процесса-обработчика: None в очереди — сигнал остановки."""
+    # Ctrl+C обрабатывает фронт, обработчик останавливается через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from outbound import get_outbound
+
+    # Лимит Telegram общий на токен бота: очередь отправки процесса получает свою долю
+    outbound = get_outbound()
+    outbound.set_global_rate(outbound.global_rps / workers)
+    from telebot import types
+    from dispatcher import install
+
+    module = importlib.import_module(app)
+    startup = getattr(module, "startup", None)
+    if startup is not None:
+        # Меню команд регистрирует только первый обработчик
+        startup(register_commands=index == 0)
+    bot = module.bot
+    dispatcher = install(bot)
+    next_report = time.monotonic() + metrics_interval_s
+    try:
+        while True:
+            try:
+                payload = updates.get(timeout=max(next_report - time.monotonic(), 0.01))
+            except queue.Empty:
+                payload = _EMPTY
+            if payload is None:
+                break
+            if payload is not _EMPTY:
+                bot.process_new_updates([types.Update.de_json(payload)])
+            if time.monotonic() >= next_report:
+                events.put(("metrics", index, metric.snapshot()))
+                next_report = time.monotonic() + metrics_interval_s
+    finally:
+        dispatcher.stop()
+        shutdown = getattr(module, "shutdown", None)
+        if shutdown is not None:
+            shutdown()
+        events.put(("final", index, metric.snapshot()))
+
+
+class Cluster:
+    """Фронт: маршрутизация по пользователям, сбор метрик, перезапуск обработчиков."""
+
+    def __init__(self, app: str = CLUSTER_APP, workers: int = CLUSTER_WORKERS,
+                 queue_size: int = CLUSTER_QUEUE_SIZE, metrics_interval_s: float = CLUSTER_METRICS_INTERVAL_S):
+        # spawn: обработчик начинает с чистого процесса, без копий потоков и соединений фронта
+        self._ctx = mp.get_context("spawn")
+        self.app = app
+        self.workers = max(workers, 1)
+        self.metrics_interval_s = metrics_interval_s
+        self._queues = [self._ctx.Queue(maxsize=queue_size) for _ in range(self.workers)]
+        self._events = self._ctx.Queue()
+        self._procs: list = [None] * self.workers
+        self._lock = threading.Lock()
+        # Перезапуск и надзор не должны одновременно поднимать процесс на одной очереди
+        self._restart_lock = threading.RLock()
+        self._snapshots: dict[int, dict] = {}
+        # Итоговые метрики завершившихся процессов, чтобы счётчики не обнулялись при перезапуске
+        self._retired: dict = {}
+        self._stopping = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def _spawn(self, index: int) -> None:
+        proc = self._ctx.Process(
+            target=_worker_main, name=f"bot-worker-{index}",
+            args=(index, self._queues[index], self._events, self.app, self.metrics_interval_s, self.workers),
+        )
+        proc.start()
+        self._procs[index] = proc
+        log.info(f"Обработчик {index} запущен (pid {proc.pid})")
+
+    def start(self) -> "Cluster":
+        for i in range(self.workers):
+            self._spawn(i)
+        for target, name in ((self._collect, "cluster-metrics"), (self._supervise, "cluster-supervisor")):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def pid(self, index: int) -> int | None:
+        proc = self._procs[index]
+        return proc.pid if proc is not None else None
+
+    # --- Маршрутизация ---
+
+    def shard(self, payload: dict) -> int:
+        return payload_key(payload) % self.workers
+
+    def route(self, payload: dict) -> None:
+        """Ставит обновление в очередь его обработчика (ждёт, если очередь полна)."""
+        self._queues[self.shard(payload)].put(payload)
+        metric.counter("cluster_routed_total").inc()
+
+    def process_new_updates(self, payloads: list[dict]) -> None:
+        for payload in payloads:
+            self.route(payload)
+
+    # --- Метрики ---
+
+    def _collect(self) -> None:
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            kind, index, snap = event
+            with self._lock:
+                if kind == "metrics":
+                    self._snapshots[index] = snap
+                else:
+                    self._snapshots.pop(index, None)
+                    # Gauge завершившегося процесса уже ничего не значат
+                    self._retired = merge_snapshots([self._retired, dict(snap, gauges={})])
+
+    def metrics(self) -> dict:
+        """Сводный снимок метрик: фронт, живые обработчики и завершившиеся процессы."""
+        with self._lock:
+            snaps = [self._retired, *self._snapshots.values()]
+        return merge_snapshots(snaps + [metric.snapshot()])
+
+    # --- Жизненный цикл обработчиков ---
+
+    def _stop_worker(self, index: int, timeout: float) -> None:
+        proc = self._procs[index]
+        if proc is None:
+            return
+        if proc.is_alive():
+            self._queues[index].put(None)
+            proc.join(timeout)
+            if proc.is_alive():
+                log.warning(f"Обработчик {index} не завершился за {timeout:.0f} с, принудительная остановка")
+                proc.terminate()
+                proc.join()
+        self._procs[index] = None
+
+    def restart_worker(self, index: int, timeout: float = CLUSTER_STOP_TIMEOUT_S) -> None:
+        """Мягкий перезапуск: новый процесс стартует после того, как старый доработал очередь."""
+        with self._restart_lock:
+            self._stop_worker(index, timeout)
+            if not self._stopping.is_set():
+                self._spawn(index)
+                metric.counter("cluster_restarts_total").inc()
+
+    def restart_all(self) -> None:
+        """Поочерёдный перезапуск: в каждый момент остановлен не больше чем один шард."""
+        for i in range(self.workers):
+            self.restart_worker(i)
+
+    def _supervise(self) -> None:
+        while not self._stopping.wait(1.0):
+            for i in range(self.workers):
+                with self._restart_lock:
+                    proc = self._procs[i]
+                    if self._stopping.is_set() or proc is None or proc.is_alive():
+                        continue
+                    log.error(f"Обработчик {i} завершился с кодом {proc.exitcode}, перезапуск")
+                    metric.counter("cluster_crashes_total").inc()
+                    self._spawn(i)
+
+    def stop(self, timeout: float = CLUSTER_STOP_TIMEOUT_S) -> None:
+        """Останавливает все обработчики, дав им доработать принятые обновления."""
+        self._stopping.set()
+        with self._restart_lock:
+            for i in range(self.workers):
+                if self._procs[i] is not None and self._procs[i].is_alive():
+                    self._queues[i].put(None)
+            for i in range(self.workers):
+                self._stop_worker(i, timeout)
+        self._events.put(None)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+
+def poll_updates(cluster: Cluster, token: str, long_polling_timeout: int = 20) -> None:
+    """Long polling во фронте: getUpdates и раскладка JSON по обработчикам."""
+    from telebot import apihelper
+
+    # Как skip_pending=True в main.py: старые обновления не обрабатываем
+    pending = apihelper.get_updates(token, offset=-1)
+    offset = pending[-1]["update_id"] + 1 if pending else None
+    while True:
+        try:
+            updates = apihelper.get_updates(token, offset=offset, timeout=long_polling_timeout,
+                                            long_polling_timeout=long_polling_timeout)
+        except Exception as e:
+            log.error(f"Ошибка getUpdates: {e}")
+            time.sleep(3)
+            continue
+        for payload in updates:
+            cluster.route(payload)
+            offset = payload["update_id"] + 1
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+    from logging_config import setup_logging
+    from telebot import TeleBot
+    from webhook import BOT_MODE, run_webhook
+
+    setup_logging()
+    load_dotenv()
+    token = os.getenv("TOKEN")
+    if not token:
+        raise RuntimeError("В .env файле нет TOKEN")
+
+    cluster = Cluster().start()
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=cluster.restart_all, name="cluster-restart", daemon=True).start())
+    log.info(f"Кластер: {cluster.workers} обработчиков, режим {BOT_MODE}")
+    try:
+        if BOT_MODE == "webhook":
+            run_webhook(TeleBot(token, threaded=False), handle=cluster.process_new_updates, decode=False)
+        else:
+            poll_updates(cluster, token)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cluster.stop()
+        counters = cluster.metrics()["counters"]
+        log.info(f"Кластер остановлен; обновлений: {counters.get('cluster_routed_total', 0)}")
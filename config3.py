@@ -44,7 +44,17 @@ CMD_MODEL_ID_ENABLED = True
 # --- Дополнительные динамические параметры ---
 DEFAULT_TEMPERATURE = 0.7
 DEFAULT_API_TIMEOUT = 30 # в секундах
+# Бюджет контекста в токенах: промпт + история + ответ модели
+CONTEXT_TOKEN_BUDGET = 4096
+# Сколько токенов оставлять под ответ (уходит в max_tokens запроса)
+REPLY_MAX_TOKENS = 1024
+# Сколько последних строк истории читать из БД перед подбором по бюджету
+CONTEXT_MAX_HISTORY_ROWS = 50
 
 # --- Дополнительные Feature Toggles ---
 WEATHER_COMMAND_ENABLED = True
-ASK_ENABLED = True
\ No newline at end of file
+ASK_ENABLED = True
+# Потоковые ответы: сообщение-заглушка правится по мере генерации
+STREAM_REPLIES_ENABLED = False
+# Минимальный интервал между правками одного сообщения (Telegram ограничивает частоту edit)
+STREAM_EDIT_INTERVAL_S = 1.0
@@ -1,131 +1,834 @@
+import logging
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from metrics import metric, timed
+
+log = logging.getLogger(__name__)
 
 DB_PATH = os.getenv("DB_PATH", "bot.db")
 
-def _connect():
-    conn = sqlite3.connect(DB_PATH, timeout=5.0)
+# --- Настройки пула соединений ---
+# Размер пула (0 — без пула: новое соединение на каждый вызов, как раньше)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# Сколько секунд ждать свободное соединение, если все заняты
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Соединение, простоявшее дольше этого (в секундах), проверяется через SELECT 1
+DB_POOL_HEALTHCHECK_S = float(os.getenv("DB_POOL_HEALTHCHECK_S", "30"))
+
+
+def _open_connection(path: str) -> sqlite3.Connection:
+    """Открывает новое соединение с нужными PRAGMA."""
+    conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON")
     conn.execute("PRAGMA journal_mode = WAL")
     conn.execute("PRAGMA busy_timeout = 5000")
+    # LOWER() в SQLite понимает только ASCII; для кириллицы нужен Python
+    conn.create_function("py_lower", 1, lambda s: s.lower() if isinstance(s, str) else s, deterministic=True)
+    conn.create_function("estimate_tokens", 1, estimate_tokens, deterministic=True)
+    metric.counter("db_connections_opened_total").inc()
     return conn
 
 
-# db.py
+class ConnectionPool:
+    """
+    Пул "прогретых" соединений SQLite.
 
-def init_db():
-    # Шаг 1: Определяем структуру всех таблиц
-    schema = """
-    CREATE TABLE IF NOT EXISTS chat_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        role TEXT NOT NULL,
-        message TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    CREATE TABLE IF NOT EXISTS notes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        text TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    CREATE TABLE IF NOT EXISTS models(
-        id INTEGER PRIMARY KEY,
-        key TEXT NOT NULL UNIQUE,
-        label TEXT NOT NULL,
-        active INTEGER NOT NULL DEFAULT 0 CHECK (active IN (0,1))
-    );
-    CREATE UNIQUE INDEX IF NOT EXISTS ux_models_single_active ON models(active) WHERE active=1;
-
-    CREATE TABLE IF NOT EXISTS characters (
-        id INTEGER PRIMARY KEY,
-        name TEXT NOT NULL UNIQUE,
-        prompt TEXT NOT NULL
-    );
-
-    CREATE TABLE IF NOT EXISTS user_character (
-        telegram_user_id INTEGER PRIMARY KEY,
-        character_id INTEGER NOT NULL,
-        FOREIGN KEY(character_id) REFERENCES characters(id)
-    );
-
-    CREATE TABLE IF NOT EXISTS settings (
-        key TEXT PRIMARY KEY,
-        value TEXT NOT NULL
-    );
-
-    CREATE TABLE IF NOT EXISTS feature_toggles (
-        name TEXT PRIMARY KEY,
-        enabled INTEGER NOT NULL CHECK (enabled IN (0, 1))
-    );
+    Соединения хранятся в ограниченной очереди и переиспользуются между вызовами,
+    поэтому PRAGMA и кэш подготовленных запросов не пересоздаются на каждый запрос.
+    Повторный вход в connection() из того же потока отдаёт то же соединение, а
+    вложенный блок работает в SAVEPOINT: его ошибка откатывает только его изменения.
     """
 
+    def __init__(self, path: str, size: int = 8, timeout: float = 5.0, health_check_s: float = 30.0):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.health_check_s = health_check_s
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size) if size > 0 else None
+        self._local = threading.local()
+        self._closed = False
+
+    def _is_healthy(self, conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self) -> sqlite3.Connection:
+        """Берёт соединение из пула (или открывает новое, если свободных нет)."""
+        if self._slots is None:
+            return _open_connection(self.path)
+        if not self._slots.acquire(timeout=self.timeout):
+            metric.counter("db_pool_timeouts_total").inc()
+            raise sqlite3.OperationalError("Пул соединений исчерпан: нет свободного соединения")
+        try:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return _open_connection(self.path)
+            if time.monotonic() - last_used > self.health_check_s and not self._is_healthy(conn):
+                metric.counter("db_pool_broken_total").inc()
+                conn.close()
+                return _open_connection(self.path)
+            return conn
+        except BaseException:
+            # Соединение не выдано (например, не открылся файл БД) — слот возвращаем
+            self._slots.release()
+            raise
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """Возвращает соединение в пул."""
+        if self._slots is None:
+            conn.close()
+            return
+        if self._closed:
+            conn.close()
+        else:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put((conn, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Контекстный менеджер: commit при успехе, rollback при ошибке, затем возврат в пул.
+        Функции, отложенные через after_commit(), выполняются только после успешного commit.
+        """
+        local = self._local
+        if getattr(local, "conn", None) is not None:
+            # Вложенный вызов в том же потоке — работаем в той же транзакции
+            yield from self._nested(local)
+            return
+        conn = self.acquire()
+        local.conn = conn
+        local.after_commit = []
+        local.depth = 0
+        try:
+            with conn:
+                yield conn
+            callbacks = local.after_commit
+        finally:
+            local.conn = None
+            local.after_commit = None
+            self.release(conn)
+        for fn in callbacks:
+            fn()
+
+    @staticmethod
+    def _nested(local):
+        """Вложенный блок: при ошибке откатывает только свои изменения и свои after_commit."""
+        conn = local.conn
+        mark = len(local.after_commit)
+        savepoint = None
+        if conn.in_transaction:
+            # Внешний блок уже что-то записал — защищаем его работу точкой сохранения
+            local.depth += 1
+            savepoint = f"nested_{local.depth}"
+            conn.execute(f"SAVEPOINT {savepoint}")
+        try:
+            yield conn
+        except BaseException:
+            del local.after_commit[mark:]
+            if savepoint is not None:
+                conn.execute(f"ROLLBACK TO {savepoint}")
+                conn.execute(f"RELEASE {savepoint}")
+            elif conn.in_transaction:
+                # До входа транзакции не было: откатывается только работа этого блока
+                conn.rollback()
+            raise
+        else:
+            if savepoint is not None:
+                conn.execute(f"RELEASE {savepoint}")
+        finally:
+            if savepoint is not None:
+                local.depth -= 1
+
+    def after_commit(self, fn) -> None:
+        """Откладывает fn до commit текущей транзакции потока; при rollback она не выполнится."""
+        callbacks = getattr(self._local, "after_commit", None)
+        if callbacks is None:
+            fn()
+        else:
+            callbacks.append(fn)
+
+    def close_all(self) -> None:
+        """Закрывает все свободные соединения; занятые закроются при возврате."""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
 
-    models_data = """
-    INSERT OR IGNORE INTO models(id, key, label, active) VALUES
-        (1, 'mistralai/mistral-7b-instruct:free', 'Mistral 7B Instruct (free)', 1),
-        (2, 'anthropic/claude-3-haiku', 'Claude 3 Haiku', 0);
+def _get_pool() -> ConnectionPool:
+    global _pool
+    pool = _pool
+    if pool is None or pool.path != DB_PATH:
+        with _pool_lock:
+            if _pool is None or _pool.path != DB_PATH:
+                if _pool is not None:
+                    _pool.close_all()
+                _pool = ConnectionPool(DB_PATH, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_S)
+            pool = _pool
+    return pool
+
+
+def configure_pool(size: int | None = None, timeout: float | None = None,
+                   health_check_s: float | None = None) -> None:
+    """Меняет параметры пула (старые соединения закрываются)."""
+    global DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_S
+    if size is not None:
+        DB_POOL_SIZE = size
+    if timeout is not None:
+        DB_POOL_TIMEOUT = timeout
+    if health_check_s is not None:
+        DB_POOL_HEALTHCHECK_S = health_check_s
+    close_all()
+
+
+def close_all() -> None:
+    """Закрывает все соединения пула (вызывать при остановке бота)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
+
+
+def _connect():
+    """Соединение из пула: `with _connect() as conn: ...`"""
+    return _get_pool().connection()
+
+
+def _after_commit(fn) -> None:
+    """Выполняет fn после commit транзакции, открытой _connect() в этом потоке."""
+    _get_pool().after_commit(fn)
+
+
+# --- Кэши таблиц в памяти процесса ---
+# Как часто (в секундах) сверять версию кэша с БД. Это же — максимальная
+# задержка, с которой процесс увидит изменения, сделанные другим процессом.
+CACHE_VERSION_CHECK_S = float(os.getenv("CACHE_VERSION_CHECK_S", "5"))
+
+
+def _read_version(conn: sqlite3.Connection, name: str) -> int:
+    row = conn.execute("SELECT version FROM cache_versions WHERE name = ?", (name,)).fetchone()
+    return row["version"] if row else 0
+
+
+class VersionedCache:
     """
+    Неизменяемый снимок таблиц в памяти, который перечитывается при смене версии.
 
+    Версию в таблице cache_versions увеличивают триггеры на каждое изменение
+    исходных таблиц (в том числе из других процессов). Раз в ttl_s секунд кэш
+    сверяет версию одним запросом по первичному ключу и перезагружается, если она
+    изменилась. Снимок заменяется целиком, поэтому читатели никогда не видят
+    наполовину обновлённые данные.
 
-    # Шаг 3: Данные для персонажей (этот блок у вас уже есть, он не меняется)
-    characters_data = """
-    INSERT OR IGNORE INTO characters (id, name, prompt) VALUES
-        (1, 'Йода', 'Ты отвечаешь строго в образе персонажа «Йода» из вселенной «Звёздные войны». Стиль: мудрые и загадочные речи, инверсия слов.'),
-        (2, 'Дарт Вейдер', 'Ты отвечаешь строго в образе персонажа «Дарт Вейдер» из «Звёздных войн». Стиль: властный, тёмный, угрожающий.'),
-        (3, 'Мистер Спок', 'Ты отвечаешь строго в образе персонажа «Спок» из «Звёздного пути». Стиль: логичный, беспристрастный, точный.'),
-        (4, 'Тони Старк', 'Ты отвечаешь строго в образе персонажа «Тони Старк» из киновселенной Marvel. Стиль: остроумный, саркастичный, гениальный.'),
-        (5, 'Шерлок Холмс', 'Ты отвечаешь строго в образе «Шерлока Холмса». Стиль: дедукция шаг за шагом, внимание к деталям.'),
-        (6, 'Капитан Джек Воробей', 'Ты отвечаешь строго в образе «Капитана Джека Воробья». Стиль: ироничный, эксцентричный, непредсказуемый.'),
-        (7, 'Гэндальф', 'Ты отвечаешь строго в образе «Гэндальфа» из «Властелина колец». Стиль: наставнический, мудрый, величественный.'),
-        (8, 'Винни-Пух', 'Ты отвечаешь строго в образе «Винни-Пуха». Стиль: просто, доброжелательно, наивный, с любовью к мёду.'),
-        (9, 'Голум', 'Ты отвечаешь строго в образе «Голума» из «Властелина колец». Стиль: шёпот, шипящие звуки, раздвоение личности.'),
-        (10, 'Рик', 'Ты отвечаешь строго в образе «Рика» из «Рика и Морти». Стиль: сухой сарказм, цинизм, научный жаргон.'),
-        (11, 'Бендер', 'Ты отвечаешь строго в образе «Бендера» из «Футурамы». Стиль: дерзкий, самоуверенный, эгоистичный.');
+    Вместо снимка loader может вернуть потокобезопасный контейнер (LRUCache):
+    тогда его меняют на месте под его собственной блокировкой, а целиком он
+    заменяется только при смене версии.
     """
 
-    # Шаг 4: Выполняем все запросы
+    def __init__(self, name: str, loader, ttl_s: float):
+        self.name = name
+        self.ttl_s = ttl_s
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version: int | None = None
+        self._path: str | None = None
+        self._checked_at = 0.0
+
+    def get(self):
+        """Возвращает актуальный снимок (из памяти, если версия не устарела)."""
+        snapshot = self._snapshot
+        if (snapshot is not None and self._path == DB_PATH
+                and time.monotonic() - self._checked_at < self.ttl_s):
+            metric.counter(f"{self.name}_cache_hits_total").inc()
+            return snapshot
+        with _connect() as conn, self._lock:
+            if conn.in_transaction:
+                # Внутри ещё не закоммиченной записи этого потока: её данные другим потокам не показываем
+                return self._loader(conn)
+            version = _read_version(conn, self.name)
+            if self._snapshot is not None and self._path == DB_PATH and version == self._version:
+                metric.counter(f"{self.name}_cache_hits_total").inc()
+            else:
+                metric.counter(f"{self.name}_cache_misses_total").inc()
+                self._snapshot = self._loader(conn)
+                self._version, self._path = version, DB_PATH
+            self._checked_at = time.monotonic()
+            return self._snapshot
+
+    def write_through(self, conn: sqlite3.Connection, update) -> None:
+        """
+        Применяет собственную запись к снимку без перечитывания таблиц.
+
+        Вызывается внутри транзакции записи, а снимок меняется только после её
+        commit: если с момента загрузки снимка версия выросла ровно на эту запись,
+        снимок заменяется результатом update(снимок), иначе кэш сбрасывается и
+        будет перечитан при следующем обращении. При rollback снимок не трогается.
+        Контейнер update меняет на месте и возвращает его же.
+        """
+        version = _read_version(conn, self.name)
+
+        def apply() -> None:
+            with self._lock:
+                if self._path == DB_PATH and self._version == version:
+                    return  # запись уже видна: снимок перечитали после commit
+                if self._snapshot is not None and self._path == DB_PATH and self._version == version - 1:
+                    self._snapshot = update(self._snapshot)
+                    self._version = version
+                else:
+                    self._snapshot = None
+
+        _after_commit(apply)
+
+    def reload(self, conn: sqlite3.Connection) -> None:
+        """Перечитывает снимок через переданное соединение (например, сразу после записи; виден после commit)."""
+        snapshot, version = self._loader(conn), _read_version(conn, self.name)
+
+        def publish() -> None:
+            with self._lock:
+                if self._path == DB_PATH and self._version is not None and self._version > version:
+                    return
+                self._snapshot, self._version, self._path = snapshot, version, DB_PATH
+                self._checked_at = time.monotonic()
+
+        _after_commit(publish)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshot = None
+            self._version = None
+
+
+@dataclass(frozen=True)
+class SettingsSnapshot:
+    """Снимок таблиц settings и feature_toggles."""
+    values: dict
+    toggles: dict
+
+
+def _load_settings(conn: sqlite3.Connection) -> SettingsSnapshot:
+    values = {r["key"]: r["value"] for r in conn.execute("SELECT key, value FROM settings")}
+    toggles = {r["name"]: bool(r["enabled"]) for r in conn.execute("SELECT name, enabled FROM feature_toggles")}
+    return SettingsSnapshot(values, toggles)
+
+
+@dataclass(frozen=True)
+class RegistrySnapshot:
+    """Снимок таблиц models и characters."""
+    models: tuple
+    active_model: dict | None
+    characters: dict
+    default_character: dict | None
+
+
+def _load_registry(conn: sqlite3.Connection) -> RegistrySnapshot:
+    rows = conn.execute("SELECT id, key, label, active FROM models ORDER BY id").fetchall()
+    active_id = next((r["id"] for r in rows if r["active"]), rows[0]["id"] if rows else None)
+    # Если активной модели нет, считаем активной первую (без UPDATE в пути чтения)
+    models = tuple(
+        {"id": r["id"], "key": r["key"], "label": r["label"], "active": r["id"] == active_id} for r in rows
+    )
+    active_model = next((m for m in models if m["active"]), None)
+    characters = {
+        r["id"]: {"id": r["id"], "name": r["name"], "prompt": r["prompt"]}
+        for r in conn.execute("SELECT id, name, prompt FROM characters ORDER BY id")
+    }
+    default_character = characters.get(1) or next(iter(characters.values()), None)
+    return RegistrySnapshot(models, active_model, characters, default_character)
+
+
+# Размер LRU-кэша "пользователь -> персонаж"
+USER_CHARACTER_CACHE_SIZE = int(os.getenv("USER_CHARACTER_CACHE_SIZE", "10000"))
+
+
+class LRUCache:
+    """Ограниченный по размеру потокобезопасный LRU-словарь."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def setdefault(self, key, value):
+        """Кладёт значение, только если ключа ещё нет (не затирает более свежую запись)."""
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = value
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+_settings_cache = VersionedCache("settings", _load_settings, CACHE_VERSION_CHECK_S)
+_registry_cache = VersionedCache("registry", _load_registry, CACHE_VERSION_CHECK_S)
+# Здесь не снимок, а общий LRU: потоки заполняют его на месте (под блокировкой
+# LRUCache), а новым, пустым, он заменяется при изменении таблицы user_character
+# другим процессом
+_user_character_cache = VersionedCache(
+    "user_character", lambda conn: LRUCache(USER_CHARACTER_CACHE_SIZE), CACHE_VERSION_CHECK_S
+)
+_CACHES = [_settings_cache, _registry_cache, _user_character_cache]
+
+
+def reset_caches() -> None:
+    """Сбрасывает все кэши (например, после смены БД)."""
+    for cache in _CACHES:
+        cache.invalidate()
+
+
+# db.py
+
+# --- Схема БД и миграции ---
+# Номер последней применённой миграции хранится в PRAGMA user_version.
+# Каждая миграция выполняется один раз в своей транзакции BEGIN IMMEDIATE,
+# поэтому схему можно обновлять на "живой" базе в режиме WAL: другие процессы
+# лишь подождут busy_timeout, а повторно миграцию никто не применит.
+# Все миграции идемпотентны (IF NOT EXISTS), так что базы, созданные до
+# появления миграций (user_version = 0), обновляются без потерь.
+
+# Исходная схема (миграция 1)
+_BASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    message TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS models(
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    label TEXT NOT NULL,
+    active INTEGER NOT NULL DEFAULT 0 CHECK (active IN (0,1))
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_models_single_active ON models(active) WHERE active=1;
+
+CREATE TABLE IF NOT EXISTS characters (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    prompt TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS user_character (
+    telegram_user_id INTEGER PRIMARY KEY,
+    character_id INTEGER NOT NULL,
+    FOREIGN KEY(character_id) REFERENCES characters(id)
+);
+
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS feature_toggles (
+    name TEXT PRIMARY KEY,
+    enabled INTEGER NOT NULL CHECK (enabled IN (0, 1))
+);
+"""
+
+_MODELS_DATA = """
+INSERT OR IGNORE INTO models(id, key, label, active) VALUES
+    (1, 'mistralai/mistral-7b-instruct:free', 'Mistral 7B Instruct (free)', 1),
+    (2, 'anthropic/claude-3-haiku', 'Claude 3 Haiku', 0);
+"""
+
+# Данные для персонажей
+_CHARACTERS_DATA = """
+INSERT OR IGNORE INTO characters (id, name, prompt) VALUES
+    (1, 'Йода', 'Ты отвечаешь строго в образе персонажа «Йода» из вселенной «Звёздные войны». Стиль: мудрые и загадочные речи, инверсия слов.'),
+    (2, 'Дарт Вейдер', 'Ты отвечаешь строго в образе персонажа «Дарт Вейдер» из «Звёздных войн». Стиль: властный, тёмный, угрожающий.'),
+    (3, 'Мистер Спок', 'Ты отвечаешь строго в образе персонажа «Спок» из «Звёздного пути». Стиль: логичный, беспристрастный, точный.'),
+    (4, 'Тони Старк', 'Ты отвечаешь строго в образе персонажа «Тони Старк» из киновселенной Marvel. Стиль: остроумный, саркастичный, гениальный.'),
+    (5, 'Шерлок Холмс', 'Ты отвечаешь строго в образе «Шерлока Холмса». Стиль: дедукция шаг за шагом, внимание к деталям.'),
+    (6, 'Капитан Джек Воробей', 'Ты отвечаешь строго в образе «Капитана Джека Воробья». Стиль: ироничный, эксцентричный, непредсказуемый.'),
+    (7, 'Гэндальф', 'Ты отвечаешь строго в образе «Гэндальфа» из «Властелина колец». Стиль: наставнический, мудрый, величественный.'),
+    (8, 'Винни-Пух', 'Ты отвечаешь строго в образе «Винни-Пуха». Стиль: просто, доброжелательно, наивный, с любовью к мёду.'),
+    (9, 'Голум', 'Ты отвечаешь строго в образе «Голума» из «Властелина колец». Стиль: шёпот, шипящие звуки, раздвоение личности.'),
+    (10, 'Рик', 'Ты отвечаешь строго в образе «Рика» из «Рика и Морти». Стиль: сухой сарказм, цинизм, научный жаргон.'),
+    (11, 'Бендер', 'Ты отвечаешь строго в образе «Бендера» из «Футурамы». Стиль: дерзкий, самоуверенный, эгоистичный.');
+"""
+
+
+def _execute_script(conn: sqlite3.Connection, script: str) -> None:
+    """Выполняет несколько выражений в текущей транзакции (executescript делает COMMIT)."""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+    if statement.strip():
+        conn.execute(statement)
+
+
+def _ensure_columns(conn: sqlite3.Connection, table: str, columns: dict[str, str]) -> None:
+    """Добавляет в таблицу недостающие колонки."""
+    existing = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+    for name, ddl in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+
+
+def _version_triggers(name: str, tables: tuple[str, ...]) -> str:
+    """SQL триггеров, увеличивающих версию кэша name при изменении таблиц."""
+    parts = [f"INSERT OR IGNORE INTO cache_versions(name, version) VALUES ('{name}', 0);"]
+    for table in tables:
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            parts.append(
+                f"CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version "
+                f"AFTER {event} ON {table} BEGIN "
+                f"UPDATE cache_versions SET version = version + 1 WHERE name = '{name}'; END;"
+            )
+    return "\n".join(parts)
+
+
+def _migration_base_schema(conn: sqlite3.Connection) -> None:
+    _execute_script(conn, _BASE_SCHEMA)
+
+
+def _migration_cache_versions(conn: sqlite3.Connection) -> None:
+    # Версии для кэшей в памяти: триггеры увеличивают счётчик при любом изменении
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    _execute_script(conn, _version_triggers("settings", ("settings", "feature_toggles")))
+    _execute_script(conn, _version_triggers("registry", ("models", "characters")))
+    _execute_script(conn, _version_triggers("user_character", ("user_character",)))
+
+
+def _migration_chat_history_meta(conn: sqlite3.Connection) -> None:
+    _ensure_columns(conn, "chat_history", {
+        "model_key": "TEXT",
+        "latency_ms": "INTEGER",
+        "prompt_tokens": "INTEGER",
+        "completion_tokens": "INTEGER",
+    })
+
+
+def _migration_user_indexes(conn: sqlite3.Connection) -> None:
+    # История и заметки всегда читаются "по пользователю, от новых к старым"
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_chat_history_user_id ON chat_history(user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_notes_user_id ON notes(user_id, id)")
+
+
+def _fts5_available(conn: sqlite3.Connection) -> bool:
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp._fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp._fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def _migration_notes_fts(conn: sqlite3.Connection) -> None:
+    # Полнотекстовый индекс по заметкам; без FTS5 поиск работает через LIKE.
+    # Таблица "contentless": тексты лежат в notes, а в индексе кроме слов есть
+    # токен владельца (u<user_id>), чтобы FTS сразу пересекал слова с заметками
+    # пользователя, а не ранжировал совпадения всех пользователей.
+    if not _fts5_available(conn):
+        log.warning("SQLite собран без FTS5: поиск заметок будет работать через LIKE")
+        return
+    _execute_script(conn, """
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            text,
+            owner,
+            content='',
+            prefix='2 3',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, text, owner) VALUES (new.id, new.text, 'u' || new.user_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, text, owner)
+            VALUES ('delete', old.id, old.text, 'u' || old.user_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_notes_fts_update AFTER UPDATE OF text, user_id ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, text, owner)
+            VALUES ('delete', old.id, old.text, 'u' || old.user_id);
+            INSERT INTO notes_fts(rowid, text, owner) VALUES (new.id, new.text, 'u' || new.user_id);
+        END;
+        INSERT INTO notes_fts(rowid, text, owner) SELECT id, text, 'u' || user_id FROM notes;
+    """)
+
+
+def _migration_note_counts(conn: sqlite3.Connection) -> None:
+    # Счётчик заметок на пользователя: чтение за O(1) вместо COUNT(*)
+    _execute_script(conn, """
+        CREATE TABLE IF NOT EXISTS note_counts (
+            user_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_note_counts_insert AFTER INSERT ON notes BEGIN
+            INSERT OR IGNORE INTO note_counts(user_id, count) VALUES (new.user_id, 0);
+            UPDATE note_counts SET count = count + 1 WHERE user_id = new.user_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_note_counts_delete AFTER DELETE ON notes BEGIN
+            UPDATE note_counts SET count = count - 1 WHERE user_id = old.user_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_note_counts_owner AFTER UPDATE OF user_id ON notes
+        WHEN old.user_id <> new.user_id BEGIN
+            UPDATE note_counts SET count = count - 1 WHERE user_id = old.user_id;
+            INSERT OR IGNORE INTO note_counts(user_id, count) VALUES (new.user_id, 0);
+            UPDATE note_counts SET count = count + 1 WHERE user_id = new.user_id;
+        END;
+    """)
+    _rebuild_note_counts(conn)
+
+
+def _migration_llm_cache(conn: sqlite3.Connection) -> None:
+    # Второй уровень кэша ответов LLM (см. llm_cache.py)
+    _execute_script(conn, """
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS ix_llm_cache_expires_at ON llm_cache(expires_at);
+    """)
+
+
+def _migration_history_token_estimate(conn: sqlite3.Connection) -> None:
+    # Оценка токенов хранится вместе с сообщением и не пересчитывается на каждом ходе
+    _ensure_columns(conn, "chat_history", {"token_estimate": "INTEGER"})
+    conn.execute("UPDATE chat_history SET token_estimate = estimate_tokens(message) WHERE token_estimate IS NULL")
+
+
+def _migration_chat_summaries(conn: sqlite3.Connection) -> None:
+    # Свёрнутое резюме старой части диалога; last_history_id — последняя свёрнутая строка
+    _execute_script(conn, """
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_history_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+
+
+# (версия, описание, функция) — только добавлять в конец, не менять применённые
+MIGRATIONS = [
+    (1, "исходная схема", _migration_base_schema),
+    (2, "версии кэшей и триггеры", _migration_cache_versions),
+    (3, "метаданные хода в chat_history", _migration_chat_history_meta),
+    (4, "индексы (user_id, id) для истории и заметок", _migration_user_indexes),
+    (5, "полнотекстовый поиск по заметкам (FTS5)", _migration_notes_fts),
+    (6, "счётчики заметок note_counts", _migration_note_counts),
+    (7, "кэш ответов LLM", _migration_llm_cache),
+    (8, "оценка токенов в chat_history", _migration_history_token_estimate),
+    (9, "резюме диалогов chat_summaries", _migration_chat_summaries),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие миграции и возвращает итоговую версию схемы."""
+    for version, description, apply in MIGRATIONS:
+        if _schema_version(conn) >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Пока мы ждали блокировку, миграцию мог применить другой процесс
+            if _schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            apply(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log.info("Миграция БД %d применена: %s", version, description)
+    return _schema_version(conn)
+
+
+def init_db():
+    """Приводит схему к последней версии и заполняет справочники."""
+    _notes_fts_by_path.pop(DB_PATH, None)
     with _connect() as conn:
-        conn.executescript(schema)
-        conn.executescript(models_data)  # <--- Добавляем выполнение запроса для моделей
-        conn.executescript(characters_data)
+        migrate(conn)
+        _has_notes_fts(conn)
+        _execute_script(conn, _MODELS_DATA)
+        _execute_script(conn, _CHARACTERS_DATA)
+    reset_caches()
 
 
 def add_note(user_id: int, text: str) -> int:
+    writer = _writer
+    if writer is not None:
+        # Ждём групповой коммит: ID заметки нужен вызывающему сразу
+        return writer.submit_note(user_id, text).result()
     with _connect() as conn:
-        cur = conn.execute(
-            "INSERT INTO notes(user_id, text) VALUES (?, ?)",
-            (user_id, text)
-        )
+        return _insert_note(conn, user_id, text)
+
+
+def _insert_note(conn: sqlite3.Connection, user_id: int, text: str) -> int:
+    cur = conn.execute(
+        "INSERT INTO notes(user_id, text) VALUES (?, ?)",
+        (user_id, text)
+    )
     return cur.lastrowid
 
 
-def list_notes(user_id: int, limit: int = 100):
+_MAX_ROWID = 2 ** 63 - 1
+
+
+def list_notes(user_id: int, limit: int = 100, before_id: int | None = None, after_id: int | None = None):
+    """
+    Заметки пользователя от новых к старым, постранично (keyset-пагинация).
+
+    before_id — следующая страница (заметки старше указанной),
+    after_id — предыдущая страница (ближайшие заметки новее указанной).
+    """
     with _connect() as conn:
+        if after_id is not None:
+            rows = conn.execute(
+                """SELECT id, text, created_at
+                FROM notes
+                WHERE user_id = ? AND id > ?
+                ORDER BY id ASC
+                LIMIT ?""",
+                (user_id, after_id, limit)
+            ).fetchall()
+            return rows[::-1]
         cur = conn.execute(
             """SELECT id, text, created_at
             FROM notes
-            WHERE user_id = ?
+            WHERE user_id = ? AND id < ?
             ORDER BY id DESC
             LIMIT ?""",
-            (user_id, limit)
+            (user_id, before_id if before_id is not None else _MAX_ROWID, limit)
         )
-    return cur.fetchall()
+        return cur.fetchall()
+
+
+_notes_fts_by_path: dict[str, bool] = {}
+
+
+def _has_notes_fts(conn: sqlite3.Connection) -> bool:
+    """Есть ли в текущей БД индекс notes_fts (проверяется один раз на путь к БД)."""
+    has_fts = _notes_fts_by_path.get(DB_PATH)
+    if has_fts is None:
+        row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notes_fts'").fetchone()
+        has_fts = _notes_fts_by_path[DB_PATH] = row is not None
+    return has_fts
+
+
+def _fts_query(user_id: int, query: str) -> str:
+    """
+    Превращает пользовательский запрос в запрос FTS5: заметки владельца,
+    в которых есть все слова запроса (каждое — как префикс).
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return ""
+    terms = " ".join(f'"{w}"*' for w in words)
+    return f'owner : "u{int(user_id)}" AND text : ({terms})'
 
 
 def find_notes(user_id: int, query: str, limit: int = 50):
-    """Поиск заметок по тексту"""
+    """
+    Поиск заметок по тексту (FTS5, по релевантности bm25).
+
+    Строки отсортированы по (rank, id убыв.) и содержат колонку rank. rank
+    меняется при любом изменении индекса, поэтому постранично результаты
+    листают по снимку id (см. get_notes_by_ids), а не по курсору из rank.
+    """
     with _connect() as conn:
-        cur = conn.execute(
-            """SELECT id, text, created_at
+        if _has_notes_fts(conn):
+            match = _fts_query(user_id, query)
+            if not match:
+                return []
+            return conn.execute(
+                """SELECT n.id, n.text, n.created_at, bm25(notes_fts, 1.0, 0.0) AS rank
+                FROM notes_fts
+                JOIN notes n ON n.id = notes_fts.rowid
+                WHERE notes_fts MATCH ? AND n.user_id = ?
+                ORDER BY rank ASC, n.id DESC
+                LIMIT ?""",
+                (match, user_id, limit)
+            ).fetchall()
+        return conn.execute(
+            """SELECT id, text, created_at, 0.0 AS rank
             FROM notes
-            WHERE user_id = ? AND LOWER(text) LIKE LOWER(?)
+            WHERE user_id = ? AND py_lower(text) LIKE py_lower(?)
             ORDER BY id DESC
             LIMIT ?""",
             (user_id, f"%{query}%", limit)
-        )
-    return cur.fetchall()
+        ).fetchall()
+
+
+def get_notes_by_ids(user_id: int, ids: list[int]) -> list:
+    """Заметки пользователя с указанными id в том же порядке (удалённые пропускаются)."""
+    if not ids:
+        return []
+    with _connect() as conn:
+        rows = conn.execute(
+            f"""SELECT id, text, created_at
+            FROM notes
+            WHERE user_id = ? AND id IN ({",".join("?" * len(ids))})""",
+            (user_id, *ids)
+        ).fetchall()
+    by_id = {r["id"]: r for r in rows}
+    return [by_id[i] for i in ids if i in by_id]
 
 
 def get_note_by_id(user_id: int, note_id: int):
@@ -137,7 +840,7 @@ def get_note_by_id(user_id: int, note_id: int):
             WHERE user_id = ? AND id = ?""",
             (user_id, note_id)
         )
-    return cur.fetchone()
+        return cur.fetchone()
 
 
 def update_note(user_id: int, note_id: int, text: str) -> bool:
@@ -151,20 +854,13 @@ def update_note(user_id: int, note_id: int, text: str) -> bool:
     return cur.rowcount > 0
 
 def list_models() -> list[dict]:
-    with _connect() as conn:
-        rows = conn.execute("SELECT id,key,label,active FROM models ORDER BY id").fetchall()
-        return [{"id":r["id"], "key":r["key"], "label":r["label"], "active":bool(r["active"])} for r in rows]
+    return [dict(m) for m in _registry_cache.get().models]
 
 def get_active_model() -> dict:
-    with _connect() as conn:
-        row = conn.execute("SELECT id,key,label FROM models WHERE active=1").fetchone()
-        if row:
-            return {"id":row["id"], "key":row["key"], "label":row["label"], "active":True}
-        row = conn.execute("SELECT id,key,label FROM models ORDER BY id LIMIT 1").fetchone()
-        if not row:
-            raise RuntimeError("В реестре моделей нет записей")
-        conn.execute("UPDATE models SET active=CASE WHEN id=? THEN 1 ELSE 0 END", (row["id"],))
-        return {"id":row["id"], "key":row["key"], "label":row["label"], "active":True}
+    active = _registry_cache.get().active_model
+    if active is None:
+        raise RuntimeError("В реестре моделей нет записей")
+    return dict(active)
 
 
 # db.py
@@ -190,6 +886,9 @@ def set_active_model(model_id: int) -> dict:
         # Нарушить UNIQUE constraint теперь невозможно.
         conn.execute("UPDATE models SET active=1 WHERE id=?", (model_id,))
 
+        # Сразу подменяем снимок реестра, не дожидаясь проверки версии
+        _registry_cache.reload(conn)
+
     return get_active_model()
 
 def delete_note(user_id: int, note_id: int) -> bool:
@@ -201,25 +900,56 @@ def delete_note(user_id: int, note_id: int) -> bool:
     return cur.rowcount > 0
 
 
+def count_notes(user_id: int) -> int:
+    """Количество заметок пользователя (из счётчика note_counts)."""
+    with _connect() as conn:
+        row = conn.execute("SELECT count FROM note_counts WHERE user_id = ?", (user_id,)).fetchone()
+        return row["count"] if row else 0
+
+
+def _rebuild_note_counts(conn: sqlite3.Connection) -> None:
+    conn.execute("DELETE FROM note_counts")
+    conn.execute(
+        "INSERT INTO note_counts(user_id, count) SELECT user_id, COUNT(*) FROM notes GROUP BY user_id"
+    )
+
+
+def check_note_counts() -> list[dict]:
+    """Сверяет счётчики с реальным количеством заметок; возвращает расхождения."""
+    with _connect() as conn:
+        rows = conn.execute(
+            """
+            SELECT u.user_id, COALESCE(c.count, 0) AS stored, COALESCE(a.actual, 0) AS actual
+            FROM (SELECT user_id FROM note_counts UNION SELECT DISTINCT user_id FROM notes) u
+            LEFT JOIN note_counts c ON c.user_id = u.user_id
+            LEFT JOIN (SELECT user_id, COUNT(*) AS actual FROM notes GROUP BY user_id) a
+                ON a.user_id = u.user_id
+            WHERE COALESCE(c.count, 0) <> COALESCE(a.actual, 0)
+            """
+        ).fetchall()
+        return [{"user_id": r["user_id"], "stored": r["stored"], "actual": r["actual"]} for r in rows]
+
+
+def rebuild_note_counts() -> int:
+    """Пересчитывает все счётчики заново; возвращает число исправленных расхождений."""
+    mismatches = check_note_counts()
+    if mismatches:
+        with _connect() as conn:
+            _rebuild_note_counts(conn)
+    return len(mismatches)
+
+
 # --- Функции для работы с персонажами ---
 
 def list_characters() -> list[dict]:
     """Возвращает список всех персонажей."""
-    with _connect() as conn:
-        rows = conn.execute("SELECT id, name FROM characters ORDER BY id").fetchall()
-        return [{"id": r["id"], "name": r["name"]} for r in rows]
+    return [{"id": c["id"], "name": c["name"]} for c in _registry_cache.get().characters.values()]
 
 
 def get_character_by_id(character_id: int) -> dict | None:
     """Возвращает персонажа по его ID."""
-    with _connect() as conn:
-        row = conn.execute(
-            "SELECT id, name, prompt FROM characters WHERE id=?",
-            (character_id,)
-        ).fetchone()
-        if row:
-            return {"id": row["id"], "name": row["name"], "prompt": row["prompt"]}
-        return None
+    character = _registry_cache.get().characters.get(character_id)
+    return dict(character) if character else None
 
 
 def set_user_character(user_id: int, character_id: int) -> dict:
@@ -235,68 +965,74 @@ def set_user_character(user_id: int, character_id: int) -> dict:
             """,
             (user_id, character_id)
         )
+
+        def remember(lru: LRUCache) -> LRUCache:
+            lru.put(user_id, character_id)
+            return lru
+
+        _user_character_cache.write_through(conn, remember)
     return character
 
 
+_NOT_CACHED = object()
+
+
 def get_user_character(user_id: int) -> dict:
     """Получает персонажа для пользователя, с фолбэком на первого в списке."""
-    with _connect() as conn:
-        # Сначала пробуем найти выбранного персонажа
-        row = conn.execute("""
-            SELECT p.id, p.name, p.prompt
-            FROM user_character uc
-            JOIN characters p ON p.id = uc.character_id
-            WHERE uc.telegram_user_id = ?
-        """, (user_id,)).fetchone()
-        if row:
-            return {"id": row["id"], "name": row["name"], "prompt": row["prompt"]}
-
-        # Если не найден, берем первого персонажа по умолчанию (ID=1)
-        row = conn.execute("SELECT id, name, prompt FROM characters WHERE id=1").fetchone()
-        if row:
-            return {"id": row["id"], "name": row["name"], "prompt": row["prompt"]}
-
-        # Если и его нет, берем вообще любого первого
-        row = conn.execute("SELECT id, name, prompt FROM characters ORDER BY id LIMIT 1").fetchone()
-        if not row:
-            raise RuntimeError("Таблица characters пуста")
-        return {"id": row["id"], "name": row["name"], "prompt": row["prompt"]}
+    registry = _registry_cache.get()
+    mapping = _user_character_cache.get()
+    character_id = mapping.get(user_id, _NOT_CACHED)
+    if character_id is _NOT_CACHED:
+        metric.counter("user_character_lru_misses_total").inc()
+        with _connect() as conn:
+            row = conn.execute(
+                "SELECT character_id FROM user_character WHERE telegram_user_id = ?", (user_id,)
+            ).fetchone()
+        character_id = mapping.setdefault(user_id, row["character_id"] if row else None)
+
+    # Выбранный персонаж, иначе персонаж по умолчанию (ID=1 или первый в списке)
+    character = registry.characters.get(character_id) or registry.default_character
+    if character is None:
+        raise RuntimeError("Таблица characters пуста")
+    return dict(character)
 
 
 def get_setting_or_default(key: str, default: str) -> str:
     """Возвращает динамический параметр по ключу. Если его нет - возвращает default."""
-    with _connect() as conn:
-        row = conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
-        if row is None:
-            return default
-        return row["value"]
+    return _settings_cache.get().values.get(key, default)
 
 
-def get_int_setting(key: str, default: int) -> int:
-    """Возвращает динамический параметр по ключу в виде int."""
-    raw = get_setting_or_default(key, str(default))
+def _parse_int(raw: str, default: int) -> int:
     try:
         return int(raw)
     except ValueError:
         return default
 
 
+def _parse_float(raw: str, default: float) -> float:
+    try:
+        return float(raw)
+    except ValueError:
+        return default
+
+
+def _parse_bool(raw: str) -> bool:
+    return raw.lower() in ("1", "true", "yes", "on")
+
+
+def get_int_setting(key: str, default: int) -> int:
+    """Возвращает динамический параметр по ключу в виде int."""
+    return _parse_int(get_setting_or_default(key, str(default)), default)
+
+
 def get_bool_setting(key: str, default: bool) -> bool:
     """Возвращает динамический параметр по ключу в виде bool."""
-    raw = get_setting_or_default(key, "true" if default else "false")
-    raw_low = raw.lower()
-    if raw_low in ("1", "true", "yes", "on"):
-        return True
-    return False
+    return _parse_bool(get_setting_or_default(key, "true" if default else "false"))
 
 
 def is_feature_enabled(name: str, default: bool) -> bool:
     """Возвращает состояние фиче-тоггла по имени (включен/выключен)."""
-    with _connect() as conn:
-        row = conn.execute("SELECT enabled FROM feature_toggles WHERE name = ?", (name,)).fetchone()
-        if row is None:
-            return default
-        return bool(row["enabled"])
+    return _settings_cache.get().toggles.get(name, default)
 
 
 def set_setting(key: str, value: str) -> None:
@@ -307,6 +1043,9 @@ def set_setting(key: str, value: str) -> None:
             "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
             (key, value),
         )
+        _settings_cache.write_through(
+            conn, lambda snap: SettingsSnapshot({**snap.values, key: value}, snap.toggles)
+        )
 
 def set_feature_toggle(name: str, enabled: bool) -> None:
     """Установить фиче-тоггл (UPSERT)."""
@@ -316,33 +1055,445 @@ def set_feature_toggle(name: str, enabled: bool) -> None:
             "ON CONFLICT(name) DO UPDATE SET enabled = excluded.enabled",
             (name, 1 if enabled else 0),
         )
+        _settings_cache.write_through(
+            conn, lambda snap: SettingsSnapshot(snap.values, {**snap.toggles, name: bool(enabled)})
+        )
 
 # db.py (в самый конец файла)
 
 # --- Функции для работы с историей чата ---
 
+_HISTORY_INSERT_SQL = """
+    INSERT INTO chat_history
+        (user_id, role, message, model_key, latency_ms, prompt_tokens, completion_tokens, token_estimate)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Служебные токены на одно сообщение (роль, разделители)
+TOKENS_PER_MESSAGE = 4
+
+
+def estimate_tokens(text: str | None) -> int:
+    """
+    Грубая оценка числа токенов без токенизатора: латиница и цифры — около
+    4 символов на токен, кириллица и прочее — около 2, плюс служебные токены.
+    """
+    if not text:
+        return TOKENS_PER_MESSAGE
+    ascii_chars = sum(1 for ch in text if ch < "\x80")
+    other_chars = len(text) - ascii_chars
+    return TOKENS_PER_MESSAGE + (ascii_chars + 3) // 4 + (other_chars + 1) // 2
+
+
+def _write_history_rows(user_id: int, rows: list[tuple]) -> None:
+    """Пишет строки истории сразу или через фоновый писатель, если он запущен."""
+    writer = _writer
+    if writer is not None:
+        writer.submit_history(user_id, rows)
+        return
+    with _connect() as conn:
+        conn.executemany(_HISTORY_INSERT_SQL, rows)
+
+
 def add_to_chat_history(user_id: int, role: str, message: str):
     """Добавляет новое сообщение в историю чата пользователя."""
-    with _connect() as conn:
-        conn.execute(
-            "INSERT INTO chat_history (user_id, role, message) VALUES (?, ?, ?)",
-            (user_id, role, message)
-        )
+    _write_history_rows(user_id, [(user_id, role, message, None, None, None, None, estimate_tokens(message))])
+
+def record_turn(user_id: int, user_text: str, assistant_text: str, meta: dict | None = None) -> None:
+    """
+    Сохраняет ход диалога (вопрос и ответ) одной транзакцией.
+
+    meta может содержать model_key, latency_ms, prompt_tokens и completion_tokens;
+    модель пишется в обе строки, задержка и токены — в строку ответа.
+    """
+    meta = meta or {}
+    model_key = meta.get("model_key")
+    completion_tokens = meta.get("completion_tokens")
+    # Для ответа есть точное число токенов от API — оно лучше оценки
+    assistant_tokens = completion_tokens + TOKENS_PER_MESSAGE if completion_tokens else estimate_tokens(assistant_text)
+    rows = [
+        (user_id, "user", user_text, model_key, None, None, None, estimate_tokens(user_text)),
+        (user_id, "assistant", assistant_text, model_key,
+         meta.get("latency_ms"), meta.get("prompt_tokens"), completion_tokens, assistant_tokens),
+    ]
+    _write_history_rows(user_id, rows)
+
+
+def _fetch_history(conn: sqlite3.Connection, user_id: int, limit: int, after_id: int = 0,
+                   oldest_first: bool = False) -> list[dict]:
+    """limit последних (или, с oldest_first, самых старых) строк после after_id."""
+    rows = conn.execute(
+        f"""
+        SELECT id, role, message, COALESCE(token_estimate, estimate_tokens(message)) AS tokens
+        FROM chat_history
+        WHERE user_id = ? AND id > ? ORDER BY id {"ASC" if oldest_first else "DESC"} LIMIT ?
+        """,
+        (user_id, after_id, limit)
+    ).fetchall()
+    # Возвращаем в хронологическом порядке (старые -> новые)
+    return [
+        {"id": r["id"], "role": r["role"], "message": r["message"], "tokens": r["tokens"]}
+        for r in (rows if oldest_first else reversed(rows))
+    ]
+
+
+def _history_window(conn: sqlite3.Connection, user_id: int, limit: int, after_id: int = 0) -> list[dict]:
+    """
+    История из БД (строки с id > after_id) плюс ещё не записанные строки
+    фонового писателя (read-your-writes); у последних id равен None.
+    """
+    writer = _writer
+    if writer is None or not writer.has_pending(user_id):
+        return _fetch_history(conn, user_id, limit, after_id)
+    with writer.commit_lock:
+        history = _fetch_history(conn, user_id, limit, after_id) + writer.pending_history(user_id)
+    return history[-limit:] if limit > 0 else []
+
 
 def get_chat_history(user_id: int, limit: int = 10) -> list[dict]:
     """Получает последние 'limit' сообщений из истории чата."""
     with _connect() as conn:
-        rows = conn.execute(
-            """
-            SELECT role, message FROM chat_history
-            WHERE user_id = ? ORDER BY id DESC LIMIT ?
-            """,
-            (user_id, limit)
-        ).fetchall()
-        # Возвращаем в хронологическом порядке (старые -> новые)
-        return [{"role": r["role"], "message": r["message"]} for r in reversed(rows)]
+        return [{"role": h["role"], "message": h["message"]} for h in _history_window(conn, user_id, limit)]
 
 def clear_chat_history(user_id: int):
     """Очищает всю историю чата для пользователя."""
+    if _writer is not None:
+        _writer.flush()
+    with _connect() as conn:
+        conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM chat_summaries WHERE user_id = ?", (user_id,))
+
+
+# --- Резюме диалога ---
+
+def _fetch_summary(conn: sqlite3.Connection, user_id: int) -> dict | None:
+    row = conn.execute(
+        "SELECT summary, last_history_id FROM chat_summaries WHERE user_id = ?", (user_id,)
+    ).fetchone()
+    return {"summary": row["summary"], "last_history_id": row["last_history_id"]} if row else None
+
+
+def get_chat_summary(user_id: int) -> dict | None:
+    """Резюме свёрнутой части диалога: {"summary", "last_history_id"} или None."""
+    with _connect() as conn:
+        return _fetch_summary(conn, user_id)
+
+
+def get_unsummarized_history(user_id: int, limit: int = 50) -> tuple[dict | None, list[dict]]:
+    """
+    Резюме и самые старые строки истории после него (не больше limit), чтобы
+    свёртка шла по порядку и ни одна строка не осталась за резюме. Очередь
+    фонового писателя сначала сбрасывается, поэтому у всех строк есть id.
+    """
+    if _writer is not None and _writer.has_pending(user_id):
+        _writer.flush()
+    with _connect() as conn:
+        summary = _fetch_summary(conn, user_id)
+        history = _fetch_history(conn, user_id, limit, summary["last_history_id"] if summary else 0,
+                                 oldest_first=True)
+    return summary, history
+
+
+def save_chat_summary(user_id: int, summary: str, last_history_id: int) -> bool:
+    """
+    Сохраняет резюме истории до строки last_history_id включительно. Не пишет,
+    если эту строку уже удалили (/clear во время свёртки) или сохранённое
+    резюме охватывает больше. Возвращает True, если резюме записано.
+    """
+    with _connect() as conn:
+        cur = conn.execute(
+            """
+            INSERT INTO chat_summaries(user_id, summary, last_history_id)
+            SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM chat_history WHERE id = ? AND user_id = ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                summary = excluded.summary,
+                last_history_id = excluded.last_history_id,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE excluded.last_history_id > chat_summaries.last_history_id
+            """,
+            (user_id, summary, last_history_id, last_history_id, user_id)
+        )
+        return cur.rowcount > 0
+
+
+# --- Кэш ответов LLM (второй уровень) ---
+
+def llm_cache_get(key: str, now: float) -> tuple[str, float] | None:
+    """Возвращает (JSON ответа, срок годности) или None, если записи нет или она устарела."""
+    with _connect() as conn:
+        row = conn.execute(
+            "SELECT value, expires_at FROM llm_cache WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+    return (row["value"], row["expires_at"]) if row else None
+
+
+def llm_cache_put(key: str, value: str, expires_at: float, max_rows: int) -> None:
+    """Сохраняет ответ; при переполнении удаляет истёкшие и самые старые записи."""
+    with _connect() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache(key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, expires_at)
+        )
+        (rows,) = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        if rows > max_rows:
+            conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN "
+                "(SELECT key FROM llm_cache ORDER BY expires_at LIMIT max(0, (SELECT COUNT(*) FROM llm_cache) - ?))",
+                (max_rows,)
+            )
+
+
+# --- Отложенная запись истории и заметок (write-behind) ---
+# Включить фоновый писатель при старте бота
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0").lower() in ("1", "true", "yes", "on")
+# Групповой коммит — не реже чем раз в FLUSH_MS миллисекунд или каждые BATCH строк
+DB_WRITE_BEHIND_FLUSH_MS = int(os.getenv("DB_WRITE_BEHIND_FLUSH_MS", "50"))
+DB_WRITE_BEHIND_BATCH = int(os.getenv("DB_WRITE_BEHIND_BATCH", "200"))
+# Размер очереди: если она заполнена, обработчик ждёт (backpressure)
+DB_WRITE_BEHIND_QUEUE = int(os.getenv("DB_WRITE_BEHIND_QUEUE", "10000"))
+
+_STOP = object()
+
+
+class WriteBehindWriter:
+    """
+    Фоновый поток, который записывает историю чата и заметки пачками.
+
+    Обработчик Telegram только кладёт запись в ограниченную очередь, а поток
+    собирает её в одну транзакцию каждые flush_ms мс или max_batch записей.
+    Пока строки истории не записаны, они видны get_chat_history того же
+    пользователя через pending_history().
+    """
+
+    def __init__(self, flush_ms: int = 50, max_batch: int = 200, max_queue: int = 10000):
+        self.flush_s = flush_ms / 1000
+        self.max_batch = max_batch
+        self._queue: queue.Queue = queue.Queue(max_queue)
+        # Коммит пачки и чтение "БД + очередь" не должны перемежаться
+        self.commit_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending: dict[int, list[dict]] = {}
+        self._thread = threading.Thread(target=self._run, name="db-write-behind", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _put(self, item, timeout: float | None = None) -> bool:
+        """Кладёт запись в очередь; при полной очереди ждёт не дольше timeout (False — не успели)."""
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            metric.counter("db_write_behind_backpressure_total").inc()
+            try:
+                self._queue.put(item, timeout=timeout)
+            except queue.Full:
+                return False
+        return True
+
+    def submit_history(self, user_id: int, rows: list[tuple]) -> None:
+        with self._pending_lock:
+            self._pending.setdefault(user_id, []).extend(
+                {"id": None, "role": r[1], "message": r[2], "tokens": r[7]} for r in rows
+            )
+        self._put(("history", user_id, rows))
+
+    def submit_note(self, user_id: int, text: str) -> Future:
+        future: Future = Future()
+        self._put(("note", user_id, text, future))
+        return future
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Дожидается записи всего, что было поставлено в очередь до вызова (False — не дождались)."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        done = threading.Event()
+        if not self._put(("flush", done), timeout):
+            log.error("Фоновый писатель: очередь полна и не разбирается, flush не дождался записи")
+            return False
+        return done.wait(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+
+    def stop(self, timeout: float | None = 10.0) -> bool:
+        """Записывает остаток очереди и останавливает поток. False — не уложились в timeout."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if not self._put(_STOP, timeout):
+            # Поток умер или завис: ждать места в очереди бесконечно нельзя — остановка зависнет
+            log.error("Фоновый писатель не принял остановку за %s с, незаписанных записей: %d",
+                      timeout, self._queue.qsize())
+            return False
+        self._thread.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+        if self._thread.is_alive():
+            log.error("Фоновый писатель не дописал очередь за %s с", timeout)
+            return False
+        return True
+
+    def has_pending(self, user_id: int) -> bool:
+        return bool(self._pending.get(user_id))
+
+    def pending_history(self, user_id: int) -> list[dict]:
+        with self._pending_lock:
+            return list(self._pending.get(user_id, ()))
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            if batch[0] is _STOP:
+                break
+            deadline = time.monotonic() + self.flush_s
+            # Кто-то ждёт результат (flush или ID заметки) — коммитим, не дожидаясь таймера
+            while len(batch) < self.max_batch and batch[-1][0] not in ("flush", "note"):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Например, пул не выдал соединение: поток не должен умирать
+                log.exception("Фоновый писатель не смог записать пачку: %s", e)
+                metric.counter("db_write_behind_errors_total").inc(len(batch))
+                self._settle(batch, [e] * len(batch))
+
+    def _commit(self, batch: list) -> None:
+        t0 = time.perf_counter()
+        with _connect() as conn, self.commit_lock:
+            try:
+                results = [self._apply(conn, item) for item in batch]
+                conn.commit()
+            except Exception as e:
+                # Пачка не прошла — пишем записи по одной, чтобы потерять только сбойные
+                conn.rollback()
+                log.error("Ошибка группового коммита (%d записей): %s", len(batch), e)
+                results = []
+                for item in batch:
+                    try:
+                        results.append(self._apply(conn, item))
+                        conn.commit()
+                    except Exception as item_error:
+                        conn.rollback()
+                        metric.counter("db_write_behind_errors_total").inc()
+                        results.append(item_error)
+            self._settle(batch, results)
+        metric.counter("db_write_behind_batches_total").inc()
+        metric.counter("db_write_behind_items_total").inc(len(batch))
+        metric.latency("db_write_behind_commit_ms").observe(int((time.perf_counter() - t0) * 1000))
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, item):
+        kind = item[0]
+        if kind == "history":
+            conn.executemany(_HISTORY_INSERT_SQL, item[2])
+        elif kind == "note":
+            return _insert_note(conn, item[1], item[2])
+        return None
+
+    def _settle(self, batch: list, results: list) -> None:
+        """Снимает записанные строки с оверлея и завершает ожидающих."""
+        with self._pending_lock:
+            for item in batch:
+                if item[0] == "history":
+                    pending = self._pending.get(item[1], [])
+                    del pending[:len(item[2])]
+                    if not pending:
+                        self._pending.pop(item[1], None)
+        for item, result in zip(batch, results):
+            if item[0] == "note":
+                if isinstance(result, Exception):
+                    item[3].set_exception(result)
+                else:
+                    item[3].set_result(result)
+            elif item[0] == "flush":
+                item[1].set()
+
+
+_writer: WriteBehindWriter | None = None
+
+
+def start_write_behind(flush_ms: int | None = None, max_batch: int | None = None,
+                       max_queue: int | None = None) -> WriteBehindWriter:
+    """Запускает фоновый писатель истории и заметок."""
+    global _writer
+    if _writer is None:
+        writer = WriteBehindWriter(
+            flush_ms if flush_ms is not None else DB_WRITE_BEHIND_FLUSH_MS,
+            max_batch if max_batch is not None else DB_WRITE_BEHIND_BATCH,
+            max_queue if max_queue is not None else DB_WRITE_BEHIND_QUEUE,
+        )
+        writer.start()
+        _writer = writer
+    return _writer
+
+
+def stop_write_behind(timeout: float | None = 10.0) -> None:
+    """Дописывает очередь и останавливает фоновый писатель (вызывать при остановке бота)."""
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop(timeout)
+
+
+# --- Контекст одного хода диалога ---
+
+@dataclass(frozen=True)
+class TurnContext:
+    """Всё, что нужно обработчику для одного хода диалога с LLM."""
+    user_id: int
+    character: dict
+    history: tuple
+    model: dict
+    temperature: float
+    api_timeout: int
+    show_footer: bool
+    max_prompt_chars: int
+    ask_enabled: bool
+    stream_replies: bool = False
+    context_budget: int = 4096
+    reply_max_tokens: int = 1024
+    summary: str | None = None
+
+
+@timed("load_turn_context_ms")
+def load_turn_context(user_id: int, history_limit: int = 10, *,
+                      temperature: float = 0.7, api_timeout: int = 30, show_footer: bool = True,
+                      max_prompt_chars: int = 600, ask_enabled: bool = True,
+                      stream_replies: bool = False, context_budget: int = 4096,
+                      reply_max_tokens: int = 1024) -> TurnContext:
+    """
+    Загружает персонажа, окно истории, активную модель и настройки за один раз.
+
+    Все обращения идут через одно соединение; конфигурация берётся из кэшей,
+    так что обычно к БД уходит только запрос истории. Именованные аргументы —
+    значения по умолчанию для отсутствующих настроек. Строки истории содержат
+    ключ "tokens" — сохранённую оценку длины сообщения в токенах. Если старая
+    часть диалога свёрнута в резюме, история начинается после неё.
+    """
     with _connect() as conn:
-        conn.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
\ No newline at end of file
+        settings = _settings_cache.get()
+        character = get_user_character(user_id)
+        model = get_active_model()
+        summary = _fetch_summary(conn, user_id)
+        after_id = summary["last_history_id"] if summary else 0
+        history = _history_window(conn, user_id, history_limit, after_id)
+    values = settings.values
+    return TurnContext(
+        user_id=user_id,
+        character=character,
+        history=tuple(history),
+        model=model,
+        temperature=_parse_float(values.get("temperature", str(temperature)), temperature),
+        api_timeout=_parse_int(values.get("api_timeout", str(api_timeout)), api_timeout),
+        show_footer=_parse_bool(values.get("show_model_footer", "true" if show_footer else "false")),
+        max_prompt_chars=_parse_int(values.get("max_prompt_chars", str(max_prompt_chars)), max_prompt_chars),
+        ask_enabled=settings.toggles.get("ask_enabled", ask_enabled),
+        stream_replies=settings.toggles.get("stream_replies", stream_replies),
+        context_budget=_parse_int(values.get("context_token_budget", str(context_budget)), context_budget),
+        reply_max_tokens=_parse_int(values.get("reply_max_tokens", str(reply_max_tokens)), reply_max_tokens),
+        summary=summary["summary"] if summary else None,
+    )
@@ -0,0 +1,136 @@
+# dispatcher.py
+"""
+Диспетчер обновлений Telegram с сохранением порядка для каждого пользователя.
+
+Обновления раскладываются по DISPATCH_WORKERS очередям по from_user.id: у
+каждого пользователя своя очередь и свой поток-обработчик, поэтому его сообщения
+обрабатываются строго по одному и по порядку (без гонок за chat_history), а
+медленный запрос к LLM задерживает только пользователей того же шарда.
+
+Бот создаётся с threaded=False, а install() подменяет bot.process_new_updates:
+поток polling только раскладывает обновления по очередям.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable
+
+from metrics import metric
+
+log = logging.getLogger(__name__)
+
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+# Размер очереди шарда; при переполнении polling ждёт (обратное давление)
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", "1000"))
+
+# Поля Update, у которых есть from_user (в порядке частоты)
+_USER_FIELDS = (
+    "message", "callback_query", "edited_message", "inline_query", "chosen_inline_result",
+    "shipping_query", "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+    "chat_join_request",
+)
+
+_STOP = object()
+
+
+def update_key(update) -> int:
+    """Ключ шардирования: id пользователя, иначе id чата, иначе update_id."""
+    for field in _USER_FIELDS:
+        event = getattr(update, field, None)
+        if event is None:
+            continue
+        user = getattr(event, "from_user", None) or getattr(event, "user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(event, "chat", None)
+        if chat is not None:
+            return chat.id
+    return getattr(update, "update_id", 0)
+
+
+def payload_key(payload: dict) -> int:
+    """update_key для JSON обновления (как его присылает Telegram)."""
+    for field in _USER_FIELDS:
+        event = payload.get(field)
+        if not event:
+            continue
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+        chat = event.get("chat")
+        if chat:
+            return chat["id"]
+    return payload.get("update_id", 0)
+
+
+class ShardedDispatcher:
+    """Пул обработчиков: по одному потоку и одной очереди на шард."""
+
+    def __init__(self, handle: Callable[[list], None], workers: int = DISPATCH_WORKERS,
+                 queue_size: int = DISPATCH_QUEUE_SIZE, key: Callable[[object], int] = update_key):
+        self._handle = handle
+        self._key = key
+        self.workers = max(workers, 1)
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(self.workers)]
+        self._threads: list[threading.Thread] = []
+        self._depth = metric.gauge("dispatch_queue_depth")
+
+    def start(self) -> "ShardedDispatcher":
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"dispatch-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def shard(self, update) -> int:
+        return self._key(update) % self.workers
+
+    def submit(self, update) -> None:
+        self._depth.inc()
+        self._queues[self.shard(update)].put((time.perf_counter(), update))
+
+    def process_new_updates(self, updates: list) -> None:
+        """Замена TeleBot.process_new_updates: только раскладывает обновления по очередям."""
+        for update in updates:
+            self.submit(update)
+        metric.counter("dispatch_updates_total").inc(len(updates))
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            enqueued_at, update = item
+            self._depth.dec()
+            metric.latency("dispatch_wait_ms").observe(int((time.perf_counter() - enqueued_at) * 1000))
+            try:
+                self._handle([update])
+            except Exception as e:
+                # Ошибка одного обновления не должна останавливать шард
+                metric.counter("dispatch_errors_total").inc()
+                log.error(f"Ошибка обработки обновления {getattr(update, 'update_id', '?')}: {e}", exc_info=True)
+
+    def stop(self, timeout: float | None = 10.0) -> None:
+        """Дорабатывает уже принятые обновления и останавливает потоки."""
+        for q in self._queues:
+            q.put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+
+def install(bot, workers: int = DISPATCH_WORKERS, queue_size: int = DISPATCH_QUEUE_SIZE) -> ShardedDispatcher:
+    """
+    Подключает диспетчер к боту, созданному с threaded=False: исходный
+    process_new_updates вызывается в потоках шардов, по одному обновлению.
+    """
+    if getattr(bot, "threaded", False):
+        log.warning("Диспетчер подключён к боту с threaded=True: порядок внутри пользователя не гарантирован")
+    dispatcher = ShardedDispatcher(bot.process_new_updates, workers, queue_size).start()
+    bot.process_new_updates = dispatcher.process_new_updates
+    return dispatcher
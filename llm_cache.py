@@ -0,0 +1,152 @@
+# llm_cache.py
+"""
+Кэш ответов LLM для детерминированных вызовов.
+
+Ключ — sha256 от канонического JSON (модель, сообщения, temperature, max_tokens).
+Уровни: в памяти (TTL + LRU по числу записей и объёму текста) и, по желанию,
+таблица llm_cache в bot.db, которая переживает перезапуск и общая для процессов.
+Вызовы с temperature выше LLM_CACHE_MAX_TEMPERATURE в кэш не попадают:
+там пользователь ждёт каждый раз новый ответ.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import db
+from metrics import metric
+
+log = logging.getLogger(__name__)
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S", "3600"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+# Суммарный объём закэшированных текстов в памяти (символы)
+LLM_CACHE_MAX_CHARS = int(os.getenv("LLM_CACHE_MAX_CHARS", "2000000"))
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.3"))
+# Второй уровень в SQLite (таблица llm_cache в bot.db)
+LLM_CACHE_SQLITE = os.getenv("LLM_CACHE_SQLITE", "0") == "1"
+LLM_CACHE_SQLITE_MAX_ROWS = int(os.getenv("LLM_CACHE_SQLITE_MAX_ROWS", "10000"))
+
+
+def make_key(model: str, msgs: list[dict], temperature: float, max_tokens: int) -> str:
+    """Канонический хэш запроса: одинаковые по смыслу запросы дают один ключ."""
+    canonical = json.dumps(
+        {"model": model, "messages": msgs, "temperature": round(float(temperature), 4), "max_tokens": max_tokens},
+        sort_keys=True, ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SQLiteStore:
+    """Второй уровень кэша: таблица llm_cache (см. db.llm_cache_get/llm_cache_put)."""
+
+    def __init__(self, max_rows: int = LLM_CACHE_SQLITE_MAX_ROWS):
+        self.max_rows = max_rows
+
+    def get(self, key: str) -> tuple[dict, float] | None:
+        row = db.llm_cache_get(key, time.time())
+        if row is None:
+            return None
+        value, expires_at = row
+        return json.loads(value), expires_at
+
+    def put(self, key: str, value: dict, expires_at: float) -> None:
+        db.llm_cache_put(key, json.dumps(value, ensure_ascii=False), expires_at, self.max_rows)
+
+
+class LLMCache:
+    """
+    Кэш ответов: значения — словари (поля ChatResult). Потокобезопасен.
+    Ошибки второго уровня только логируются: кэш не должен ломать ответ бота.
+    """
+
+    def __init__(self, ttl_s: float = LLM_CACHE_TTL_S, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 max_chars: int = LLM_CACHE_MAX_CHARS, max_temperature: float = LLM_CACHE_MAX_TEMPERATURE,
+                 store: SQLiteStore | None = None):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.max_temperature = max_temperature
+        self.store = store
+        # key -> (expires_at, value, size)
+        self._data: OrderedDict = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def cacheable(self, temperature: float) -> bool:
+        if temperature <= self.max_temperature:
+            return True
+        metric.counter("llm_cache_bypass_total").inc()
+        return False
+
+    def get(self, key: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._data.move_to_end(key)
+                    metric.counter("llm_cache_hits_total").inc()
+                    return entry[1]
+                self._remove(key)
+        if self.store is not None:
+            try:
+                found = self.store.get(key)
+            except Exception as e:
+                log.warning(f"Кэш LLM в SQLite недоступен: {e}")
+                found = None
+            if found is not None:
+                value, expires_at = found
+                with self._lock:
+                    self._insert(key, value, expires_at)
+                metric.counter("llm_cache_hits_total").inc()
+                metric.counter("llm_cache_sqlite_hits_total").inc()
+                return value
+        metric.counter("llm_cache_misses_total").inc()
+        return None
+
+    def put(self, key: str, value: dict) -> None:
+        expires_at = time.time() + self.ttl_s
+        with self._lock:
+            self._insert(key, value, expires_at)
+        if self.store is not None:
+            try:
+                self.store.put(key, value, expires_at)
+            except Exception as e:
+                log.warning(f"Не удалось записать ответ в кэш LLM (SQLite): {e}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._chars = 0
+
+    def _insert(self, key: str, value: dict, expires_at: float) -> None:
+        if key in self._data:
+            self._remove(key)
+        size = len(value.get("text") or "")
+        if size > self.max_chars:
+            return
+        self._data[key] = (expires_at, value, size)
+        self._chars += size
+        while len(self._data) > self.max_entries or self._chars > self.max_chars:
+            old_key = next(iter(self._data))
+            self._remove(old_key)
+            metric.counter("llm_cache_evictions_total").inc()
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self._data.pop(key)
+        self._chars -= size
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def default_cache() -> LLMCache | None:
+    """Кэш по настройкам из окружения (None, если кэш выключен)."""
+    if not LLM_CACHE_ENABLED:
+        return None
+    return LLMCache(store=SQLiteStore() if LLM_CACHE_SQLITE else None)
@@ -5,11 +5,14 @@
 # --- Стандартные библиотеки ---
 import os
 import logging
+import math
 import random
+import time
 
 # --- Сторонние библиотеки ---
 import requests
 from telebot import TeleBot, types
+from telebot.apihelper import ApiTelegramException
 from dotenv import load_dotenv
 from duckduckgo_search import DDGS
 
@@ -19,20 +22,31 @@ from config3 import (
     MAX_PROMPT_CHARS_DEFAULT, SHOW_MODEL_FOOTER_DEFAULT,
     DEBUG_SETTINGS_SHOW, CMD_MODEL_ID_ENABLED,
     DEFAULT_TEMPERATURE, DEFAULT_API_TIMEOUT,
-    WEATHER_COMMAND_ENABLED, ASK_ENABLED
+    WEATHER_COMMAND_ENABLED, ASK_ENABLED,
+    STREAM_REPLIES_ENABLED, STREAM_EDIT_INTERVAL_S,
+    CONTEXT_TOKEN_BUDGET, REPLY_MAX_TOKENS, CONTEXT_MAX_HISTORY_ROWS,
 )
 # База данных
 from db import (
     init_db,
     get_active_model, set_active_model,
     get_user_character, set_user_character, list_characters, get_character_by_id, list_models,
-    get_int_setting, get_bool_setting, get_setting_or_default,
+    get_int_setting, get_bool_setting,
     set_setting, set_feature_toggle, is_feature_enabled,
-    add_to_chat_history, get_chat_history, clear_chat_history,
-    add_note  # Для команды summarize_and_save
+    clear_chat_history, get_unsummarized_history,
+    add_note,  # Для команды summarize_and_save
+    load_turn_context, TurnContext, record_turn, estimate_tokens,
+    DB_WRITE_BEHIND, start_write_behind, stop_write_behind,
+    close_all as close_db_pool,
 )
 # Клиент для AI
-from openrouter_client import chat_once, OpenRouterError
+from openrouter_client import chat_stream, close_client, is_transient, ChatResult, OpenRouterError
+from model_router import get_router
+from rate_limit import RateLimited
+from summarizer import SUMMARY_ENABLED, get_summarizer
+from dispatcher import install as install_dispatcher
+from webhook import BOT_MODE, run_webhook
+from outbound import get_outbound, install as install_outbound
 # Наши кастомные модули
 from logging_config import setup_logging
 from metrics import metric, timed
@@ -48,8 +62,11 @@ log = logging.getLogger(__name__)
 # 2. Загружаем переменные окружения из .env файла
 load_dotenv()
 
-# 3. Инициализируем бота
-bot = TeleBot(os.getenv('TOKEN'))
+# 3. Инициализируем бота. Потоками обработчиков управляет dispatcher.py:
+# обновления одного пользователя обрабатываются по порядку, разных — параллельно
+bot = TeleBot(os.getenv('TOKEN'), threaded=False)
+# Все отправки идут через общую очередь с лимитами Telegram (outbound.py)
+install_outbound(bot)
 log.info("Старт приложения (инициализация бота)")
 
 
@@ -64,11 +81,38 @@ def make_main_kb() -> types.ReplyKeyboardMarkup:
     return kb
 
 
-@timed("build_messages_ms", logger=log)
-def _build_messages(user_id: int, user_text: str) -> list[dict]:
-    """Формирует промпт для LLM с учетом персонажа и ИСТОРИИ ДИАЛОГА."""
-    p = get_user_character(user_id)
-    history = get_chat_history(user_id)
+def _load_turn_context(user_id: int) -> TurnContext:
+    """Загружает контекст хода, подставляя значения по умолчанию из конфигурации."""
+    return load_turn_context(
+        user_id,
+        history_limit=CONTEXT_MAX_HISTORY_ROWS,
+        temperature=DEFAULT_TEMPERATURE,
+        api_timeout=DEFAULT_API_TIMEOUT,
+        show_footer=SHOW_MODEL_FOOTER_DEFAULT,
+        max_prompt_chars=MAX_PROMPT_CHARS_DEFAULT,
+        ask_enabled=ASK_ENABLED,
+        stream_replies=STREAM_REPLIES_ENABLED,
+        context_budget=CONTEXT_TOKEN_BUDGET,
+        reply_max_tokens=REPLY_MAX_TOKENS,
+    )
+
+
+def _fit_history(history, budget: int) -> list[dict]:
+    """Самые свежие сообщения истории, суммарно укладывающиеся в budget токенов."""
+    fitted = []
+    for h in reversed(history):
+        budget -= h["tokens"]
+        if budget < 0:
+            metric.counter("context_history_truncated_total").inc()
+            break
+        fitted.append(h)
+    fitted.reverse()
+    return fitted
+
+
+def _messages_from_context(ctx: TurnContext, user_text: str) -> list[dict]:
+    """Формирует промпт для LLM из готового контекста хода (персонаж + ИСТОРИЯ ДИАЛОГА)."""
+    p = ctx.character
     system_prompt = (
         f"Ты отвечаешь строго в образе персонажа «{p['name']}».\n"
         f"{p['prompt']}\n"
@@ -76,12 +120,25 @@ def _build_messages(user_id: int, user_text: str) -> list[dict]:
         "1) Всегда держи стиль и манеру речи.\n"
         "2) Не раскрывай, что ты 'играешь роль'.\n"
     )
+    # История заполняет то, что осталось от бюджета после промпта и резерва под ответ
+    budget = ctx.context_budget - ctx.reply_max_tokens - estimate_tokens(system_prompt) - estimate_tokens(user_text)
     messages = [{"role": "system", "content": system_prompt}]
-    messages.extend(history)
+    if ctx.summary:
+        # Свёрнутая часть диалога идёт в промпт вместо сырых сообщений
+        summary_prompt = f"Краткое содержание предыдущей части диалога:\n{ctx.summary}"
+        budget -= estimate_tokens(summary_prompt)
+        messages.append({"role": "system", "content": summary_prompt})
+    messages.extend({"role": h["role"], "content": h["message"]} for h in _fit_history(ctx.history, budget))
     messages.append({"role": "user", "content": user_text})
     return messages
 
 
+@timed("build_messages_ms", logger=log)
+def _build_messages(user_id: int, user_text: str) -> list[dict]:
+    """Формирует промпт для LLM с учетом персонажа и ИСТОРИИ ДИАЛОГА."""
+    return _messages_from_context(_load_turn_context(user_id), user_text)
+
+
 def _build_messages_for_character(character: dict, user_text: str) -> list[dict]:
     """Формирует промпт для LLM для СЛУЧАЙНОГО персонажа (без истории)."""
     system = (
@@ -91,6 +148,86 @@ def _build_messages_for_character(character: dict, user_text: str) -> list[dict]
     return [{"role": "system", "content": system}, {"role": "user", "content": user_text}]
 
 
+def _reply_rate_limited(message: types.Message, e: RateLimited) -> None:
+    """Мгновенный ответ вместо ожидания, если квота не освободится до дедлайна."""
+    metric.counter("rate_limited_replies_total").inc()
+    bot.reply_to(message, f"⏳ Слишком много запросов. Попробуйте через {math.ceil(e.retry_after)} с.")
+
+
+# Telegram не примет сообщение длиннее этого
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def _edit_reply(chat_id: int, message_id: int, text: str, parse_mode: str | None = None) -> float:
+    """
+    Правит сообщение с ответом. Возвращает, сколько секунд нужно подождать
+    до следующей правки (больше нуля, только если Telegram ответил 429).
+    """
+    try:
+        bot.edit_message_text(text[:TELEGRAM_MESSAGE_LIMIT], chat_id, message_id, parse_mode=parse_mode)
+        metric.counter("stream_edits_total").inc()
+    except ApiTelegramException as e:
+        if e.error_code == 429:
+            metric.counter("stream_edits_throttled_total").inc()
+            return float((e.result_json.get("parameters") or {}).get("retry_after", STREAM_EDIT_INTERVAL_S))
+        if "message is not modified" not in e.description:
+            raise
+    return 0.0
+
+
+def _stream_reply(message: types.Message, msgs: list[dict], ctx: TurnContext) -> tuple[ChatResult, types.Message]:
+    """
+    Отправляет заглушку и правит её по мере прихода фрагментов ответа —
+    не чаще раза в STREAM_EDIT_INTERVAL_S, чтобы не упереться в лимиты Telegram.
+    Финальную правку (с разметкой и футером) делает вызывающий код.
+    """
+    router = get_router()
+    model_key = router.pick(ctx.model["key"])
+    router.admit(model_key, ctx.user_id)
+    placeholder = bot.reply_to(message, "⏳ …")
+    stream = chat_stream(msgs, model=model_key, temperature=ctx.temperature,
+                         max_tokens=ctx.reply_max_tokens, timeout_s=ctx.api_timeout)
+    next_edit = time.monotonic() + STREAM_EDIT_INTERVAL_S
+    shown = ""
+    try:
+        for _ in stream:
+            now = time.monotonic()
+            if now < next_edit or stream.text.strip() == shown:
+                continue
+            shown = stream.text.strip()
+            # Промежуточный текст без parse_mode: незакрытая разметка дала бы ошибку 400
+            wait_s = _edit_reply(placeholder.chat.id, placeholder.message_id, shown + " …")
+            next_edit = time.monotonic() + max(wait_s, STREAM_EDIT_INTERVAL_S)
+    except Exception as e:
+        if is_transient(e):
+            router.observe(model_key, False, stream.ms)
+        try:
+            _edit_reply(placeholder.chat.id, placeholder.message_id,
+                        (shown + "\n\n" if shown else "") + "⚠️ Ответ прерван.")
+        except ApiTelegramException as edit_error:
+            log.warning(f"Не удалось пометить прерванный ответ: {edit_error.description}")
+        raise
+    result = stream.result()
+    router.observe(model_key, True, result.ms)
+    return result, placeholder
+
+
+def _finish_stream_reply(placeholder: types.Message, text: str) -> None:
+    """Финальная правка: с Markdown, а если разметка не разобралась — простым текстом."""
+    for parse_mode in ("Markdown", None):
+        try:
+            wait_s = _edit_reply(placeholder.chat.id, placeholder.message_id, text, parse_mode=parse_mode)
+            if wait_s:
+                # Итоговый текст терять нельзя: ждём, сколько просит Telegram, и повторяем
+                time.sleep(wait_s)
+                _edit_reply(placeholder.chat.id, placeholder.message_id, text, parse_mode=parse_mode)
+            return
+        except ApiTelegramException as e:
+            if parse_mode is None:
+                raise
+            log.warning(f"Не удалось применить Markdown к ответу: {e.description}")
+
+
 # =================================================================================
 # --------------------------- ОБРАБОТЧИКИ КОМАНД (HANDLERS) -------------------------
 # =================================================================================
@@ -162,10 +299,12 @@ def cmd_ask_web(message: types.Message):
 
         msgs = [{"role": "user", "content": final_prompt}]
         model_key = get_active_model()["key"]
-        response_text, ms = chat_once(msgs, model=model_key)
+        response_text = get_router().chat(msgs, primary=model_key, user_id=user_id).text
 
         bot.reply_to(message, response_text)
 
+    except RateLimited as e:
+        _reply_rate_limited(message, e)
     except Exception as e:
         log.error(f"Ошибка в /ask_web: {e}", exc_info=True)
         bot.reply_to(message, f"Произошла ошибка при поиске в интернете: {e}")
@@ -177,23 +316,24 @@ def cmd_summarize_and_save(message: types.Message):
     metric.counter("commands_total").inc()
     metric.counter("summarize_requests_total").inc()
     user_id = message.from_user.id
-    history = get_chat_history(user_id)
-    if not history:
+    summary, history = get_unsummarized_history(user_id, 1)
+    if not summary and not history:
         bot.reply_to(message, "История диалога пуста, нечего сохранять.")
         return
     try:
-        bot.send_chat_action(message.chat.id, 'typing')
-        dialog_text = "\n".join([f"{h['role']}: {h['message']}" for h in history])
-        prompt = (
-            "Сделай краткое, но емкое резюме следующего диалога. "
-            "Выдели ключевые темы и выводы. Ответ должен быть только самим текстом заметки.\n\n"
-            f"ДИАЛОГ:\n{dialog_text}"
-        )
-        msgs = [{"role": "user", "content": prompt}]
-        model_key = get_active_model()["key"]
-        summary_text, ms = chat_once(msgs, model=model_key, temperature=0.2)
-        note_id = add_note(user_id, summary_text)
+        if history:
+            bot.send_chat_action(message.chat.id, 'typing')
+        # Сохранённое резюме дополняется только новыми ходами, длинный хвост — по частям;
+        # последние сообщения попадают в заметку, но остаются в промпте как есть
+        text = get_summarizer().full_summary(user_id, get_active_model()["key"])
+        if not text:
+            # Историю очистили, пока строилось резюме
+            bot.reply_to(message, "История диалога пуста, нечего сохранять.")
+            return
+        note_id = add_note(user_id, text)
         bot.reply_to(message, f"Готово! Сохранил резюме нашего разговора в заметку #{note_id}.")
+    except RateLimited as e:
+        _reply_rate_limited(message, e)
     except Exception as e:
         log.error(f"Ошибка в /summarize_and_save: {e}", exc_info=True)
         bot.reply_to(message, f"Произошла ошибка при создании резюме: {e}")
@@ -201,6 +341,14 @@ def cmd_summarize_and_save(message: types.Message):
 
 # --- Команды настройки и управления ---
 
+def _model_health(snap: dict | None) -> str:
+    """Живая статистика модели за последние вызовы для /models."""
+    if not snap or not snap["count"]:
+        return ""
+    latency = f"p50 {snap['p50_ms']} мс, p95 {snap['p95_ms']} мс" if snap["p50_ms"] is not None else "нет ответов"
+    return f" — {latency}, ошибок {snap['error_rate']:.0%} (из {snap['count']})"
+
+
 @bot.message_handler(commands=['models'])
 def cmd_models(message: types.Message) -> None:
     metric.counter("commands_total").inc()
@@ -209,10 +357,11 @@ def cmd_models(message: types.Message) -> None:
         bot.reply_to(message, "Команда временно отключена.")
         return
     items = list_models()
+    live = get_router().snapshot()
     lines = ["**Доступные модели:**"]
     for m in items:
         star = "★" if m["active"] else " "
-        lines.append(f"{star} `{m['id']}`. {m['label']}")
+        lines.append(f"{star} `{m['id']}`. {m['label']}{_model_health(live.get(m['key']))}")
     lines.append("\n**Активировать:** /model <ID>")
     bot.reply_to(message, "\n".join(lines), parse_mode="Markdown")
 
@@ -371,29 +520,48 @@ def on_text_message(message: types.Message):
         # bot.reply_to(message, "Неизвестная команда. Используйте /help.")
         return
 
-    if not is_feature_enabled("ask_enabled", ASK_ENABLED):
-        return
-
-    max_len = get_int_setting("max_prompt_chars", MAX_PROMPT_CHARS_DEFAULT)
-    q = q[:max_len]
-
     try:
-        bot.send_chat_action(message.chat.id, 'typing')
-        msgs = _build_messages(user_id, q)
-        model_key = get_active_model()["key"]
-        temperature = float(get_setting_or_default("temperature", str(DEFAULT_TEMPERATURE)))
-        timeout = get_int_setting("api_timeout", DEFAULT_API_TIMEOUT)
-        response_text, ms = chat_once(msgs, model=model_key, temperature=temperature, timeout_s=timeout)
-
-        add_to_chat_history(user_id, "user", q)
-        add_to_chat_history(user_id, "assistant", response_text)
-
-        show_footer = get_bool_setting("show_model_footer", SHOW_MODEL_FOOTER_DEFAULT)
-        character = get_user_character(user_id)
-        add_info = f"\n\n({ms} мс; модель: {model_key}; как: {character['name']})" if show_footer else ""
-
-        bot.reply_to(message, f"{response_text}{add_info}", parse_mode="Markdown")
+        # Один снимок персонажа, истории, модели и настроек на весь ход
+        ctx = _load_turn_context(user_id)
+        if not ctx.ask_enabled:
+            return
 
+        q = q[:ctx.max_prompt_chars]
+        msgs = _messages_from_context(ctx, q)
+        model_key = ctx.model["key"]
+        placeholder = None
+        if ctx.stream_replies:
+            result, placeholder = _stream_reply(message, msgs, ctx)
+        else:
+            bot.send_chat_action(message.chat.id, 'typing')
+            result = get_router().chat(msgs, primary=model_key, temperature=ctx.temperature,
+                                       max_tokens=ctx.reply_max_tokens, timeout_s=ctx.api_timeout,
+                                       user_id=user_id)
+        # Роутер мог ответить запасной моделью
+        model_key = result.model
+        response_text, ms = result.text, result.ms
+
+        # Вопрос и ответ сохраняются вместе: полуходов в истории не бывает
+        record_turn(user_id, q, response_text, {
+            "model_key": model_key,
+            "latency_ms": ms,
+            "prompt_tokens": result.prompt_tokens,
+            "completion_tokens": result.completion_tokens,
+        })
+
+        add_info = f"\n\n({ms} мс; модель: {model_key}; как: {ctx.character['name']})" if ctx.show_footer else ""
+
+        if placeholder is None:
+            bot.reply_to(message, f"{response_text}{add_info}", parse_mode="Markdown")
+        else:
+            _finish_stream_reply(placeholder, f"{response_text}{add_info}")
+
+        if SUMMARY_ENABLED:
+            history_tokens = sum(h["tokens"] for h in ctx.history) + estimate_tokens(q) + estimate_tokens(response_text)
+            get_summarizer().maybe_schedule(user_id, model_key, history_tokens)
+
+    except RateLimited as e:
+        _reply_rate_limited(message, e)
     except Exception as e:
         log.error(f"Ошибка в on_text_message: {e}", exc_info=True)
         bot.reply_to(message, f"Произошла ошибка: {e}")
@@ -422,14 +590,40 @@ def setup_bot_commands():
     bot.set_my_commands(cmds)
 
 
-if __name__ == '__main__':
+def startup(register_commands: bool = True) -> None:
+    """Предстартовая настройка процесса: схема БД, фоновая запись истории, меню команд."""
     log.info("Настройка меню команд...")
     try:
         init_db()
-        setup_bot_commands()
-        log.info("Меню команд успешно настроено.")
+        if DB_WRITE_BEHIND:
+            start_write_behind()
+            log.info("Фоновая запись истории включена")
+        if register_commands:
+            setup_bot_commands()
+            log.info("Меню команд успешно настроено.")
     except Exception as e:
         log.error(f"Не удалось выполнить предстартовую настройку: {e}", exc_info=True)
 
-    log.info("Запуск long polling...")
-    bot.infinity_polling(skip_pending=True)
\ No newline at end of file
+
+def shutdown() -> None:
+    """Дописывает историю и освобождает соединения процесса."""
+    get_outbound().stop()
+    stop_write_behind()
+    close_db_pool()
+    get_summarizer().close(wait=False)
+    close_client()
+
+
+if __name__ == '__main__':
+    startup()
+    dispatcher = install_dispatcher(bot)
+    try:
+        if BOT_MODE == "webhook":
+            log.info(f"Запуск в режиме webhook ({dispatcher.workers} потоков-обработчиков)...")
+            run_webhook(bot)
+        else:
+            log.info(f"Запуск long polling ({dispatcher.workers} потоков-обработчиков)...")
+            bot.infinity_polling(skip_pending=True)
+    finally:
+        dispatcher.stop()
+        shutdown()
@@ -1,9 +1,14 @@
 import os
+import hashlib
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 import telebot
+from telebot import types
 import time
 import db
 from datetime import datetime
+from webhook import BOT_MODE, run_webhook
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -41,6 +46,7 @@ def help_cmd(message):
 /note\_show `<id>` - Показать полную заметку
 /note\_edit `<id>` `<новый текст>` - Изменить заметку
 /note\_del `<id>` - Удалить заметку
+/note\_count - Сколько у меня заметок
 
 💡 **Примеры:**
 /note\_add Купить молоко
@@ -67,30 +73,149 @@ def note_add(message):
         bot.reply_to(message, f"❌ Ошибка при добавлении заметки: {str(e)}")
 
 
+# --- Постраничный вывод заметок ---
+# Заметок на одной странице (из БД читается ровно страница + 1 строка)
+NOTES_PAGE_SIZE = 10
+# Лимит Telegram на длину сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Запас под подпись "... страница обрезана" и разметку
+PAGE_RESERVE = 96
+
+# Результаты поиска для кнопок: в callback_data влезает только 64 байта, поэтому там
+# лишь токен и номер страницы, а запрос, найденные id и начала уже показанных
+# страниц хранятся здесь. Листание идёт по снимку id на момент /note_find: rank
+# bm25 меняется при каждой новой заметке, и курсор по нему терял бы или повторял
+# строки между страницами. Начала страниц запоминаются, потому что страница,
+# обрезанная по лимиту сообщения, короче NOTES_PAGE_SIZE
+_find_queries: OrderedDict = OrderedDict()
+_find_lock = threading.Lock()
+FIND_QUERIES_MAX = 1000
+# Сколько найденных заметок можно пролистать
+FIND_RESULTS_MAX = 500
+
+
+def _remember_search(user_id: int, query: str) -> tuple[str, dict]:
+    ids = [row["id"] for row in db.find_notes(user_id, query, FIND_RESULTS_MAX)]
+    token = hashlib.sha1(f"{user_id}:{query}".encode("utf-8")).hexdigest()[:10]
+    search = {"query": query, "ids": ids, "starts": [0]}
+    with _find_lock:
+        _find_queries[token] = search
+        _find_queries.move_to_end(token)
+        while len(_find_queries) > FIND_QUERIES_MAX:
+            _find_queries.popitem(last=False)
+    return token, search
+
+
+def _get_search(token: str, page_no: int) -> dict | None:
+    """Сохранённый поиск, если он ещё есть и его страница page_no уже открывалась."""
+    with _find_lock:
+        search = _find_queries.get(token)
+        if search is None or page_no >= len(search["starts"]):
+            return None
+        _find_queries.move_to_end(token)
+        return search
+
+
+def _render_page(header: str, notes: list, preview_len: int) -> tuple[str, int]:
+    """
+    Собирает текст страницы, не выходя за лимит Telegram.
+    Возвращает текст и число заметок, которые в него поместились.
+    """
+    response = header
+    shown = 0
+    for note in notes:
+        # Форматируем дату
+        created_at = datetime.fromisoformat(note['created_at']).strftime('%d.%m.%Y %H:%M')
+        # Ограничиваем длину текста для списка
+        text = note['text']
+        display_text = text[:preview_len] + "..." if len(text) > preview_len else text
+        entry = f"#{note['id']} _{created_at}_\n{display_text}\n\n"
+        if len(response) + len(entry) > TELEGRAM_MESSAGE_LIMIT - PAGE_RESERVE:
+            break
+        response += entry
+        shown += 1
+    if shown < len(notes):
+        response += "... _страница обрезана_"
+    return response, shown
+
+
+def _page_keyboard(prev_data: str | None, next_data: str | None) -> types.InlineKeyboardMarkup | None:
+    buttons = []
+    if prev_data:
+        buttons.append(types.InlineKeyboardButton("◀️ Новее", callback_data=prev_data))
+    if next_data:
+        buttons.append(types.InlineKeyboardButton("Старше ▶️", callback_data=next_data))
+    if not buttons:
+        return None
+    kb = types.InlineKeyboardMarkup()
+    kb.row(*buttons)
+    return kb
+
+
+def _split_page(rows: list, newer: bool, has_cursor: bool) -> tuple[list, bool, bool]:
+    """
+    Из "страница + 1" строк оставляет страницу и определяет, есть ли соседние.
+    Лишняя строка лежит со стороны, куда листали: в начале при листании к новым.
+    """
+    has_more = len(rows) > NOTES_PAGE_SIZE
+    if newer:
+        page = rows[1:] if has_more else rows
+        return page, has_more, True
+    return rows[:NOTES_PAGE_SIZE], has_cursor, has_more
+
+
+def _notes_list_page(user_id: int, before_id: int | None = None, after_id: int | None = None,
+                     page_no: int = 1):
+    rows = db.list_notes(user_id, NOTES_PAGE_SIZE + 1, before_id=before_id, after_id=after_id)
+    page, has_newer, has_older = _split_page(rows, after_id is not None, before_id is not None)
+    if not page:
+        return None, None
+    total = db.count_notes(user_id)
+    pages = max(1, -(-total // NOTES_PAGE_SIZE))
+    header = f"📋 **Ваши заметки** (всего {total}), страница {min(page_no, pages)} из {pages}:\n\n"
+    response, shown = _render_page(header, page, 50)
+    if shown < len(page):
+        # Не влезло в лимит сообщения — остаток уйдёт на следующую страницу
+        page, has_older = page[:shown], True
+    kb = _page_keyboard(
+        f"nl:a:{page[0]['id']}:{max(page_no - 1, 1)}" if has_newer else None,
+        f"nl:b:{page[-1]['id']}:{page_no + 1}" if has_older else None,
+    )
+    return response, kb
+
+
+def _notes_find_page(user_id: int, token: str, search: dict, page_no: int = 0):
+    with _find_lock:
+        offset = search["starts"][page_no]
+    ids = search["ids"]
+    # Удалённые с момента поиска заметки просто пропускаются
+    page = db.get_notes_by_ids(user_id, ids[offset:offset + NOTES_PAGE_SIZE])
+    if not page:
+        return None, None
+    header = f"🔍 **Найденные заметки** ({len(ids)})\nПо запросу: _{search['query']}_\n\n"
+    response, shown = _render_page(header, page, 100)
+    # Не влезло в лимит сообщения — остаток уйдёт на следующую страницу
+    next_offset = ids.index(page[shown - 1]["id"], offset) + 1 if shown else offset + NOTES_PAGE_SIZE
+    with _find_lock:
+        del search["starts"][page_no + 1:]
+        search["starts"].append(next_offset)
+    kb = _page_keyboard(
+        f"nf:{token}:{page_no - 1}" if page_no > 0 else None,
+        f"nf:{token}:{page_no + 1}" if next_offset < len(ids) else None,
+    )
+    return response, kb
+
+
 @bot.message_handler(commands=['note_list'])
 def note_list(message):
     try:
-        notes = db.list_notes(message.from_user.id)
+        response, kb = _notes_list_page(message.from_user.id)
 
-        if not notes:
+        if not response:
             bot.reply_to(message, "📭 У вас пока нет заметок.\nИспользуйте /note_add <текст> для добавления.")
             return
 
-        response = f"📋 **Ваши заметки** (последние {len(notes)}):\n\n"
-
-        for note in notes:
-            # Форматируем дату
-            created_at = datetime.fromisoformat(note['created_at']).strftime('%d.%m.%Y %H:%M')
-            # Ограничиваем длину текста для списка
-            text = note['text']
-            display_text = text[:50] + "..." if len(text) > 50 else text
-            response += f"#{note['id']} _{created_at}_\n{display_text}\n\n"
-
-        # Telegram имеет лимит на длину сообщения
-        if len(response) > 4000:
-            response = response[:3900] + "\n\n... _список обрезан_"
-
-        bot.reply_to(message, response, parse_mode='Markdown')
+        bot.reply_to(message, response, parse_mode='Markdown', reply_markup=kb)
     except Exception as e:
         bot.reply_to(message, f"❌ Ошибка при получении заметок: {str(e)}")
 
@@ -105,27 +230,48 @@ def note_find(message):
     query = parts[1].strip()
 
     try:
-        notes = db.find_notes(message.from_user.id, query)
+        # Полнотекстовый поиск: регистр не важен, слова ищутся по началу, сначала самые релевантные
+        token, search = _remember_search(message.from_user.id, query)
+        response, kb = _notes_find_page(message.from_user.id, token, search)
 
-        if not notes:
+        if not response:
             bot.reply_to(message, f"🔍 Заметки по запросу '{query}' не найдены.")
             return
 
-        response = f"🔍 **Найдено заметок:** {len(notes)}\nПо запросу: _{query}_\n\n"
-
-        for note in notes:
-            created_at = datetime.fromisoformat(note['created_at']).strftime('%d.%m.%Y %H:%M')
-            text = note['text']
-            # Подсвечиваем найденный текст
-            display_text = text[:100] + "..." if len(text) > 100 else text
-            response += f"#{note['id']} _{created_at}_\n{display_text}\n\n"
+        bot.reply_to(message, response, parse_mode='Markdown', reply_markup=kb)
+    except Exception as e:
+        bot.reply_to(message, f"❌ Ошибка при поиске: {str(e)}")
 
-        if len(response) > 4000:
-            response = response[:3900] + "\n\n... _список обрезан_"
 
-        bot.reply_to(message, response, parse_mode='Markdown')
+@bot.callback_query_handler(func=lambda call: (call.data or "").startswith(("nl:", "nf:")))
+def notes_page_callback(call):
+    """Листание страниц /note_list и /note_find по inline-кнопкам."""
+    user_id = call.from_user.id
+    parts = call.data.split(":")
+    try:
+        if parts[0] == "nl":
+            cursor, page_no = int(parts[2]), int(parts[3])
+            response, kb = _notes_list_page(
+                user_id,
+                before_id=cursor if parts[1] == "b" else None,
+                after_id=cursor if parts[1] == "a" else None,
+                page_no=page_no,
+            )
+        else:
+            token = parts[1]
+            search = _get_search(token, int(parts[2])) if len(parts) == 3 else None
+            if search is None:
+                bot.answer_callback_query(call.id, "Поиск устарел, повторите /note_find")
+                return
+            response, kb = _notes_find_page(user_id, token, search, int(parts[2]))
+        if not response:
+            bot.answer_callback_query(call.id, "Больше заметок нет")
+            return
+        bot.edit_message_text(response, call.message.chat.id, call.message.message_id,
+                              parse_mode='Markdown', reply_markup=kb)
+        bot.answer_callback_query(call.id)
     except Exception as e:
-        bot.reply_to(message, f"❌ Ошибка при поиске: {str(e)}")
+        bot.answer_callback_query(call.id, f"❌ Ошибка: {str(e)}")
 
 
 @bot.message_handler(commands=['note_show'])
@@ -222,11 +368,14 @@ if __name__ == "__main__":
     print("🤖 Бот запускается...")
     print("✅ База данных инициализирована")
     print(f"📁 Путь к БД: {os.getenv('DB_PATH', 'bot.db')}")
-    print("📡 Начинаю получение обновлений...")
-
-    while True:
-        try:
-            bot.polling(none_stop=True, interval=0, timeout=20)
-        except Exception as e:
-            print(f"❌ Ошибка: {e}")
-            time.sleep(5)
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        print("📡 Режим webhook: жду обновления от Telegram...")
+        run_webhook(bot)
+    else:
+        print("📡 Начинаю получение обновлений...")
+        while True:
+            try:
+                bot.polling(none_stop=True, interval=0, timeout=20)
+            except Exception as e:
+                print(f"❌ Ошибка: {e}")
+                time.sleep(5)
\ No newline at end of file
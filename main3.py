@@ -18,6 +18,7 @@ main.py — DailyZodiakBot (развлекательный контент без
 
 from __future__ import annotations
 import logging
+import functools
 import threading
 import time
 import hashlib
@@ -28,10 +29,14 @@ from telebot import types
 
 import db3 as db
 from config3 import TOKEN, DEFAULT_NOTIFY_HOUR
+from webhook import BOT_MODE, run_webhook
+from outbound import BULK, install as install_outbound
 
 log = logging.getLogger(__name__)
 
 bot = telebot.TeleBot(TOKEN)
+# Отправки через очередь с лимитами Telegram: ответы обгоняют рассылку
+install_outbound(bot)
 db.init_db()  # создаём схемы, если их нет
 
 # ---------- справочник знаков: канон, синонимы, эмодзи ----------
@@ -231,6 +236,12 @@ def kb_pick_sign(message: types.Message) -> None:
 
 
 # ---------- планировщик ежедневной отправки ----------
+def _log_send_failure(user_id: int, future) -> None:
+    e = future.exception()
+    if e is not None:
+        log.warning("Send failed to %s: %r", user_id, e)
+
+
 def scheduler_loop() -> None:
     log.info("Scheduler started")
     while True:
@@ -242,10 +253,9 @@ def scheduler_loop() -> None:
             for u in due:
                 # Сгенерировать текст и отправить:
                 txt = make_daily_text(u["sign"], now.date())
-                try:
-                    bot.send_message(u["user_id"], txt, parse_mode="Markdown")
-                except Exception as e:
-                    log.warning("Send failed to %s: %r", u["user_id"], e)
+                # Рассылка не ждёт отправки: очередь сама выдерживает лимиты и повторяет 429
+                future = bot.send_message(u["user_id"], txt, parse_mode="Markdown", priority=BULK, wait=False)
+                future.add_done_callback(functools.partial(_log_send_failure, u["user_id"]))
                 # Отметить отправку за сегодня:
                 db.mark_sent_today(u["user_id"], today_str)
         except Exception as e:
@@ -277,4 +287,7 @@ def setup_bot_commands() -> None:
 if __name__ == "__main__":
     setup_bot_commands()        # удобство для пользователей [oai_citation:8‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq)
     start_scheduler()           # запускаем фоновую проверку
-    bot.infinity_polling(skip_pending=True)  # запуск long polling (паттерн Л2/Л3) [oai_citation:9‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq) [oai_citation:10‡L3.pdf](file-service://file-TzQZFVK22mksuAGPBby5ME)
+    if BOT_MODE == "webhook":
+        run_webhook(bot)        # обновления приходят на встроенный HTTP-сервер
+    else:
+        bot.infinity_polling(skip_pending=True)  # запуск long polling (паттерн Л2/Л3) [oai_citation:9‡L2_Текст к лекции.pdf](file-service://file-6kQEVmhZuKhD1nBDo1XNnq) [oai_citation:10‡L3.pdf](file-service://file-TzQZFVK22mksuAGPBby5ME)
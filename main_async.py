@@ -0,0 +1,194 @@
+# main_async.py
+"""
+Асинхронный вариант бота на AsyncTeleBot.
+
+Основной путь — обычное сообщение пользователю, которое уходит в LLM, —
+полностью асинхронный:
+  * запросы к SQLite выполняются в отдельном пуле потоков БД (db_call), так что
+    event loop никогда не ждёт диск;
+  * запрос к модели идёт через ModelRouter.achat и AsyncOpenRouterClient (aiohttp):
+    та же цепочка запасных моделей, статистика, лимиты, hedging, кэш, повторы
+    и circuit breaker'ы, что и в синхронном main.py, но без потоков на ожидание;
+  * сообщения одного пользователя обрабатываются по очереди (asyncio.Lock на
+    пользователя), разных — одновременно.
+  * ответы уходят через общую очередь отправки процесса (outbound.py) с
+    лимитами Telegram.
+Пока модель думает, корутина ничего не занимает, поэтому один процесс держит
+тысячи одновременных диалогов. Редкие команды (/models, /character и т.п.)
+выполняют синхронные обработчики из main.py в пуле потоков.
+
+Запуск: python main_async.py
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, TypeVar
+
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+
+import main
+import openrouter_client
+from db import estimate_tokens, record_turn
+from metrics import metric
+from model_router import get_router
+from openrouter_async import AsyncOpenRouterClient, AsyncSingleFlight
+from openrouter_client import ChatResult
+from outbound import install_async as install_outbound
+from rate_limit import RateLimited
+from summarizer import SUMMARY_ENABLED, get_summarizer
+
+T = TypeVar("T")
+
+log = logging.getLogger(__name__)
+
+# Потоки для SQLite: запись идёт под блокировкой, но чтение в WAL параллельно
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+# Потоки для синхронных обработчиков редких команд из main.py
+SYNC_HANDLER_WORKERS = int(os.getenv("SYNC_HANDLER_WORKERS", "8"))
+
+bot = AsyncTeleBot(os.getenv('TOKEN'))
+# Отправки идут через ту же очередь с лимитами Telegram, что и у синхронных обработчиков main.py
+install_outbound(bot)
+
+_db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+_sync_executor = ThreadPoolExecutor(max_workers=SYNC_HANDLER_WORKERS, thread_name_prefix="sync-handler")
+_client: AsyncOpenRouterClient | None = None
+# Блокировка живёт, пока её держит или ждёт хотя бы один ход пользователя
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+async def db_call(fn: Callable[..., T], *args, **kwargs) -> T:
+    """Выполняет синхронную функцию БД в пуле потоков БД."""
+    t0 = time.perf_counter()
+    result = await asyncio.get_running_loop().run_in_executor(_db_executor, partial(fn, *args, **kwargs))
+    metric.latency("async_db_call_ms").observe(int((time.perf_counter() - t0) * 1000))
+    return result
+
+
+def get_async_client() -> AsyncOpenRouterClient:
+    global _client
+    if _client is None:
+        # Кэш, повторы и circuit breaker'ы — те же объекты, что у синхронного клиента main.py
+        _client = AsyncOpenRouterClient(
+            api_key=openrouter_client.OPENROUTER_API_KEY,
+            single_flight=AsyncSingleFlight() if openrouter_client.OPENROUTER_SINGLE_FLIGHT else None,
+            offload=db_call, **openrouter_client.shared_options(),
+        )
+    return _client
+
+
+def _user_lock(user_id: int) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+async def route_chat(msgs: list[dict], primary: str, temperature: float = 0.7, max_tokens: int = 1024,
+                     timeout_s: float = 30, user_id: int | None = None, router=None, client=None) -> ChatResult:
+    """ModelRouter.achat с общим роутером процесса и асинхронным клиентом."""
+    router = router or get_router()
+    return await router.achat(msgs, primary, client or get_async_client(), temperature=temperature,
+                              max_tokens=max_tokens, timeout_s=timeout_s, user_id=user_id, offload=db_call)
+
+
+async def _reply_rate_limited(message: types.Message, e: RateLimited) -> None:
+    metric.counter("rate_limited_replies_total").inc()
+    await bot.reply_to(message, f"⏳ Слишком много запросов. Попробуйте через {math.ceil(e.retry_after)} с.")
+
+
+# --- Редкие команды: синхронные обработчики main.py в пуле потоков ---
+
+_SYNC_COMMANDS = {
+    "start": main.start_help, "help": main.start_help,
+    "clear": main.cmd_clear,
+    "ask_web": main.cmd_ask_web,
+    "summarize_and_save": main.cmd_summarize_and_save,
+    "models": main.cmd_models, "model": main.cmd_model,
+    "characters": main.cmd_characters, "character": main.cmd_character,
+    "whoami": main.cmd_whoami,
+    "set_setting": main.cmd_set_setting, "set_toggle": main.cmd_set_toggle,
+    "debug_settings": main.cmd_debug_settings,
+}
+
+
+@bot.message_handler(commands=list(_SYNC_COMMANDS))
+async def on_sync_command(message: types.Message) -> None:
+    command = message.text.split()[0].lstrip("/").split("@")[0]
+    handler = _SYNC_COMMANDS[command]
+    async with _user_lock(message.from_user.id):
+        await asyncio.get_running_loop().run_in_executor(_sync_executor, handler, message)
+
+
+@bot.message_handler(func=lambda m: m.text == "Погода (Москва)")
+async def kb_weather_moscow(message: types.Message) -> None:
+    await asyncio.get_running_loop().run_in_executor(_sync_executor, main.kb_weather_moscow, message)
+
+
+# --- Основной путь: сообщение -> LLM ---
+
+@bot.message_handler(func=lambda message: True)
+async def on_text_message(message: types.Message) -> None:
+    """Асинхронный аналог main.on_text_message (без потоковых ответов)."""
+    user_id = message.from_user.id
+    q = (message.text or "").strip()
+    if not q or q.startswith('/'):
+        return
+
+    async with _user_lock(user_id):
+        try:
+            ctx = await db_call(main._load_turn_context, user_id)
+            if not ctx.ask_enabled:
+                return
+            q = q[:ctx.max_prompt_chars]
+            msgs = main._messages_from_context(ctx, q)
+            await bot.send_chat_action(message.chat.id, 'typing')
+            # Потоковые ответы есть только в синхронном main.py; здесь ответ приходит целиком
+            result = await route_chat(msgs, primary=ctx.model["key"], temperature=ctx.temperature,
+                                      max_tokens=ctx.reply_max_tokens, timeout_s=ctx.api_timeout,
+                                      user_id=user_id)
+            await db_call(record_turn, user_id, q, result.text, {
+                "model_key": result.model,
+                "latency_ms": result.ms,
+                "prompt_tokens": result.prompt_tokens,
+                "completion_tokens": result.completion_tokens,
+            })
+            add_info = (f"\n\n({result.ms} мс; модель: {result.model}; как: {ctx.character['name']})"
+                        if ctx.show_footer else "")
+            await bot.reply_to(message, f"{result.text}{add_info}", parse_mode="Markdown")
+        except RateLimited as e:
+            await _reply_rate_limited(message, e)
+            return
+        except Exception as e:
+            log.error(f"Ошибка в on_text_message (async): {e}", exc_info=True)
+            await bot.reply_to(message, f"Произошла ошибка: {e}")
+            return
+
+    if SUMMARY_ENABLED:
+        history_tokens = sum(h["tokens"] for h in ctx.history) + estimate_tokens(q) + estimate_tokens(result.text)
+        get_summarizer().maybe_schedule(user_id, result.model, history_tokens)
+
+
+async def run() -> None:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_db_executor, main.startup)
+    try:
+        log.info("Запуск асинхронного long polling...")
+        await bot.infinity_polling(skip_pending=True)
+    finally:
+        if _client is not None:
+            await _client.aclose()
+        await bot.close_session()
+        await loop.run_in_executor(_db_executor, main.shutdown)
+        _sync_executor.shutdown(wait=False)
+        _db_executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(run())
@@ -19,6 +19,23 @@ class Counter:
     def get(self) -> int:
         return self.value
 
+class Gauge:
+    """Текущее значение (глубина очереди, число активных задач)."""
+    def __init__(self, name: str):
+        self.name = name
+        self.value = 0
+        self._lock = threading.Lock()
+    def set(self, value: int) -> None:
+        self.value = value
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+    def dec(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value -= amount
+    def get(self) -> int:
+        return self.value
+
 @dataclass
 class LatencyStats:
     """Статистика по задержке в миллисекундах."""
@@ -48,6 +65,7 @@ class MetricsRegistry:
         self._lock = threading.Lock()
         self._counters: Dict[str, Counter] = {}
         self._latencies: Dict[str, LatencyStats] = {}
+        self._gauges: Dict[str, Gauge] = {}
 
     def counter(self, name: str) -> Counter:
         with self._lock:
@@ -61,6 +79,19 @@ class MetricsRegistry:
                 self._latencies[name] = LatencyStats()
             return self._latencies[name]
 
+    def gauge(self, name: str) -> Gauge:
+        with self._lock:
+            if name not in self._gauges:
+                self._gauges[name] = Gauge(name)
+            return self._gauges[name]
+
+    def hit_rate(self, prefix: str) -> float:
+        """Доля попаданий для пары счётчиков {prefix}_hits_total / {prefix}_misses_total."""
+        hits = self.counter(f"{prefix}_hits_total").get()
+        misses = self.counter(f"{prefix}_misses_total").get()
+        total = hits + misses
+        return hits / total if total else 0.0
+
     # ПРАВИЛЬНЫЙ ВАРИАНТ
     def snapshot(self) -> Dict[str, Any]:
         with self._lock:
@@ -77,11 +108,38 @@ class MetricsRegistry:
                     "avg_ms": latency_stat.avg_ms  # <--- Теперь мы его добавляем
                 }
 
-            return {"counters": counters_snap, "latencies": latencies_snap}
+            gauges_snap = {name: g.get() for name, g in self._gauges.items()}
+
+            return {"counters": counters_snap, "latencies": latencies_snap, "gauges": gauges_snap}
 
 # Глобальный реестр метрик
 metric = MetricsRegistry()
 
+def merge_snapshots(snapshots: list[Dict[str, Any]]) -> Dict[str, Any]:
+    """Сводит снимки нескольких процессов: счётчики и gauge суммируются, задержки объединяются."""
+    counters: Dict[str, int] = {}
+    gauges: Dict[str, int] = {}
+    latencies: Dict[str, Dict[str, Any]] = {}
+    for snap in snapshots:
+        for name, value in snap.get("counters", {}).items():
+            counters[name] = counters.get(name, 0) + value
+        for name, value in snap.get("gauges", {}).items():
+            gauges[name] = gauges.get(name, 0) + value
+        for name, lat in snap.get("latencies", {}).items():
+            if not lat["count"]:
+                continue
+            acc = latencies.get(name)
+            if acc is None:
+                latencies[name] = dict(lat)
+                continue
+            acc["min_ms"] = min(acc["min_ms"], lat["min_ms"])
+            acc["max_ms"] = max(acc["max_ms"], lat["max_ms"])
+            acc["count"] += lat["count"]
+            acc["total_ms"] += lat["total_ms"]
+    for acc in latencies.values():
+        acc["avg_ms"] = acc["total_ms"] / acc["count"]
+    return {"counters": counters, "latencies": latencies, "gauges": gauges}
+
 def timed(metric_name: str, logger: logging.Logger | None = None) -> Callable[[Callable[..., T]], Callable[..., T]]:
     """Декоратор для замера времени выполнения функции."""
     def decorator(func: Callable[..., T]) -> Callable[..., T]:
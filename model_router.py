@@ -0,0 +1,400 @@
+# model_router.py
+"""
+Маршрутизация запросов к LLM между моделями.
+
+По каждой модели хранится скользящее окно последних вызовов (задержка, успех).
+Цепочка моделей — активная модель из /model, затем настройка model_fallback_chain
+(ключи через запятую), а если её нет — остальные модели реестра. Роутер:
+  * пропускает модели с разомкнутым circuit breaker;
+  * ставит первой самую "здоровую" модель, если активная заметно хуже
+    (ожидаемое время успешного ответа в ROUTER_SWITCH_FACTOR раз больше);
+  * при 429/5xx/сетевой ошибке переходит к следующей модели цепочки;
+  * перед отправкой берёт токены лимитера пользователя и модели (rate_limit.py);
+  * по желанию (ROUTER_HEDGE=1) шлёт дублирующий запрос второй модели, если
+    первая не ответила за свой p95, и берёт ответ, пришедший раньше.
+chat() — для потоков, achat() — для asyncio (main_async.py); решения о порядке
+моделей, переходах и возврате квоты у них общие (_Route).
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Awaitable, Callable, NoReturn
+
+import db
+import openrouter_client
+from metrics import metric
+from rate_limit import RateLimited, RateLimiter, get_limiter
+from openrouter_client import ChatResult, ModelUnavailableError, OpenRouterError, is_transient
+
+log = logging.getLogger(__name__)
+
+# Сколько последних вызовов модели учитывать
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "50"))
+# Меньше этого числа замеров статистика модели считается неизвестной
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+# Во сколько раз активная модель должна быть хуже лучшей, чтобы её обойти
+ROUTER_SWITCH_FACTOR = float(os.getenv("ROUTER_SWITCH_FACTOR", "2.0"))
+# Hedged-запросы ко второй модели цепочки
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "0") == "1"
+ROUTER_HEDGE_MIN_DELAY_MS = int(os.getenv("ROUTER_HEDGE_MIN_DELAY_MS", "500"))
+ROUTER_HEDGE_WORKERS = int(os.getenv("ROUTER_HEDGE_WORKERS", "16"))
+
+
+class ModelStats:
+    """Скользящее окно вызовов одной модели."""
+
+    def __init__(self, window: int = ROUTER_WINDOW):
+        self._samples: deque = deque(maxlen=window)  # (ok, ms)
+        self._lock = threading.Lock()
+
+    def record(self, ok: bool, ms: int) -> None:
+        with self._lock:
+            self._samples.append((ok, ms))
+
+    def snapshot(self) -> dict:
+        """count, error_rate и перцентили задержки успешных вызовов (None, если их нет)."""
+        with self._lock:
+            samples = list(self._samples)
+        latencies = sorted(ms for ok, ms in samples if ok)
+        errors = sum(1 for ok, _ in samples if not ok)
+
+        def pct(p: float) -> int | None:
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)] if latencies else None
+
+        return {
+            "count": len(samples),
+            "error_rate": errors / len(samples) if samples else 0.0,
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+        }
+
+
+def expected_ms(snap: dict, min_samples: int = ROUTER_MIN_SAMPLES) -> float | None:
+    """Ожидаемое время до успешного ответа: p50 / доля успехов (None — мало данных)."""
+    if snap["count"] < min_samples:
+        return None
+    success = 1.0 - snap["error_rate"]
+    if success <= 0:
+        return float("inf")
+    return (snap["p50_ms"] or 0) / success
+
+
+def _falls_back(e: Exception) -> bool:
+    """Ошибка модели (лимит, 429/5xx, сеть, разомкнутая цепь), после которой пробуем следующую."""
+    return isinstance(e, (RateLimited, ModelUnavailableError)) or is_transient(e)
+
+
+class _Route:
+    """Проход одного запроса по цепочке моделей: общий для chat() и achat()."""
+
+    def __init__(self, router: "ModelRouter", order: list[str], user_id: int | None):
+        self.router = router
+        self.order = order
+        self.user_id = user_id
+        self.last_error: OpenRouterError | RateLimited | None = None
+        self._i = 0
+        self._step = 1
+
+    def next(self) -> tuple[str, str | None, int | None] | None:
+        """Следующая попытка: (модель, запасная для hedged-запроса, задержка подстраховки) или None."""
+        if self._i >= len(self.order):
+            return None
+        model = self.order[self._i]
+        backup = self.order[self._i + 1] if self.router.hedge and self._i + 1 < len(self.order) else None
+        delay_ms = self.router._hedge_delay_ms(model) if backup else None
+        # После hedged-пары обе модели уже опробованы
+        self._step = 2 if delay_ms is not None else 1
+        return model, backup, delay_ms
+
+    def failed(self, e: OpenRouterError | RateLimited) -> None:
+        """Запоминает ошибку и переходит дальше; ошибки самого запроса пробрасывает."""
+        if not _falls_back(e):
+            raise e
+        self.last_error = e
+        model = self.order[self._i]
+        self._i += self._step
+        if self._i < len(self.order):
+            metric.counter("router_fallbacks_total").inc()
+            log.warning(f"Роутер: {model} не ответила ({e}), пробуем {self.order[self._i]}")
+
+    def give_up(self) -> NoReturn:
+        limiter = self.router.limiter
+        if isinstance(self.last_error, RateLimited) and self.user_id is not None and limiter is not None:
+            # В API так ничего и не ушло — квота пользователя не должна сгорать
+            limiter.refund_user(self.user_id)
+        raise self.last_error
+
+
+class ModelRouter:
+    """Выбор модели, переход по цепочке при сбоях и hedged-запросы."""
+
+    def __init__(self, chat_fn: Callable[..., ChatResult] | None = None, breakers=None,
+                 window: int = ROUTER_WINDOW, hedge: bool = ROUTER_HEDGE,
+                 hedge_min_delay_ms: int = ROUTER_HEDGE_MIN_DELAY_MS, limiter: RateLimiter | None = None):
+        self._chat_fn = chat_fn
+        self._breakers = breakers
+        self.limiter = limiter
+        self.window = window
+        self.hedge = hedge
+        self.hedge_min_delay_ms = hedge_min_delay_ms
+        self._stats: dict[str, ModelStats] = {}
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+
+    # --- Статистика ---
+
+    def stats(self, model: str) -> ModelStats:
+        with self._lock:
+            st = self._stats.get(model)
+            if st is None:
+                st = self._stats[model] = ModelStats(self.window)
+            return st
+
+    def observe(self, model: str, ok: bool, ms: int) -> None:
+        self.stats(model).record(ok, ms)
+
+    def snapshot(self) -> dict[str, dict]:
+        with self._lock:
+            models = list(self._stats)
+        return {m: self.stats(m).snapshot() for m in models}
+
+    # --- Выбор модели ---
+
+    def chain(self, primary: str) -> list[str]:
+        """Активная модель и запасные из настройки model_fallback_chain (или весь реестр)."""
+        raw = db.get_setting_or_default("model_fallback_chain", "")
+        fallbacks = [k.strip() for k in raw.split(",") if k.strip()] or [m["key"] for m in db.list_models()]
+        return list(dict.fromkeys([primary, *fallbacks]))
+
+    def _available(self, model: str) -> bool:
+        breakers = self._breakers if self._breakers is not None else openrouter_client.get_breakers()
+        return breakers is None or breakers.get(model).allows_call()
+
+    def order(self, chain: list[str]) -> list[str]:
+        """Порядок попыток: доступные модели, самая здоровая первой, если активная заметно хуже."""
+        candidates = [m for m in chain if self._available(m)] or list(chain)
+        primary = candidates[0]
+        scores = {m: expected_ms(self.stats(m).snapshot()) for m in candidates}
+        known = [m for m in candidates if scores[m] is not None]
+        if known:
+            best = min(known, key=lambda m: scores[m])
+            if best != primary and scores[primary] is not None \
+                    and scores[primary] > scores[best] * ROUTER_SWITCH_FACTOR:
+                metric.counter("router_switches_total").inc()
+                log.info(f"Роутер: {primary} деградировала, первой идёт {best}")
+                candidates.remove(best)
+                candidates.insert(0, best)
+        return candidates
+
+    def pick(self, primary: str) -> str:
+        """Модель для одиночного (например, потокового) запроса."""
+        return self.order(self.chain(primary))[0]
+
+    # --- Вызовы ---
+
+    def admit(self, model: str, user_id: int | None, deadline: float | None = None) -> None:
+        """Токен лимитера модели (и пользователя, если deadline не задан) или RateLimited."""
+        if self.limiter is None:
+            return
+        user_token = False
+        if deadline is None:
+            deadline = self.limiter.deadline()
+            if user_id is not None:
+                self.limiter.acquire_user(user_id, deadline)
+                user_token = True
+        try:
+            self.limiter.acquire_model(model, user_id, deadline)
+        except RateLimited:
+            # Запрос не уйдёт в API — квота пользователя не должна сгорать
+            if user_token:
+                self.limiter.refund_user(user_id)
+            raise
+
+    def _observe_failure(self, model: str, e: OpenRouterError, t0: float) -> None:
+        if is_transient(e):
+            self.observe(model, False, int((time.perf_counter() - t0) * 1000))
+
+    def _observe_success(self, model: str, result: ChatResult) -> None:
+        # Ответ из кэша (ms=0) ничего не говорит о скорости модели
+        if result.ms > 0:
+            self.observe(model, True, result.ms)
+
+    def _call(self, model: str, msgs: list[dict], user_id: int | None = None, deadline: float | None = None,
+              **kwargs) -> ChatResult:
+        if self.limiter is not None:
+            self.limiter.acquire_model(model, user_id, deadline or self.limiter.deadline())
+        chat_fn = self._chat_fn or openrouter_client.chat
+        t0 = time.perf_counter()
+        try:
+            result = chat_fn(msgs, model=model, **kwargs)
+        except OpenRouterError as e:
+            self._observe_failure(model, e, t0)
+            raise
+        self._observe_success(model, result)
+        return result
+
+    def chat(self, msgs: list[dict], primary: str, temperature: float = 0.7, max_tokens: int = 1024,
+             timeout_s: float = 30, user_id: int | None = None) -> ChatResult:
+        """
+        Отправляет запрос по цепочке моделей; result.model — модель, которая ответила.
+        Ошибки запроса (4xx, кроме 408/429) не приводят к смене модели. Если у роутера
+        есть лимитер, запрос сначала получает токен пользователя, а затем — токен
+        модели; модель, квота которой не успевает освободиться, пропускается.
+        """
+        kwargs = {"temperature": temperature, "max_tokens": max_tokens, "timeout_s": timeout_s}
+        deadline = self.limiter.deadline() if self.limiter is not None else None
+        if self.limiter is not None and user_id is not None:
+            self.limiter.acquire_user(user_id, deadline)
+        route = _Route(self, self.order(self.chain(primary)), user_id)
+        while (step := route.next()) is not None:
+            model, backup, delay_ms = step
+            try:
+                if delay_ms is not None:
+                    return self._hedged(model, backup, delay_ms, msgs, user_id, deadline, kwargs)
+                return self._call(model, msgs, user_id, deadline, **kwargs)
+            except (OpenRouterError, RateLimited) as e:
+                route.failed(e)
+        route.give_up()
+
+    def _hedge_delay_ms(self, model: str) -> int | None:
+        snap = self.stats(model).snapshot()
+        if snap["count"] < ROUTER_MIN_SAMPLES or snap["p95_ms"] is None:
+            return None
+        return max(snap["p95_ms"], self.hedge_min_delay_ms)
+
+    def _hedged(self, first: str, second: str, delay_ms: int, msgs: list[dict],
+                user_id: int | None, deadline: float | None, kwargs: dict) -> ChatResult:
+        """Запрос к first; если за delay_ms ответа нет — ещё и к second. Побеждает первый успешный."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=ROUTER_HEDGE_WORKERS,
+                                                    thread_name_prefix="router-hedge")
+            executor = self._executor
+        head = executor.submit(self._call, first, msgs, user_id, deadline, **kwargs)
+        done, _ = wait([head], timeout=delay_ms / 1000)
+        if done:
+            try:
+                return head.result()
+            except (OpenRouterError, RateLimited) as e:
+                self._hedge_fallback(first, second, e)
+                return self._call(second, msgs, user_id, deadline, **kwargs)
+        metric.counter("router_hedges_total").inc()
+        futures: dict[Future, str] = {
+            head: first,
+            executor.submit(self._call, second, msgs, user_id, deadline, **kwargs): second,
+        }
+        pending = set(futures)
+        error: OpenRouterError | RateLimited | None = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                try:
+                    result = f.result()
+                except (OpenRouterError, RateLimited) as e:
+                    error = e
+                    continue
+                if futures[f] == second:
+                    metric.counter("router_hedge_wins_total").inc()
+                # Проигравший запрос дорабатывает в фоне: HTTP-вызов не прервать
+                return result
+        raise error
+
+    @staticmethod
+    def _hedge_fallback(first: str, second: str, e: OpenRouterError | RateLimited) -> None:
+        """Первая модель упала до срока подстраховки — вторую вызываем сразу (или пробрасываем ошибку запроса)."""
+        if not _falls_back(e):
+            raise e
+        metric.counter("router_fallbacks_total").inc()
+        log.warning(f"Роутер: {first} не ответила ({e}), пробуем {second}")
+
+    # --- Вызовы из asyncio ---
+
+    async def _acall(self, client, model: str, msgs: list[dict], user_id: int | None, deadline: float | None,
+                     kwargs: dict) -> ChatResult:
+        if self.limiter is not None:
+            await self.limiter.acquire_model_async(model, user_id, deadline or self.limiter.deadline())
+        t0 = time.perf_counter()
+        try:
+            result = await client.chat(msgs, model, **kwargs)
+        except OpenRouterError as e:
+            self._observe_failure(model, e, t0)
+            raise
+        self._observe_success(model, result)
+        return result
+
+    async def achat(self, msgs: list[dict], primary: str, client, temperature: float = 0.7,
+                    max_tokens: int = 1024, timeout_s: float = 30, user_id: int | None = None,
+                    offload: Callable[..., Awaitable] | None = None) -> ChatResult:
+        """
+        Как chat(), но для asyncio: client — AsyncOpenRouterClient (или совместимый),
+        лимиты ждутся в event loop. offload выполняет чтение настроек цепочки из БД
+        (например, db_call из main_async); без него chain() вызывается прямо в loop.
+        """
+        kwargs = {"temperature": temperature, "max_tokens": max_tokens, "timeout_s": timeout_s}
+        deadline = self.limiter.deadline() if self.limiter is not None else None
+        if self.limiter is not None and user_id is not None:
+            await self.limiter.acquire_user_async(user_id, deadline)
+        chain = await offload(self.chain, primary) if offload is not None else self.chain(primary)
+        route = _Route(self, self.order(chain), user_id)
+        while (step := route.next()) is not None:
+            model, backup, delay_ms = step
+            try:
+                if delay_ms is not None:
+                    return await self._ahedged(client, model, backup, delay_ms, msgs, user_id, deadline, kwargs)
+                return await self._acall(client, model, msgs, user_id, deadline, kwargs)
+            except (OpenRouterError, RateLimited) as e:
+                route.failed(e)
+        route.give_up()
+
+    async def _ahedged(self, client, first: str, second: str, delay_ms: int, msgs: list[dict],
+                       user_id: int | None, deadline: float | None, kwargs: dict) -> ChatResult:
+        """Как _hedged(), но на задачах asyncio: проигравший запрос отменяется."""
+        head = asyncio.ensure_future(self._acall(client, first, msgs, user_id, deadline, kwargs))
+        tasks: dict[asyncio.Future, str] = {head: first}
+        try:
+            done, _ = await asyncio.wait([head], timeout=delay_ms / 1000)
+            if done:
+                try:
+                    return head.result()
+                except (OpenRouterError, RateLimited) as e:
+                    self._hedge_fallback(first, second, e)
+                    return await self._acall(client, second, msgs, user_id, deadline, kwargs)
+            metric.counter("router_hedges_total").inc()
+            tasks[asyncio.ensure_future(self._acall(client, second, msgs, user_id, deadline, kwargs))] = second
+            pending = set(tasks)
+            error: OpenRouterError | RateLimited | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    try:
+                        result = t.result()
+                    except (OpenRouterError, RateLimited) as e:
+                        error = e
+                        continue
+                    if tasks[t] == second:
+                        metric.counter("router_hedge_wins_total").inc()
+                    return result
+            raise error
+        finally:
+            for t in tasks:
+                if not t.done():
+                    t.cancel()
+                elif not t.cancelled():
+                    t.exception()  # ошибка проигравшего уже не нужна
+
+
+_router: ModelRouter | None = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    """Общий роутер процесса."""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter(limiter=get_limiter())
+        return _router
@@ -0,0 +1,210 @@
+# openrouter_async.py
+"""
+Асинхронный клиент OpenRouter поверх aiohttp.
+
+Один поток с event loop обслуживает сотни одновременных запросов к LLM:
+ожидание ответа модели не занимает поток-обработчик. Ошибки те же, что и
+в openrouter_client (OpenRouterError с "дружелюбным" текстом и retry_after);
+кэш ответов, склейка одинаковых запросов, повторы и circuit breaker'ы работают
+так же, как у синхронного клиента, и могут быть с ним общими (shared_options()).
+"""
+import asyncio
+import copy
+import json
+import logging
+import os
+import time
+from dataclasses import asdict
+from typing import Awaitable, Callable
+
+try:
+    import aiohttp
+except ImportError:  # aiohttp нужен только асинхронному клиенту
+    aiohttp = None
+
+from llm_cache import LLMCache, make_key
+from metrics import metric
+from openrouter_client import (
+    OPENROUTER_API_URL, OPENROUTER_CONNECT_TIMEOUT, OPENROUTER_READ_TIMEOUT,
+    ChatResult, ModelUnavailableError, OpenRouterError, _get_friendly_error, _result_from_json, build_payload,
+    is_transient,
+)
+from resilience import CircuitBreakers, CircuitOpenError, RetryPolicy, parse_retry_after
+
+log = logging.getLogger(__name__)
+
+# Лимит одновременных соединений: в отличие от потоков, их можно держать сотнями
+OPENROUTER_ASYNC_POOL_SIZE = int(os.getenv("OPENROUTER_ASYNC_POOL_SIZE", "100"))
+# Сколько секунд держать простаивающее соединение открытым
+OPENROUTER_KEEPALIVE_S = float(os.getenv("OPENROUTER_KEEPALIVE_S", "30"))
+
+
+class AsyncSingleFlight:
+    """SingleFlight для одного event loop: одинаковые одновременные запросы ждут ответ ведущей корутины."""
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[ChatResult]], timeout_s: float) -> ChatResult:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = asyncio.get_running_loop().create_future()
+            try:
+                result = await fn()
+            except BaseException as e:
+                # Ожидающим — OpenRouterError, даже если ведущего отменили
+                call.set_exception(e if isinstance(e, OpenRouterError) else
+                                   OpenRouterError(f"Ошибка запроса к OpenRouter: {e!r}"))
+                # Если ожидающих нет, исключение будущего никто не заберёт — это не ошибка
+                call.exception()
+                raise
+            else:
+                call.set_result(result)
+                return result
+            finally:
+                del self._calls[key]
+
+        metric.counter("llm_singleflight_shared_total").inc()
+        try:
+            # shield: отмена ожидающего не отменяет запрос ведущего
+            return await asyncio.wait_for(asyncio.shield(call), timeout_s)
+        except asyncio.TimeoutError:
+            metric.counter("llm_singleflight_timeouts_total").inc()
+            raise OpenRouterError(f"Не удалось подключиться к OpenRouter: нет ответа за {timeout_s:g} с")
+        except OpenRouterError as e:
+            # Своя копия у каждого ожидающего, как в SingleFlight
+            raise copy.copy(e) from e
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class AsyncOpenRouterClient:
+    """
+    Клиент OpenRouter для asyncio. Сессия aiohttp (пул соединений, общие заголовки)
+    создаётся лениво в том event loop, где клиент используется впервые.
+    Блокирующие обращения к кэшу (второй уровень в SQLite) выполняет offload,
+    например db_call из main_async; без него кэш читается прямо в event loop.
+    """
+
+    def __init__(self, api_key: str | None = None, url: str = OPENROUTER_API_URL,
+                 pool_size: int = OPENROUTER_ASYNC_POOL_SIZE,
+                 connect_timeout: float = OPENROUTER_CONNECT_TIMEOUT,
+                 read_timeout: float = OPENROUTER_READ_TIMEOUT,
+                 cache: LLMCache | None = None, single_flight: AsyncSingleFlight | None = None,
+                 retry: RetryPolicy | None = None, breakers: CircuitBreakers | None = None,
+                 offload: Callable[..., Awaitable] | None = None):
+        if aiohttp is None:
+            raise RuntimeError("Для асинхронного клиента нужен пакет aiohttp (pip install aiohttp).")
+        self.api_key = api_key
+        self.url = url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.cache = cache
+        self.single_flight = single_flight
+        self.retry = retry
+        self.breakers = breakers
+        self._offload = offload
+        self._session: "aiohttp.ClientSession | None" = None
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=OPENROUTER_KEEPALIVE_S)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                },
+                timeout=aiohttp.ClientTimeout(sock_connect=self.connect_timeout),
+            )
+        return self._session
+
+    async def _blocking(self, fn, *args):
+        return await self._offload(fn, *args) if self._offload is not None else fn(*args)
+
+    async def chat(self, msgs: list[dict], model: str, temperature: float = 0.7, max_tokens: int = 1024,
+                   timeout_s: float | None = None) -> ChatResult:
+        """Отправляет запрос к модели и возвращает ChatResult (кэш и склейка — как в OpenRouterClient.chat)."""
+        key = None
+        use_cache = self.cache is not None and self.cache.cacheable(temperature)
+        if use_cache or self.single_flight is not None:
+            key = make_key(model, msgs, temperature, max_tokens)
+        if use_cache:
+            cached = await self._blocking(self.cache.get, key)
+            if cached is not None:
+                log.debug(f"Ответ для model={model} взят из кэша")
+                return ChatResult(**{**cached, "ms": 0})
+
+        async def call() -> ChatResult:
+            log.debug(f"Async-запрос к OpenRouter: model={model}, temp={temperature}, max_tokens={max_tokens}")
+            result = await self._send_guarded(build_payload(msgs, model, temperature, max_tokens), model, timeout_s)
+            if use_cache:
+                await self._blocking(self.cache.put, key, asdict(result))
+            return result
+
+        if self.single_flight is None:
+            return await call()
+        wait_s = self.connect_timeout + (timeout_s if timeout_s is not None else self.read_timeout)
+        if self.retry is not None:
+            wait_s = wait_s * self.retry.max_attempts + self.retry.budget_s
+        return await self.single_flight.do(key, call, wait_s)
+
+    async def _send_guarded(self, body: bytes, model: str, timeout_s: float | None = None) -> ChatResult:
+        """send() с повторами временных ошибок и circuit breaker модели (если они заданы)."""
+        async def attempt() -> ChatResult:
+            if self.breakers is None:
+                return await self.send(body, model, timeout_s=timeout_s)
+            try:
+                # guard сообщает автомату исход на любом выходе, включая отмену задачи
+                with self.breakers.get(model).guard(is_failure=is_transient):
+                    return await self.send(body, model, timeout_s=timeout_s)
+            except CircuitOpenError as e:
+                raise ModelUnavailableError(f"Модель {model} временно недоступна. Попробуйте позже.",
+                                            status_code=503, retry_after=e.retry_after) from e
+
+        if self.retry is None:
+            return await attempt()
+        return await self.retry.arun(attempt, is_transient, lambda e: e.retry_after, name=f"OpenRouter {model}")
+
+    async def send(self, body: bytes, model: str, timeout_s: float | None = None) -> ChatResult:
+        """
+        Отправляет заранее сериализованное тело запроса. По истечении timeout_s
+        запрос отменяется (соединение возвращается в пул или закрывается).
+        """
+        if not self.api_key:
+            msg = "Отсутствует ключ OPENROUTER_API_KEY в .env файле."
+            log.error(msg)
+            raise OpenRouterError(msg, status_code=401)
+
+        timeout = timeout_s if timeout_s is not None else self.read_timeout
+        t0 = time.perf_counter()
+        try:
+            return await asyncio.wait_for(self._post(body, model, t0), timeout)
+        except asyncio.TimeoutError:
+            log.error(f"OpenRouter не ответил за {timeout} с, запрос отменён")
+            raise OpenRouterError(f"Не удалось подключиться к OpenRouter: нет ответа за {timeout} с")
+        except aiohttp.ClientError as e:
+            log.error(f"Сетевая ошибка при обращении к OpenRouter: {e}")
+            raise OpenRouterError(f"Не удалось подключиться к OpenRouter: {e}")
+        except (KeyError, IndexError, json.JSONDecodeError, aiohttp.ContentTypeError) as e:
+            log.error(f"Неожиданная структура ответа от OpenRouter: {e}")
+            raise OpenRouterError("Получен некорректный ответ от API.")
+
+    async def _post(self, body: bytes, model: str, t0: float) -> ChatResult:
+        async with self._get_session().post(self.url, data=body) as r:
+            if r.status != 200:
+                error_msg = _get_friendly_error(r.status)
+                log.error(f"Ошибка от OpenRouter API (статус {r.status}): {await r.text()}")
+                raise OpenRouterError(error_msg, status_code=r.status,
+                                      retry_after=parse_retry_after(r.headers.get("Retry-After")))
+            data = json.loads(await r.read())
+        return _result_from_json(data, model, int((time.perf_counter() - t0) * 1000))
+
+    async def aclose(self) -> None:
+        """Закрывает сессию и все соединения пула."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
@@ -1,10 +1,19 @@
 # openrouter_client.py
+import copy
 import os
 import requests
 import logging
 import json
+import threading
 import time
+from dataclasses import asdict, dataclass
+from typing import Iterator
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+from llm_cache import LLMCache, default_cache, make_key
+from metrics import metric
+from resilience import CircuitBreakers, CircuitOpenError, RetryPolicy, parse_retry_after
 
 # Загружаем переменные окружения (включая OPENROUTER_API_KEY)
 load_dotenv()
@@ -20,9 +29,33 @@ OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
 # --- Класс для ошибок API ---
 class OpenRouterError(Exception):
-    def __init__(self, message, status_code=None):
+    def __init__(self, message, status_code=None, retry_after=None):
         super().__init__(message)
         self.status_code = status_code
+        # Сколько секунд просит подождать сервер (заголовок Retry-After), если просит
+        self.retry_after = retry_after
+
+
+class ModelUnavailableError(OpenRouterError):
+    """Запрос к модели не отправлялся: её circuit breaker разомкнут после серии сбоев."""
+
+
+def is_transient(e: Exception) -> bool:
+    """Временная ошибка, которую имеет смысл повторить: сеть, таймаут, 429, 5xx."""
+    if not isinstance(e, OpenRouterError) or isinstance(e, ModelUnavailableError):
+        return False
+    return e.status_code is None or e.status_code in (408, 429) or e.status_code >= 500
+
+
+# --- Результат запроса ---
+@dataclass(frozen=True)
+class ChatResult:
+    """Ответ модели вместе с задержкой и расходом токенов (если API его вернул)."""
+    text: str
+    ms: int
+    model: str
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
 
 
 # --- Функция для "дружелюбного" описания ошибок ---
@@ -40,46 +73,368 @@ def _get_friendly_error(status_code: int) -> str:
     return error_map.get(status_code, f"Неизвестная ошибка API (код: {status_code}).")
 
 
+def _result_from_json(data: dict, model: str, dt_ms: int) -> ChatResult:
+    """Разбирает JSON ответа chat/completions (KeyError/IndexError при чужой структуре)."""
+    text = data["choices"][0]["message"]["content"]
+    usage = data.get("usage") or {}
+    return ChatResult(
+        text=text.strip(),
+        ms=dt_ms,
+        model=model,
+        prompt_tokens=usage.get("prompt_tokens"),
+        completion_tokens=usage.get("completion_tokens"),
+    )
+
+
 # --- Основная функция ---
 def chat_once(msgs: list[dict], model: str, temperature: float = 0.7, max_tokens: int = 1024, timeout_s: int = 30) -> \
 tuple[str, int]:
     """Отправляет один запрос к OpenRouter и возвращает ответ."""
-    if not OPENROUTER_API_KEY:
-        msg = "Отсутствует ключ OPENROUTER_API_KEY в .env файле."
-        log.error(msg)
-        raise OpenRouterError(msg, status_code=401)
-
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    result = chat(msgs, model, temperature=temperature, max_tokens=max_tokens, timeout_s=timeout_s)
+    return result.text, result.ms
+
+
+def chat(msgs: list[dict], model: str, temperature: float = 0.7, max_tokens: int = 1024,
+         timeout_s: int = 30) -> ChatResult:
+    """Как chat_once, но возвращает ChatResult с расходом токенов."""
+    return get_client().chat(msgs, model, temperature=temperature, max_tokens=max_tokens, timeout_s=timeout_s)
+
+
+# --- Клиент с постоянной HTTP-сессией ---
+# Размер пула соединений: примерно равен числу одновременно работающих обработчиков
+OPENROUTER_POOL_SIZE = int(os.getenv("OPENROUTER_POOL_SIZE", "8"))
+# Таймаут установки соединения (с); таймаут чтения задаётся per-call через timeout_s
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5"))
+OPENROUTER_READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", "30"))
+# Одинаковые одновременные запросы отправлять в API один раз
+OPENROUTER_SINGLE_FLIGHT = os.getenv("OPENROUTER_SINGLE_FLIGHT", "1") == "1"
+
+
+def build_payload(msgs: list[dict], model: str, temperature: float = 0.7, max_tokens: int = 1024,
+                  stream: bool = False) -> bytes:
+    """Сериализует тело запроса один раз — его можно переиспользовать в повторах."""
     payload = {
         "model": model,
         "messages": msgs,
         "temperature": temperature,
         "max_tokens": max_tokens,
     }
+    if stream:
+        payload["stream"] = True
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class _InFlight:
+    """Запрос, который сейчас выполняет "ведущий" поток."""
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: ChatResult | None = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """
+    Склеивает одинаковые одновременные запросы: первый поток (ведущий) идёт
+    в API, остальные с тем же ключом ждут его результат или его ошибку.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, _InFlight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn, timeout_s: float) -> ChatResult:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _InFlight()
+        if leader:
+            try:
+                call.result = fn()
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        metric.counter("llm_singleflight_shared_total").inc()
+        if not call.done.wait(timeout_s):
+            metric.counter("llm_singleflight_timeouts_total").inc()
+            raise OpenRouterError(f"Не удалось подключиться к OpenRouter: нет ответа за {timeout_s:g} с")
+        if isinstance(call.error, OpenRouterError):
+            # У каждого ожидающего своя копия исключения (один объект нельзя безопасно бросать из
+            # разных потоков) — того же класса, со status_code и retry_after ведущего
+            raise copy.copy(call.error) from call.error
+        if call.error is not None:
+            raise OpenRouterError(f"Ошибка запроса к OpenRouter: {call.error}") from call.error
+        return call.result
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class OpenRouterClient:
+    """
+    Клиент OpenRouter поверх requests.Session.
+    Соединения (DNS, TCP, TLS) переиспользуются между вызовами через keep-alive.
+    """
+
+    def __init__(self, api_key: str | None = None, url: str = OPENROUTER_API_URL,
+                 pool_size: int = OPENROUTER_POOL_SIZE,
+                 connect_timeout: float = OPENROUTER_CONNECT_TIMEOUT,
+                 read_timeout: float = OPENROUTER_READ_TIMEOUT,
+                 cache: LLMCache | None = None, single_flight: SingleFlight | None = None,
+                 retry: RetryPolicy | None = None, breakers: CircuitBreakers | None = None):
+        self.api_key = api_key
+        self.url = url
+        self.cache = cache
+        self.single_flight = single_flight
+        self.retry = retry
+        self.breakers = breakers
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        # pool_block=True: при нехватке соединений поток ждёт свободное, а не открывает лишнее
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1), pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        })
+
+    def chat(self, msgs: list[dict], model: str, temperature: float = 0.7, max_tokens: int = 1024,
+             timeout_s: float | None = None) -> ChatResult:
+        """
+        Отправляет запрос к модели и возвращает ChatResult.
+        Если задан cache и temperature не выше порога, одинаковые запросы
+        отдаются из кэша (ms=0). Если задан single_flight, одинаковые запросы,
+        пришедшие одновременно, уходят в API один раз.
+        """
+        key = None
+        use_cache = self.cache is not None and self.cache.cacheable(temperature)
+        if use_cache or self.single_flight is not None:
+            key = make_key(model, msgs, temperature, max_tokens)
+        if use_cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                log.debug(f"Ответ для model={model} взят из кэша")
+                return ChatResult(**{**cached, "ms": 0})
+
+        def call() -> ChatResult:
+            log.debug(f"Запрос к OpenRouter: model={model}, temp={temperature}, max_tokens={max_tokens}")
+            result = self._send_guarded(build_payload(msgs, model, temperature, max_tokens), model, timeout_s)
+            if use_cache:
+                self.cache.put(key, asdict(result))
+            return result
+
+        if self.single_flight is None:
+            return call()
+        wait_s = self.connect_timeout + (timeout_s if timeout_s is not None else self.read_timeout)
+        if self.retry is not None:
+            wait_s = wait_s * self.retry.max_attempts + self.retry.budget_s
+        return self.single_flight.do(key, call, wait_s)
+
+    def _send_guarded(self, body: bytes, model: str, timeout_s: float | None = None) -> ChatResult:
+        """send() с повторами временных ошибок и circuit breaker модели (если они заданы)."""
+        def attempt() -> ChatResult:
+            if self.breakers is None:
+                return self.send(body, model, timeout_s=timeout_s)
+            try:
+                return self.breakers.get(model).call(lambda: self.send(body, model, timeout_s=timeout_s),
+                                                     is_failure=is_transient)
+            except CircuitOpenError as e:
+                raise ModelUnavailableError(f"Модель {model} временно недоступна. Попробуйте позже.",
+                                            status_code=503, retry_after=e.retry_after) from e
+
+        if self.retry is None:
+            return attempt()
+        return self.retry.run(attempt, is_transient, lambda e: e.retry_after, name=f"OpenRouter {model}")
+
+    def send(self, body: bytes, model: str, timeout_s: float | None = None) -> ChatResult:
+        """Отправляет заранее сериализованное тело запроса (см. build_payload)."""
+        if not self.api_key:
+            msg = "Отсутствует ключ OPENROUTER_API_KEY в .env файле."
+            log.error(msg)
+            raise OpenRouterError(msg, status_code=401)
+
+        timeout = (self.connect_timeout, timeout_s if timeout_s is not None else self.read_timeout)
+        t0 = time.perf_counter()
+        try:
+            r = self.session.post(self.url, data=body, timeout=timeout)
+            dt_ms = int((time.perf_counter() - t0) * 1000)
+
+            # Проверяем статус ответа
+            if r.status_code != 200:
+                error_msg = _get_friendly_error(r.status_code)
+                log.error(f"Ошибка от OpenRouter API (статус {r.status_code}): {r.text}")
+                raise OpenRouterError(error_msg, status_code=r.status_code,
+                                      retry_after=parse_retry_after(r.headers.get("Retry-After")))
+
+            return _result_from_json(r.json(), model, dt_ms)
+
+        except requests.exceptions.RequestException as e:
+            log.error(f"Сетевая ошибка при обращении к OpenRouter: {e}")
+            raise OpenRouterError(f"Не удалось подключиться к OpenRouter: {e}")
+        except (KeyError, IndexError, json.JSONDecodeError) as e:
+            log.error(f"Неожиданная структура ответа от OpenRouter: {e}")
+            raise OpenRouterError("Получен некорректный ответ от API.")
+
+    def stream(self, msgs: list[dict], model: str, temperature: float = 0.7, max_tokens: int = 1024,
+               timeout_s: float | None = None) -> "ChatStream":
+        """Запрос с stream: true; ответ читается по мере генерации (см. ChatStream)."""
+        log.debug(f"Потоковый запрос к OpenRouter: model={model}, temp={temperature}, max_tokens={max_tokens}")
+        return ChatStream(self, build_payload(msgs, model, temperature, max_tokens, stream=True), model, timeout_s)
+
+    def close(self) -> None:
+        """Закрывает все соединения сессии."""
+        self.session.close()
+
+
+def _stream_error_status(code) -> int | None:
+    """
+    HTTP-статус из ошибки внутри SSE-потока. code бывает и строкой
+    ("rate_limit_exceeded"): нечисловой код даёт None — сбой посреди ответа
+    считается временным, как обрыв сети.
+    """
+    if isinstance(code, bool):
+        return None
+    if isinstance(code, int):
+        return code
+    if isinstance(code, str) and code.strip().isdigit():
+        return int(code)
+    return None
+
+
+class ChatStream:
+    """
+    Итератор по фрагментам ответа из SSE-потока OpenRouter.
+    После полного прохода result() возвращает ChatResult; время до первого токена
+    пишется в метрику llm_ttft_ms.
+    """
+
+    def __init__(self, client: OpenRouterClient, body: bytes, model: str, timeout_s: float | None = None):
+        self._client = client
+        self._body = body
+        self._timeout_s = timeout_s
+        self.model = model
+        self.text = ""
+        self.ttft_ms: int | None = None
+        self.ms = 0
+        self.prompt_tokens: int | None = None
+        self.completion_tokens: int | None = None
+
+    def __iter__(self) -> Iterator[str]:
+        client = self._client
+        if not client.api_key:
+            msg = "Отсутствует ключ OPENROUTER_API_KEY в .env файле."
+            log.error(msg)
+            raise OpenRouterError(msg, status_code=401)
+
+        read_timeout = self._timeout_s if self._timeout_s is not None else client.read_timeout
+        t0 = time.perf_counter()
+        try:
+            with client.session.post(client.url, data=self._body, timeout=(client.connect_timeout, read_timeout),
+                                     stream=True) as r:
+                if r.status_code != 200:
+                    error_msg = _get_friendly_error(r.status_code)
+                    log.error(f"Ошибка от OpenRouter API (статус {r.status_code}): {r.text}")
+                    raise OpenRouterError(error_msg, status_code=r.status_code,
+                                          retry_after=parse_retry_after(r.headers.get("Retry-After")))
+
+                for line in r.iter_lines():
+                    # Пустые строки разделяют события, строки с ":" — служебные комментарии
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if "error" in chunk:
+                        err = chunk["error"]
+                        log.error(f"Ошибка в потоке OpenRouter: {err}")
+                        raise OpenRouterError(err.get("message") or "Ошибка генерации ответа.",
+                                              status_code=_stream_error_status(err.get("code")))
+                    usage = chunk.get("usage")
+                    if usage:
+                        self.prompt_tokens = usage.get("prompt_tokens")
+                        self.completion_tokens = usage.get("completion_tokens")
+                    choices = chunk.get("choices") or []
+                    delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                    if not delta:
+                        continue
+                    if self.ttft_ms is None:
+                        self.ttft_ms = int((time.perf_counter() - t0) * 1000)
+                        metric.latency("llm_ttft_ms").observe(self.ttft_ms)
+                    self.text += delta
+                    yield delta
+
+        except requests.exceptions.RequestException as e:
+            log.error(f"Сетевая ошибка при обращении к OpenRouter: {e}")
+            raise OpenRouterError(f"Не удалось подключиться к OpenRouter: {e}")
+        except (KeyError, IndexError, AttributeError, json.JSONDecodeError) as e:
+            log.error(f"Неожиданная структура потока от OpenRouter: {e}")
+            raise OpenRouterError("Получен некорректный ответ от API.")
+        finally:
+            self.ms = int((time.perf_counter() - t0) * 1000)
+
+    def result(self) -> ChatResult:
+        """Итог потока в том же виде, что и у chat()."""
+        return ChatResult(
+            text=self.text.strip(),
+            ms=self.ms,
+            model=self.model,
+            prompt_tokens=self.prompt_tokens,
+            completion_tokens=self.completion_tokens,
+        )
+
+
+def chat_stream(msgs: list[dict], model: str, temperature: float = 0.7, max_tokens: int = 1024,
+                timeout_s: int = 30) -> ChatStream:
+    """Потоковый вариант chat(): итерируйте результат, чтобы получать фрагменты текста."""
+    return get_client().stream(msgs, model, temperature=temperature, max_tokens=max_tokens, timeout_s=timeout_s)
+
+
+_client: OpenRouterClient | None = None
+# Кэш, склейка запросов, политика повторов и автоматы моделей общие для всех пересозданий клиента
+_cache = default_cache()
+_single_flight = SingleFlight() if OPENROUTER_SINGLE_FLIGHT else None
+_retry = RetryPolicy()
+_breakers = CircuitBreakers()
+_client_lock = threading.Lock()
+
+
+def get_client() -> OpenRouterClient:
+    """Общий клиент модуля; создаётся лениво и пересоздаётся при смене ключа."""
+    global _client
+    with _client_lock:
+        if _client is None or _client.api_key != OPENROUTER_API_KEY:
+            if _client is not None:
+                _client.close()
+            _client = OpenRouterClient(api_key=OPENROUTER_API_KEY, single_flight=_single_flight,
+                                       **shared_options())
+        return _client
+
+
+def shared_options() -> dict:
+    """Кэш, политика повторов и автоматы моделей, общие для синхронного и асинхронного клиентов."""
+    return {"cache": _cache, "retry": _retry, "breakers": _breakers}
+
+
+def get_breakers() -> CircuitBreakers:
+    """Автоматы моделей процесса (без создания клиента)."""
+    return _breakers
+
 
-    log.debug(f"Запрос к OpenRouter: model={model}, temp={temperature}, max_tokens={max_tokens}")
-    t0 = time.perf_counter()
-
-    try:
-        r = requests.post(OPENROUTER_API_URL, headers=headers, json=payload, timeout=timeout_s)
-        dt_ms = int((time.perf_counter() - t0) * 1000)
-
-        # Проверяем статус ответа
-        if r.status_code != 200:
-            error_msg = _get_friendly_error(r.status_code)
-            log.error(f"Ошибка от OpenRouter API (статус {r.status_code}): {r.text}")
-            raise OpenRouterError(error_msg, status_code=r.status_code)
-
-        data = r.json()
-        text = data["choices"][0]["message"]["content"]
-        return text.strip(), dt_ms
-
-    except requests.exceptions.RequestException as e:
-        log.error(f"Сетевая ошибка при обращении к OpenRouter: {e}")
-        raise OpenRouterError(f"Не удалось подключиться к OpenRouter: {e}")
-    except (KeyError, IndexError, json.JSONDecodeError) as e:
-        log.error(f"Неожиданная структура ответа от OpenRouter: {e}")
-        raise OpenRouterError("Получен некорректный ответ от API.")
\ No newline at end of file
+def close_client() -> None:
+    """Закрывает общий клиент (при остановке бота)."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
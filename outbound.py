@@ -0,0 +1,290 @@
+# outbound.py
+"""
+Очередь исходящих сообщений Telegram.
+
+Telegram ограничивает бота примерно 30 сообщениями в секунду в целом и
+1 сообщением в секунду в одном чате; при превышении отвечает 429 с
+retry_after, а рассылка "в лоб" вызывает лавину таких ошибок. Все отправки
+проходят через OutboundQueue:
+  * общее ведро токенов (OUTBOUND_GLOBAL_RPS) и ведро на каждый чат
+    (OUTBOUND_CHAT_RPS), см. rate_limit.TokenBucket;
+  * две полосы: ответы пользователям (INTERACTIVE) всегда идут раньше
+    рассылок (BULK);
+  * сообщения в один чат уходят строго по порядку;
+  * на 429 сообщение откладывается на retry_after и повторяется.
+
+install(bot) подменяет методы отправки бота: обычный вызов bot.reply_to(...)
+ждёт своей очереди и возвращает Message, а с priority=BULK, wait=False —
+сразу возвращает Future. install_async(bot) делает то же для AsyncTeleBot.
+
+Лимит Telegram действует на токен целиком, а очередь — на процесс, поэтому в
+многопроцессном режиме (cluster.py) каждый обработчик получает свою долю
+OUTBOUND_GLOBAL_RPS.
+"""
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable
+
+from metrics import metric
+from rate_limit import TokenBucket
+
+log = logging.getLogger(__name__)
+
+OUTBOUND_GLOBAL_RPS = float(os.getenv("OUTBOUND_GLOBAL_RPS", "30"))
+OUTBOUND_CHAT_RPS = float(os.getenv("OUTBOUND_CHAT_RPS", "1"))
+# Короткая пачка в один чат (заглушка, правки, итоговый ответ) допустима
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", "3"))
+# Потоки отправки: при ~100 мс на запрос 8 потоков покрывают 30 сообщений/с
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "8"))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+# Дольше этого ждать по retry_after бессмысленно — отдаём ошибку вызывающему
+OUTBOUND_MAX_RETRY_AFTER_S = float(os.getenv("OUTBOUND_MAX_RETRY_AFTER_S", "60"))
+OUTBOUND_MAX_CHATS = int(os.getenv("OUTBOUND_MAX_CHATS", "10000"))
+
+INTERACTIVE = 0
+BULK = 1
+
+
+class _Job:
+    __slots__ = ("chat_id", "fn", "future", "priority", "enqueued_at", "attempts")
+
+    def __init__(self, chat_id, fn: Callable, priority: int, enqueued_at: float):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.future: Future = Future()
+        self.priority = priority
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+
+
+def retry_after_of(e: Exception) -> float | None:
+    """retry_after из ответа 429 Telegram (None — это не 429)."""
+    # У синхронного (apihelper) и асинхронного (asyncio_helper) клиента это разные классы
+    if getattr(e, "error_code", None) != 429:
+        return None
+    params = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+    return float(params.get("retry_after", 1))
+
+
+class OutboundQueue:
+    """Очередь отправки с общим и початовым лимитом и приоритетными полосами."""
+
+    def __init__(self, global_rps: float = OUTBOUND_GLOBAL_RPS, chat_rps: float = OUTBOUND_CHAT_RPS,
+                 chat_burst: int = OUTBOUND_CHAT_BURST, workers: int = OUTBOUND_WORKERS,
+                 max_retries: int = OUTBOUND_MAX_RETRIES, max_chats: int = OUTBOUND_MAX_CHATS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.chat_rps = chat_rps
+        self.chat_burst = chat_burst
+        self.workers = max(workers, 1)
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._clock = clock
+        self._global = TokenBucket(global_rps, max(int(global_rps), 1), clock)
+        self._chats: OrderedDict = OrderedDict()
+        self._lanes = (deque(), deque())  # INTERACTIVE, BULK
+        self._in_flight: set = set()
+        self._paused_until: dict = {}
+        self._cond = threading.Condition()
+        self._threads: list[threading.Thread] = []
+        self._stopping = False
+        self._backlog = metric.gauge("outbound_backlog")
+
+    @property
+    def global_rps(self) -> float:
+        return self._global.rate
+
+    def set_global_rate(self, rps: float) -> None:
+        """Меняет общий лимит (например, долю процесса в cluster.py); запас — не больше секунды."""
+        with self._cond:
+            self._global = TokenBucket(rps, max(int(rps), 1), self._clock)
+            self._cond.notify_all()
+
+    def start(self) -> "OutboundQueue":
+        with self._cond:
+            self._start_locked()
+        return self
+
+    def _start_locked(self) -> None:
+        if self._threads:
+            return
+        self._stopping = False
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"outbound-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, chat_id, fn: Callable, priority: int = INTERACTIVE) -> Future:
+        """Ставит отправку в очередь; Future получит результат fn (например, Message)."""
+        job = _Job(chat_id, fn, priority, self._clock())
+        with self._cond:
+            self._start_locked()
+            self._lanes[priority].append(job)
+            self._cond.notify()
+        self._backlog.inc()
+        metric.counter(f"outbound_{'interactive' if priority == INTERACTIVE else 'bulk'}_total").inc()
+        return job.future
+
+    def backlog(self) -> int:
+        with self._cond:
+            return len(self._lanes[INTERACTIVE]) + len(self._lanes[BULK])
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rps, self.chat_burst, self._clock)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _pick(self) -> tuple[_Job | None, float | None]:
+        """Первое готовое к отправке сообщение или (None, сколько ждать). Под self._cond."""
+        now = self._clock()
+        wait = None
+        for lane in self._lanes:
+            # Чаты, у которых более раннее сообщение ещё не ушло, пропускаем — порядок важнее
+            seen = set()
+            for job in lane:
+                chat = job.chat_id
+                if chat in seen or chat in self._in_flight:
+                    seen.add(chat)
+                    continue
+                seen.add(chat)
+                paused = self._paused_until.get(chat, 0) - now
+                if paused > 0:
+                    wait = paused if wait is None else min(wait, paused)
+                    continue
+                self._paused_until.pop(chat, None)
+                bucket = self._chat_bucket(chat)
+                eta = bucket.time_until(1)
+                if eta > 0:
+                    wait = eta if wait is None else min(wait, eta)
+                    continue
+                eta = self._global.time_until(1)
+                if eta > 0:
+                    # Общий лимит исчерпан: сейчас не уйдёт ничего
+                    return None, eta if wait is None else min(wait, eta)
+                bucket.try_acquire()
+                self._global.try_acquire()
+                lane.remove(job)
+                return job, None
+        return None, wait
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    job, wait = self._pick()
+                    if job is not None:
+                        break
+                    if self._stopping and not any(self._lanes):
+                        return
+                    self._cond.wait(wait)
+                self._in_flight.add(job.chat_id)
+            self._send(job)
+            with self._cond:
+                self._in_flight.discard(job.chat_id)
+                self._cond.notify_all()
+
+    def _send(self, job: _Job) -> None:
+        job.attempts += 1
+        try:
+            result = job.fn()
+        except Exception as e:
+            retry_after = retry_after_of(e)
+            if retry_after is not None:
+                metric.counter("outbound_429_total").inc()
+                if job.attempts <= self.max_retries and retry_after <= OUTBOUND_MAX_RETRY_AFTER_S:
+                    log.warning(f"Telegram 429 для чата {job.chat_id}, повтор через {retry_after:.0f} с")
+                    with self._cond:
+                        self._paused_until[job.chat_id] = self._clock() + retry_after
+                        # В начало полосы: следующие сообщения этого чата не обгонят его
+                        self._lanes[job.priority].appendleft(job)
+                    return
+            metric.counter("outbound_errors_total").inc()
+            self._backlog.dec()
+            job.future.set_exception(e)
+            return
+        self._backlog.dec()
+        metric.counter("outbound_sent_total").inc()
+        metric.latency("outbound_latency_ms").observe(int((self._clock() - job.enqueued_at) * 1000))
+        job.future.set_result(result)
+
+    def stop(self, timeout: float | None = 10.0) -> None:
+        """Отправляет то, что уже в очереди, и останавливает потоки."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            threads, self._threads = self._threads, []
+        for t in threads:
+            t.join(timeout)
+
+
+# Методы отправки и позиция chat_id среди позиционных аргументов
+_SEND_METHODS = {
+    "send_message": 0,
+    "edit_message_text": 1,
+    "send_photo": 0,
+    "send_document": 0,
+    "copy_message": 0,
+    "forward_message": 0,
+}
+
+
+def _queued(outbound: OutboundQueue, send: Callable, chat_arg: int) -> Callable:
+    @functools.wraps(send)
+    def wrapper(*args, priority: int = INTERACTIVE, wait: bool = True, **kwargs):
+        chat_id = kwargs.get("chat_id", args[chat_arg] if len(args) > chat_arg else None)
+        if chat_id is None:
+            # Например, правка inline-сообщения: чата нет, лимит не применим
+            return send(*args, **kwargs)
+        future = outbound.submit(chat_id, functools.partial(send, *args, **kwargs), priority)
+        return future.result() if wait else future
+    return wrapper
+
+
+def _queued_async(outbound: OutboundQueue, send: Callable, chat_arg: int) -> Callable:
+    @functools.wraps(send)
+    async def wrapper(*args, priority: int = INTERACTIVE, wait: bool = True, **kwargs):
+        chat_id = kwargs.get("chat_id", args[chat_arg] if len(args) > chat_arg else None)
+        if chat_id is None:
+            return await send(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+
+        def call():
+            # Поток очереди ждёт, пока event loop выполнит отправку; на 429 корутина создаётся заново
+            return asyncio.run_coroutine_threadsafe(send(*args, **kwargs), loop).result()
+
+        future = asyncio.wrap_future(outbound.submit(chat_id, call, priority))
+        return await future if wait else future
+    return wrapper
+
+
+def install(bot, outbound: OutboundQueue | None = None) -> OutboundQueue:
+    """Пускает методы отправки бота через очередь (reply_to использует send_message)."""
+    outbound = outbound or get_outbound()
+    for name, chat_arg in _SEND_METHODS.items():
+        setattr(bot, name, _queued(outbound, getattr(bot, name), chat_arg))
+    return outbound
+
+
+def install_async(bot, outbound: OutboundQueue | None = None) -> OutboundQueue:
+    """install() для AsyncTeleBot: await bot.reply_to(...) ждёт очереди, не блокируя event loop."""
+    outbound = outbound or get_outbound()
+    for name, chat_arg in _SEND_METHODS.items():
+        setattr(bot, name, _queued_async(outbound, getattr(bot, name), chat_arg))
+    return outbound
+
+
+_outbound = OutboundQueue()
+
+
+def get_outbound() -> OutboundQueue:
+    """Общая очередь процесса: лимиты Telegram действуют на токен бота целиком."""
+    return _outbound
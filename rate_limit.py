@@ -0,0 +1,262 @@
+# rate_limit.py
+"""
+Клиентское ограничение частоты запросов (token bucket).
+
+  * TokenBucket — классическое "ведро": rate токенов в секунду, не больше burst.
+  * FairQueue — очередь к одному ведру с честным обслуживанием: ожидающие
+    запросы получают токены по кругу между пользователями, а не в порядке
+    прихода, поэтому один активный пользователь не занимает всю квоту модели.
+  * RateLimiter — ведро на каждую модель и на каждого пользователя Telegram.
+
+Если по оценке токен не достанется до дедлайна, запрос сразу отклоняется
+исключением RateLimited(retry_after) — бот отвечает "подождите", а не висит.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Callable
+
+from metrics import metric
+
+log = logging.getLogger(__name__)
+
+# По умолчанию выключено: лимиты ниже рассчитаны на бесплатные модели и
+# урезали бы платные. Включайте, подобрав RPM под свои модели и тариф.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "0") == "1"
+# Бесплатные модели OpenRouter: порядка 20 запросов в минуту
+RATE_LIMIT_MODEL_RPM = float(os.getenv("RATE_LIMIT_MODEL_RPM", "20"))
+RATE_LIMIT_MODEL_BURST = int(os.getenv("RATE_LIMIT_MODEL_BURST", "5"))
+RATE_LIMIT_USER_RPM = float(os.getenv("RATE_LIMIT_USER_RPM", "6"))
+RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", "3"))
+# Сколько секунд запрос может ждать своей очереди
+RATE_LIMIT_MAX_WAIT_S = float(os.getenv("RATE_LIMIT_MAX_WAIT_S", "10"))
+# Сколько пользовательских вёдер держать в памяти (LRU)
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "10000"))
+
+
+class RateLimited(Exception):
+    """Запрос не получит токен до дедлайна; retry_after — через сколько секунд стоит повторить."""
+
+    def __init__(self, scope: str, retry_after: float):
+        super().__init__(f"Превышен лимит запросов ({scope}), повторите через {retry_after:.0f} с")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Ведро токенов; не потокобезопасно само по себе — вызывайте под своей блокировкой."""
+
+    def __init__(self, rate_per_s: float, burst: int, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate_per_s
+        self.burst = max(burst, 1)
+        self._clock = clock
+        self.tokens = float(self.burst)
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def time_until(self, n: float = 1) -> float:
+        """Через сколько секунд в ведре наберётся n токенов (0 — уже есть)."""
+        self._refill()
+        missing = n - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+    def try_acquire(self, n: float = 1) -> bool:
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def refund(self, n: float = 1) -> None:
+        self._refill()
+        self.tokens = min(self.burst, self.tokens + n)
+
+
+class FairQueue:
+    """Очередь к одному ведру: токены раздаются по кругу между ключами (пользователями)."""
+
+    def __init__(self, name: str, bucket: TokenBucket, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.bucket = bucket
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._queues: OrderedDict = OrderedDict()  # key -> deque билетов
+
+    def _position(self, key, ticket) -> int:
+        """
+        Сколько билетов будет обслужено раньше данного. Круг r обслуживает r-й билет
+        каждого ключа в порядке очереди; наш билет — в круге idx.
+        """
+        keys = list(self._queues)
+        mine = keys.index(key)
+        idx = self._queues[key].index(ticket)
+        ahead = idx
+        for i, other in enumerate(keys):
+            if i != mine:
+                ahead += min(len(self._queues[other]), idx + 1 if i < mine else idx)
+        return ahead
+
+    def _remove(self, key, ticket) -> None:
+        q = self._queues[key]
+        q.remove(ticket)
+        if not q:
+            del self._queues[key]
+
+    def _step(self, key, ticket, deadline: float) -> float | None:
+        """Под self._cond: None — токен получен, иначе сколько ждать; RateLimited — не успеем."""
+        head_key = next(iter(self._queues))
+        if self._queues[head_key][0] is ticket and self.bucket.try_acquire():
+            self._queues[key].popleft()
+            # Пользователь уходит в конец круга
+            if self._queues[key]:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            self._cond.notify_all()
+            return None
+        eta = self.bucket.time_until(self._position(key, ticket) + 1)
+        remaining = deadline - self._clock()
+        if eta > remaining:
+            raise RateLimited(self.name, eta)
+        return max(min(eta, remaining), 0.001)
+
+    def _abandon(self, key, ticket) -> None:
+        with self._cond:
+            if ticket in self._queues.get(key, ()):
+                self._remove(key, ticket)
+            self._cond.notify_all()
+
+    def acquire(self, key, deadline: float) -> None:
+        """Ждёт своей очереди до deadline (по часам clock) или бросает RateLimited."""
+        ticket = object()
+        with self._cond:
+            self._queues.setdefault(key, deque()).append(ticket)
+            try:
+                while (wait := self._step(key, ticket, deadline)) is not None:
+                    self._cond.wait(timeout=wait)
+            except BaseException:
+                self._abandon(key, ticket)
+                raise
+
+    async def acquire_async(self, key, deadline: float) -> None:
+        """Как acquire(), но ждёт в event loop, не занимая поток."""
+        ticket = object()
+        with self._cond:
+            self._queues.setdefault(key, deque()).append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._step(key, ticket, deadline)
+                if wait is None:
+                    return
+                # Уведомлений Condition корутина не получает — перепроверяем не позже расчётного срока
+                await asyncio.sleep(wait)
+        except BaseException:
+            self._abandon(key, ticket)
+            raise
+
+    def depth(self) -> int:
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+
+class RateLimiter:
+    """Лимиты на модель (общие для всех) и на пользователя."""
+
+    def __init__(self, model_rpm: float = RATE_LIMIT_MODEL_RPM, model_burst: int = RATE_LIMIT_MODEL_BURST,
+                 user_rpm: float = RATE_LIMIT_USER_RPM, user_burst: int = RATE_LIMIT_USER_BURST,
+                 max_wait_s: float = RATE_LIMIT_MAX_WAIT_S, max_users: int = RATE_LIMIT_MAX_USERS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.model_rate = model_rpm / 60
+        self.model_burst = model_burst
+        self.user_rate = user_rpm / 60
+        self.user_burst = user_burst
+        self.max_wait_s = max_wait_s
+        self.max_users = max_users
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._models: dict[str, FairQueue] = {}
+        self._users: OrderedDict = OrderedDict()
+
+    def deadline(self, max_wait_s: float | None = None) -> float:
+        return self._clock() + (self.max_wait_s if max_wait_s is None else max_wait_s)
+
+    def _user_wait(self, user_id, deadline: float) -> float:
+        """0 — токен пользователя получен, иначе сколько ждать; RateLimited — не успеем до дедлайна."""
+        with self._lock:
+            bucket = self._users.get(user_id)
+            if bucket is None:
+                bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst, self._clock)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            self._users.move_to_end(user_id)
+            if bucket.try_acquire():
+                return 0.0
+            eta = bucket.time_until(1)
+        if eta > deadline - self._clock():
+            metric.counter("rate_limited_user_total").inc()
+            raise RateLimited("пользователь", eta)
+        return eta
+
+    def acquire_user(self, user_id, deadline: float) -> None:
+        """Токен из ведра пользователя: ждём, если успеваем до дедлайна, иначе RateLimited."""
+        while wait := self._user_wait(user_id, deadline):
+            time.sleep(wait)
+
+    async def acquire_user_async(self, user_id, deadline: float) -> None:
+        """Как acquire_user(), но ждёт в event loop."""
+        while wait := self._user_wait(user_id, deadline):
+            await asyncio.sleep(wait)
+
+    def refund_user(self, user_id) -> None:
+        """Возвращает токен пользователю, если запрос так и не ушёл в API."""
+        with self._lock:
+            bucket = self._users.get(user_id)
+            if bucket is not None:
+                bucket.refund()
+
+    def _model_queue(self, model: str) -> FairQueue:
+        with self._lock:
+            queue = self._models.get(model)
+            if queue is None:
+                queue = self._models[model] = FairQueue(
+                    model, TokenBucket(self.model_rate, self.model_burst, self._clock), self._clock
+                )
+            return queue
+
+    def acquire_model(self, model: str, user_id, deadline: float) -> None:
+        """Место в честной очереди к ведру модели."""
+        t0 = time.perf_counter()
+        try:
+            self._model_queue(model).acquire(user_id, deadline)
+        except RateLimited:
+            metric.counter("rate_limited_model_total").inc()
+            raise
+        metric.latency("rate_limit_wait_ms").observe(int((time.perf_counter() - t0) * 1000))
+
+    async def acquire_model_async(self, model: str, user_id, deadline: float) -> None:
+        """Как acquire_model(), но ждёт в event loop."""
+        t0 = time.perf_counter()
+        try:
+            await self._model_queue(model).acquire_async(user_id, deadline)
+        except RateLimited:
+            metric.counter("rate_limited_model_total").inc()
+            raise
+        metric.latency("rate_limit_wait_ms").observe(int((time.perf_counter() - t0) * 1000))
+
+
+_limiter: RateLimiter | None = RateLimiter() if RATE_LIMIT_ENABLED else None
+
+
+def get_limiter() -> RateLimiter | None:
+    """Общий лимитер процесса (None, если ограничение выключено)."""
+    return _limiter
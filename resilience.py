@@ -0,0 +1,256 @@
+# resilience.py
+"""
+Повторы с экспоненциальной задержкой и circuit breaker для вызовов внешних API.
+
+RetryPolicy повторяет временные ошибки (429, 5xx, сеть) с "decorrelated jitter":
+задержка случайна в [base, 3 * предыдущая], но не больше max_delay_s. Если сервер
+прислал Retry-After, ждём столько, сколько он просит (или не повторяем вовсе,
+если это не укладывается в бюджет времени).
+
+CircuitBreaker считает подряд идущие сбои. После failure_threshold сбоев он
+"размыкается" (OPEN) и сразу отклоняет вызовы, не занимая поток на весь таймаут.
+Через reset_timeout_s он пропускает один пробный вызов (HALF_OPEN): успех замыкает
+цепь, ошибка снова размыкает.
+"""
+import asyncio
+import contextlib
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Iterator, TypeVar
+
+from metrics import metric
+
+T = TypeVar("T")
+
+log = logging.getLogger(__name__)
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY_S = float(os.getenv("RETRY_BASE_DELAY_S", "0.5"))
+RETRY_MAX_DELAY_S = float(os.getenv("RETRY_MAX_DELAY_S", "8"))
+# Сколько всего секунд можно потратить на ожидание между попытками
+RETRY_BUDGET_S = float(os.getenv("RETRY_BUDGET_S", "20"))
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT_S = float(os.getenv("BREAKER_RESET_TIMEOUT_S", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Значение заголовка Retry-After (секунды или HTTP-дата) в секундах."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+class RetryPolicy:
+    """Политика повторов: число попыток, границы задержки и общий бюджет ожидания."""
+
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay_s: float = RETRY_BASE_DELAY_S,
+                 max_delay_s: float = RETRY_MAX_DELAY_S, budget_s: float = RETRY_BUDGET_S,
+                 rnd: random.Random | None = None, sleep: Callable[[float], None] = time.sleep):
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.budget_s = budget_s
+        self._rnd = rnd or random.Random()
+        self._sleep = sleep
+
+    def next_delay(self, prev_delay: float | None, retry_after: float | None = None) -> float:
+        """Задержка перед следующей попыткой (decorrelated jitter или Retry-After)."""
+        if retry_after is not None:
+            return retry_after
+        upper = max(self.base_delay_s, (prev_delay or self.base_delay_s) * 3)
+        return min(self.max_delay_s, self._rnd.uniform(self.base_delay_s, upper))
+
+    def _delay(self, attempt: int, e: Exception, waited: float, prev_delay: float | None,
+               is_retryable: Callable[[Exception], bool], retry_after: Callable[[Exception], float | None],
+               name: str) -> float | None:
+        """Задержка перед повтором после ошибки e или None, если пора сдаваться."""
+        if attempt == self.max_attempts or not is_retryable(e):
+            return None
+        delay = self.next_delay(prev_delay, retry_after(e))
+        if waited + delay > self.budget_s:
+            log.warning(f"{name}: повтор через {delay:.1f} с не укладывается в бюджет, сдаёмся")
+            return None
+        metric.counter("llm_retries_total").inc()
+        log.warning(f"{name}: попытка {attempt} не удалась ({e}), повтор через {delay:.2f} с")
+        return delay
+
+    def run(self, fn: Callable[[], T], is_retryable: Callable[[Exception], bool],
+            retry_after: Callable[[Exception], float | None] = lambda e: None, name: str = "") -> T:
+        """Вызывает fn, повторяя временные ошибки; последняя ошибка пробрасывается наверх."""
+        waited = 0.0
+        prev_delay = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return fn()
+            except Exception as e:
+                delay = self._delay(attempt, e, waited, prev_delay, is_retryable, retry_after, name)
+                if delay is None:
+                    raise
+                self._sleep(delay)
+                waited += delay
+                prev_delay = delay
+        raise AssertionError("unreachable")
+
+    async def arun(self, fn: Callable[[], Awaitable[T]], is_retryable: Callable[[Exception], bool],
+                   retry_after: Callable[[Exception], float | None] = lambda e: None, name: str = "") -> T:
+        """Как run(), но для корутин: паузы между попытками не занимают поток."""
+        waited = 0.0
+        prev_delay = None
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await fn()
+            except Exception as e:
+                delay = self._delay(attempt, e, waited, prev_delay, is_retryable, retry_after, name)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                waited += delay
+                prev_delay = delay
+        raise AssertionError("unreachable")
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонён: цепь разомкнута. retry_after — через сколько секунд будет пробный вызов."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name}: цепь разомкнута, повтор через {retry_after:.0f} с")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Автомат closed -> open -> half_open -> closed для одного ресурса (например, модели)."""
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout_s: float = BREAKER_RESET_TIMEOUT_S, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_timeout_s = reset_timeout_s
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        log.warning(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        metric.counter("llm_breaker_transitions_total").inc()
+        metric.counter(f"llm_breaker_{state}_total").inc()
+        self.state = state
+        if state == OPEN:
+            self._opened_at = self._clock()
+
+    def allows_call(self) -> bool:
+        """Пропустил бы автомат вызов сейчас (без изменения состояния)."""
+        with self._lock:
+            if self.state == OPEN:
+                return self._clock() >= self._opened_at + self.reset_timeout_s
+            return not (self.state == HALF_OPEN and self._probe_in_flight)
+
+    def before_call(self) -> None:
+        """Пропускает вызов или бросает CircuitOpenError (запрос "сброшен")."""
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened_at + self.reset_timeout_s - self._clock()
+                if remaining > 0:
+                    metric.counter("llm_breaker_shed_total").inc()
+                    raise CircuitOpenError(self.name, remaining)
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                # В полуоткрытом состоянии пропускаем только один пробный вызов
+                if self._probe_in_flight:
+                    metric.counter("llm_breaker_shed_total").inc()
+                    raise CircuitOpenError(self.name, self.reset_timeout_s)
+                self._probe_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._transition(OPEN)
+
+    def release(self) -> None:
+        """Освобождает пробный вызов, исход которого неизвестен: следующий вызов станет пробным."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    @contextlib.contextmanager
+    def guard(self, is_failure: Callable[[Exception], bool]) -> Iterator[None]:
+        """
+        Защищает блок with (в том числе с await внутри): before_call() на входе
+        и исход на любом выходе. Ошибки, для которых is_failure ложно (например,
+        400 — ошибка в самом запросе), не считаются сбоем ресурса. Выход без
+        исхода — отмена задачи (CancelledError), KeyboardInterrupt — только
+        освобождает пробный вызов, чтобы цепь не застряла в half_open.
+        """
+        self.before_call()
+        try:
+            yield
+        except Exception as e:
+            if is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        except BaseException:
+            self.release()
+            raise
+        self.record_success()
+
+    def call(self, fn: Callable[[], T], is_failure: Callable[[Exception], bool]) -> T:
+        """Выполняет fn под защитой автомата (см. guard)."""
+        with self.guard(is_failure):
+            return fn()
+
+
+class CircuitBreakers:
+    """Набор автоматов по имени ресурса (по одному на модель)."""
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout_s: float = BREAKER_RESET_TIMEOUT_S, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self._clock = clock
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(name)
+            if breaker is None:
+                breaker = self._breakers[name] = CircuitBreaker(
+                    name, self.failure_threshold, self.reset_timeout_s, self._clock
+                )
+            return breaker
+
+    def states(self) -> dict[str, str]:
+        with self._lock:
+            return {name: b.state for name, b in self._breakers.items()}
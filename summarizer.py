@@ -0,0 +1,158 @@
+# summarizer.py
+"""
+Инкрементальное резюме диалога.
+
+Когда несвёрнутая часть истории пользователя превышает SUMMARY_TRIGGER_TOKENS,
+старые ходы (кроме SUMMARY_KEEP_ROWS последних сообщений) сворачиваются в
+резюме. Модель получает прежнее резюме и только новые сообщения (не больше
+SUMMARY_MAX_ROWS за запрос), поэтому стоимость свёртки не растёт с длиной диалога. Резюме хранится в chat_summaries
+и идёт в промпт вместо сырых сообщений; /summarize_and_save дополняет его
+только ходами после last_history_id, а последние SUMMARY_KEEP_ROWS сообщений
+добавляет лишь к тексту заметки, чтобы они остались в промпте как есть.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import db
+from metrics import metric
+from model_router import get_router
+
+log = logging.getLogger(__name__)
+
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"
+# Порог несвёрнутой истории (в оценочных токенах), после которого запускается свёртка
+SUMMARY_TRIGGER_TOKENS = int(os.getenv("SUMMARY_TRIGGER_TOKENS", "2048"))
+# Сколько последних сообщений всегда остаются в промпте как есть
+SUMMARY_KEEP_ROWS = int(os.getenv("SUMMARY_KEEP_ROWS", "6"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "512"))
+# Сколько несвёрнутых строк истории читать за раз
+SUMMARY_MAX_ROWS = int(os.getenv("SUMMARY_MAX_ROWS", "50"))
+
+
+def summary_prompt(previous: str | None, history: list[dict]) -> str:
+    """Промпт свёртки: прежнее резюме (если есть) и новые сообщения."""
+    dialog_text = "\n".join(f"{h['role']}: {h['message']}" for h in history)
+    if not previous:
+        return (
+            "Сделай краткое, но емкое резюме следующего диалога. "
+            "Выдели ключевые темы и выводы. Ответ должен быть только самим текстом резюме.\n\n"
+            f"ДИАЛОГ:\n{dialog_text}"
+        )
+    return (
+        "Ниже резюме начала диалога и его продолжение. Обнови резюме с учётом продолжения: "
+        "сохрани ключевые темы и выводы, добавь новые. Ответ должен быть только самим текстом резюме.\n\n"
+        f"РЕЗЮМЕ:\n{previous}\n\nПРОДОЛЖЕНИЕ ДИАЛОГА:\n{dialog_text}"
+    )
+
+
+class Summarizer:
+    """Свёртка старых ходов в резюме; в фоне — не больше одной свёртки на пользователя."""
+
+    def __init__(self, chat_fn: Callable | None = None, trigger_tokens: int = SUMMARY_TRIGGER_TOKENS,
+                 keep_rows: int = SUMMARY_KEEP_ROWS, max_tokens: int = SUMMARY_MAX_TOKENS,
+                 max_rows: int = SUMMARY_MAX_ROWS):
+        self._chat_fn = chat_fn
+        self.trigger_tokens = trigger_tokens
+        self.keep_rows = keep_rows
+        self.max_tokens = max_tokens
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._running: set[int] = set()
+        self._executor: ThreadPoolExecutor | None = None
+
+    def summarize(self, previous: str | None, history: list[dict], model: str,
+                  user_id: int | None = None) -> str:
+        """Новое резюме из прежнего и новых сообщений (запрос к LLM через роутер)."""
+        chat_fn = self._chat_fn or get_router().chat
+        msgs = [{"role": "user", "content": summary_prompt(previous, history)}]
+        result = chat_fn(msgs, primary=model, temperature=0.2, max_tokens=self.max_tokens, user_id=user_id)
+        metric.counter("summary_requests_total").inc()
+        return result.text
+
+    def fold(self, user_id: int, model: str, force: bool = False) -> bool:
+        """
+        Сворачивает старые ходы, пока несвёрнутая история выше порога. Строки
+        читаются от старых к новым по max_rows за запрос, так что длинный хвост
+        сворачивается по частям и ничего не пропускается. force=True
+        (/summarize_and_save) сворачивает независимо от порога и расходует
+        лимит пользователя; последние keep_rows сообщений остаются и в этом
+        случае. True — резюме обновлено.
+        """
+        window = self.max_rows + self.keep_rows
+        folded = False
+        while True:
+            summary, history = db.get_unsummarized_history(user_id, window)
+            # Полное окно — за ним ещё есть строки, и сворачивать нужно независимо от порога
+            backlog = len(history) == window
+            if not backlog and not force and sum(h["tokens"] for h in history) <= self.trigger_tokens:
+                return folded
+            to_fold = history[:-self.keep_rows] if self.keep_rows > 0 else list(history)
+            # Не разрываем ход: свёрнутая часть заканчивается ответом ассистента
+            while to_fold and to_fold[-1]["role"] != "assistant":
+                to_fold.pop()
+            if not to_fold:
+                return folded
+            text = self.summarize(summary["summary"] if summary else None, to_fold, model,
+                                  user_id=user_id if force else None)
+            if not db.save_chat_summary(user_id, text, to_fold[-1]["id"]):
+                # /clear или параллельная свёртка — дальше сворачивать нечего
+                return folded
+            folded = True
+            metric.counter("summary_folds_total").inc()
+            log.info(f"Резюме диалога {user_id}: свёрнуто {len(to_fold)} сообщений")
+
+    def full_summary(self, user_id: int, model: str) -> str | None:
+        """
+        Резюме всего диалога для /summarize_and_save (None — история пуста).
+        Старые ходы сворачиваются в сохранённое резюме, а хвост, который остаётся
+        в промпте как есть, добавляется только к возвращаемому тексту: сохранённое
+        резюме и last_history_id его не охватывают.
+        """
+        self.fold(user_id, model, force=True)
+        summary, tail = db.get_unsummarized_history(user_id, self.max_rows + self.keep_rows)
+        previous = summary["summary"] if summary else None
+        if not tail:
+            return previous
+        return self.summarize(previous, tail, model, user_id=user_id)
+
+    def maybe_schedule(self, user_id: int, model: str, history_tokens: int) -> bool:
+        """Ставит свёртку в фоновую очередь, если history_tokens выше порога."""
+        if history_tokens <= self.trigger_tokens:
+            return False
+        with self._lock:
+            if user_id in self._running:
+                return False
+            self._running.add(user_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+            executor = self._executor
+        executor.submit(self._fold_in_background, user_id, model)
+        return True
+
+    def _fold_in_background(self, user_id: int, model: str) -> None:
+        try:
+            self.fold(user_id, model)
+        except Exception as e:
+            # Без резюме бот продолжает работать: история просто обрезается по бюджету
+            metric.counter("summary_errors_total").inc()
+            log.warning(f"Не удалось свернуть историю {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._running.discard(user_id)
+
+    def close(self, wait: bool = True) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+_summarizer = Summarizer()
+
+
+def get_summarizer() -> Summarizer:
+    """Общий экземпляр процесса."""
+    return _summarizer
@@ -0,0 +1,29 @@
+# tests/cluster_app.py
+"""Приложение-заглушка для тестов cluster.py: пишет обработанные обновления в файл."""
+import os
+import threading
+import time
+
+from metrics import metric
+from outbound import get_outbound
+
+_lock = threading.Lock()
+
+
+class _Bot:
+    threaded = False
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            time.sleep(0.01)
+            metric.counter("test_handled_total").inc()
+            with _lock, open(os.environ["CLUSTER_TEST_LOG"], "a") as f:
+                f.write(f"{os.getpid()} {update.message.from_user.id} {update.update_id}\n")
+
+
+bot = _Bot()
+
+if os.getenv("CLUSTER_TEST_OUTBOUND"):
+    # Общий лимит очереди отправки, который достался этому обработчику
+    with _lock, open(os.environ["CLUSTER_TEST_OUTBOUND"], "a") as f:
+        f.write(f"{os.getpid()} {get_outbound().global_rps}\n")
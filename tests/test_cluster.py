@@ -0,0 +1,106 @@
+# tests/test_cluster.py
+import time
+
+from cluster import Cluster
+from dispatcher import payload_key
+from metrics import merge_snapshots
+
+
+def _payload(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "text": "x",
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "U"}},
+    }
+
+
+def _read_log(path) -> list[tuple[int, int, int]]:
+    if not path.exists():
+        return []
+    return [tuple(map(int, line.split())) for line in path.read_text().splitlines()]
+
+
+def _wait_for_lines(path, n: int, timeout: float = 30) -> list:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        rows = _read_log(path)
+        if len(rows) >= n:
+            return rows
+        time.sleep(0.05)
+    return _read_log(path)
+
+
+def test_merge_snapshots_sums_counters_and_combines_latencies():
+    a = {"counters": {"x": 2}, "gauges": {"q": 1},
+         "latencies": {"t": {"count": 2, "total_ms": 30, "min_ms": 10, "max_ms": 20, "avg_ms": 15.0}}}
+    b = {"counters": {"x": 3, "y": 1}, "gauges": {"q": 4},
+         "latencies": {"t": {"count": 1, "total_ms": 60, "min_ms": 60, "max_ms": 60, "avg_ms": 60.0}}}
+
+    merged = merge_snapshots([a, b, {}])
+
+    assert merged["counters"] == {"x": 5, "y": 1}
+    assert merged["gauges"] == {"q": 5}
+    assert merged["latencies"]["t"] == {"count": 3, "total_ms": 90, "min_ms": 10, "max_ms": 60, "avg_ms": 30.0}
+
+
+def test_payload_key_uses_sender_then_chat():
+    assert payload_key(_payload(1, 42)) == 42
+    assert payload_key({"update_id": 5, "channel_post": {"chat": {"id": -100}}}) == 5
+    assert payload_key({"update_id": 6, "my_chat_member": {"chat": {"id": 9}, "from": {"id": 8}}}) == 8
+
+
+def test_cluster_splits_outbound_limit_between_workers(tmp_path, monkeypatch):
+    """Лимит отправки Telegram общий на токен: N обработчиков вместе не превышают его."""
+    from outbound import OUTBOUND_GLOBAL_RPS
+
+    rates_path = tmp_path / "outbound.log"
+    monkeypatch.setenv("CLUSTER_TEST_LOG", str(tmp_path / "handled.log"))
+    monkeypatch.setenv("CLUSTER_TEST_OUTBOUND", str(rates_path))
+    cluster = Cluster(app="cluster_app", workers=3).start()
+    try:
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            rows = rates_path.read_text().splitlines() if rates_path.exists() else []
+            if len(rows) >= 3:
+                break
+            time.sleep(0.05)
+    finally:
+        cluster.stop()
+
+    rates = [float(line.split()[1]) for line in rows]
+    assert len(rates) == 3
+    assert all(rate == OUTBOUND_GLOBAL_RPS / 3 for rate in rates)
+
+
+def test_cluster_routes_users_to_one_process_and_restarts_gracefully(tmp_path, monkeypatch):
+    """
+    Тест проверяет, что обновления пользователя обрабатывает один процесс и по
+    порядку, метрики процессов сводятся во фронте, а после мягкого перезапуска
+    обработчик получает новый pid и ничего не теряется.
+    """
+    log_path = tmp_path / "handled.log"
+    monkeypatch.setenv("CLUSTER_TEST_LOG", str(log_path))
+    cluster = Cluster(app="cluster_app", workers=2, metrics_interval_s=0.2).start()
+    try:
+        users = [1, 2, 3, 4]
+        cluster.process_new_updates([_payload(i, users[i % 4]) for i in range(20)])
+        rows = _wait_for_lines(log_path, 20)
+        assert len(rows) == 20
+
+        old_pid = cluster.pid(0)
+        cluster.restart_worker(0)
+        assert cluster.pid(0) != old_pid
+        cluster.process_new_updates([_payload(100 + i, u) for i, u in enumerate(users)])
+        rows = _wait_for_lines(log_path, 24)
+    finally:
+        cluster.stop()
+
+    assert len(rows) == 24
+    for user in users:
+        mine = [r for r in rows if r[1] == user]
+        assert [r[2] for r in mine] == sorted(r[2] for r in mine)
+        # До перезапуска пользователь обслуживается одним процессом
+        assert len({r[0] for r in mine if r[2] < 100}) == 1
+    assert cluster.metrics()["counters"]["test_handled_total"] == 24
+    assert cluster.metrics()["counters"]["cluster_routed_total"] >= 24
@@ -1,4 +1,7 @@
 # tests/test_db.py
+import threading
+import time
+
 import pytest
 
 
@@ -56,4 +59,241 @@ def test_set_user_character_raises_error_for_unknown_id(db_module):
 
     # Это необязательная, но очень полезная проверка:
     # убедимся, что текст ошибки именно тот, который мы ожидаем.
-    assert "Неизвестный ID персонажа" in str(excinfo.value)
\ No newline at end of file
+    assert "Неизвестный ID персонажа" in str(excinfo.value)
+
+def test_pool_reuses_connection(db_module):
+    """Тест проверяет, что пул отдаёт одно и то же "прогретое" соединение повторно."""
+    db = db_module
+    with db._connect() as conn1:
+        # Вложенный вызов в том же потоке получает то же соединение
+        with db._connect() as nested:
+            assert nested is conn1
+    with db._connect() as conn2:
+        assert conn2 is conn1
+
+
+def test_nested_connection_error_rolls_back_only_inner_block(db_module):
+    """Тест проверяет, что ошибка во вложенном _connect() не откатывает работу внешнего блока."""
+    db = db_module
+    uid = 778
+    db.clear_chat_history(uid)
+    db.set_setting("test_nested", "old")
+    with db._connect() as conn:
+        conn.execute("INSERT INTO chat_history(user_id, role, message) VALUES (?, 'user', 'внешняя')", (uid,))
+        with pytest.raises(RuntimeError):
+            with db._connect() as inner:
+                inner.execute("INSERT INTO chat_history(user_id, role, message) VALUES (?, 'user', 'вложенная')",
+                              (uid,))
+                db.set_setting("test_nested", "new")
+                raise RuntimeError("сбой во вложенном блоке")
+        conn.execute("INSERT INTO chat_history(user_id, role, message) VALUES (?, 'user', 'после')", (uid,))
+
+    assert [h["message"] for h in db.get_chat_history(uid)] == ["внешняя", "после"]
+    # Откатанная запись не попала и в кэш настроек
+    assert db.get_setting_or_default("test_nested", "") == "old"
+
+    # Без записей во внешнем блоке ошибка вложенного тоже откатывает только его
+    with db._connect():
+        with pytest.raises(RuntimeError):
+            with db._connect() as inner:
+                inner.execute("INSERT INTO chat_history(user_id, role, message) VALUES (?, 'user', 'лишняя')",
+                              (uid,))
+                raise RuntimeError("сбой")
+        db.add_to_chat_history(uid, "user", "последняя")
+    assert [h["message"] for h in db.get_chat_history(uid)] == ["внешняя", "после", "последняя"]
+
+
+def test_close_all_resets_pool(db_module):
+    """Тест проверяет, что после close_all() база снова доступна через новый пул."""
+    db = db_module
+    db.add_to_chat_history(777, "user", "до закрытия")
+    db.close_all()
+    history = db.get_chat_history(777)
+    assert history[-1]["message"] == "до закрытия"
+
+
+def test_pool_returns_slot_when_connection_fails_to_open(db_module, tmp_path):
+    """Тест проверяет, что ошибка открытия соединения не уменьшает размер пула."""
+    db = db_module
+    pool = db.ConnectionPool(str(tmp_path / "нет" / "такой" / "папки.db"), size=1, timeout=0.1)
+    for _ in range(3):
+        # Без возврата слота вторая попытка упала бы по таймауту пула
+        with pytest.raises(db.sqlite3.OperationalError, match="unable to open"):
+            pool.acquire()
+
+
+def test_settings_cache_write_through(db_module):
+    """Тест проверяет, что set_setting/set_feature_toggle сразу видны через кэш."""
+    db = db_module
+    db.set_setting("test_temperature", "0.3")
+    db.set_feature_toggle("test_toggle", False)
+    assert db.get_setting_or_default("test_temperature", "0.7") == "0.3"
+    assert db.is_feature_enabled("test_toggle", True) is False
+    db.set_setting("test_temperature", "0.5")
+    assert db.get_setting_or_default("test_temperature", "0.7") == "0.5"
+
+
+def test_settings_cache_ignores_rolled_back_write(db_module):
+    """Тест проверяет, что запись, откатанная вместе с внешней транзакцией, не попадает в кэш."""
+    db = db_module
+    db.set_setting("test_rollback", "old")
+    seen = []
+    with pytest.raises(RuntimeError):
+        with db._connect():
+            db.set_setting("test_rollback", "new")
+            assert db.get_setting_or_default("test_rollback", "") == "new"
+            # До commit другие потоки не видят новое значение и через кэш
+            reader = threading.Thread(target=lambda: seen.append(db.get_setting_or_default("test_rollback", "")))
+            reader.start()
+            reader.join()
+            raise RuntimeError("сбой после записи")
+    assert seen == ["old"]
+    assert db.get_setting_or_default("test_rollback", "") == "old"
+    db.set_setting("test_rollback", "newer")
+    assert db.get_setting_or_default("test_rollback", "") == "newer"
+
+
+def test_settings_cache_sees_changes_from_other_process(db_module, monkeypatch):
+    """Тест проверяет, что изменение из другого соединения видно после проверки версии."""
+    import sqlite3
+    db = db_module
+    monkeypatch.setattr(db._settings_cache, "ttl_s", 0)
+    assert db.get_int_setting("test_timeout", 30) == 30
+
+    # "Другой процесс" пишет в таблицу напрямую, минуя db.py
+    other = sqlite3.connect(db.DB_PATH)
+    with other:
+        other.execute("INSERT OR REPLACE INTO settings(key, value) VALUES ('test_timeout', '12')")
+    other.close()
+
+    assert db.get_int_setting("test_timeout", 30) == 12
+
+
+def test_set_active_model_swaps_registry(db_module):
+    """Тест проверяет, что смена активной модели сразу видна в реестре."""
+    db = db_module
+    models = db.list_models()
+    target = models[-1]
+    db.set_active_model(target["id"])
+    assert db.get_active_model()["id"] == target["id"]
+    assert [m["id"] for m in db.list_models() if m["active"]] == [target["id"]]
+    db.set_active_model(models[0]["id"])
+
+
+def test_registry_sees_active_model_changed_by_other_process(db_module, monkeypatch):
+    """Тест проверяет инвалидацию реестра, когда активную модель меняет другой процесс."""
+    import sqlite3
+    db = db_module
+    monkeypatch.setattr(db._registry_cache, "ttl_s", 0)
+    first, second = db.list_models()[:2]
+    db.set_active_model(first["id"])
+
+    other = sqlite3.connect(db.DB_PATH)
+    with other:
+        other.execute("UPDATE models SET active=0 WHERE active=1")
+        other.execute("UPDATE models SET active=1 WHERE id=?", (second["id"],))
+    other.close()
+
+    assert db.get_active_model()["id"] == second["id"]
+    db.set_active_model(first["id"])
+
+
+def test_record_turn_writes_both_rows_with_meta(db_module):
+    """Тест проверяет, что record_turn пишет вопрос и ответ вместе с метаданными."""
+    db = db_module
+    uid = 5005
+    db.clear_chat_history(uid)
+    db.record_turn(uid, "вопрос", "ответ", {
+        "model_key": "test/model", "latency_ms": 120, "prompt_tokens": 10, "completion_tokens": 20,
+    })
+
+    assert db.get_chat_history(uid) == [
+        {"role": "user", "message": "вопрос"},
+        {"role": "assistant", "message": "ответ"},
+    ]
+    with db._connect() as conn:
+        row = conn.execute(
+            "SELECT model_key, latency_ms, prompt_tokens, completion_tokens FROM chat_history "
+            "WHERE user_id = ? AND role = 'assistant'", (uid,)
+        ).fetchone()
+    assert tuple(row) == ("test/model", 120, 10, 20)
+
+
+def test_write_behind_read_your_writes(db_module):
+    """Тест проверяет фоновую запись: свои строки видны сразу, а после stop — в БД."""
+    db = db_module
+    uid = 6006
+    db.clear_chat_history(uid)
+    # Большой интервал, чтобы строки гарантированно повисели в очереди
+    writer = db.start_write_behind(flush_ms=10_000, max_batch=1000)
+    try:
+        db.record_turn(uid, "вопрос", "ответ")
+        db.add_to_chat_history(uid, "user", "ещё вопрос")
+        assert [h["message"] for h in db.get_chat_history(uid)] == ["вопрос", "ответ", "ещё вопрос"]
+        note_id = db.add_note(uid, "заметка через писатель")
+        assert db.get_note_by_id(uid, note_id)["text"] == "заметка через писатель"
+    finally:
+        db.stop_write_behind()
+    assert not writer.has_pending(uid)
+    assert [h["message"] for h in db.get_chat_history(uid)] == ["вопрос", "ответ", "ещё вопрос"]
+
+
+def test_write_behind_stop_and_flush_respect_timeout_when_writer_is_stuck(db_module):
+    """Тест проверяет, что остановка не зависает, если поток писателя не разбирает полную очередь."""
+    db = db_module
+    # Поток не запущен — как если бы он умер: очередь из одной записи сразу полна
+    writer = db.WriteBehindWriter(max_queue=1)
+    writer.submit_note(1, "заметка")
+
+    t0 = time.monotonic()
+    assert writer.flush(timeout=0.1) is False
+    assert writer.stop(timeout=0.1) is False
+    assert time.monotonic() - t0 < 2
+
+
+def test_find_notes_full_text_cyrillic(db_module):
+    """Тест проверяет поиск заметок: регистр кириллицы, префиксы и изоляцию пользователей."""
+    db = db_module
+    uid = 8118
+    db.add_note(uid, "Купить МОЛОКО и хлеб")
+    edited = db.add_note(uid, "Позвонить маме")
+    db.add_note(uid + 1, "Молоко чужого пользователя")
+    db.update_note(uid, edited, "Позвонить бабушке")
+
+    found = [n["text"] for n in db.find_notes(uid, "молок")]
+    assert found == ["Купить МОЛОКО и хлеб"]
+    assert db.find_notes(uid, "маме") == []
+    assert [n["text"] for n in db.find_notes(uid, "бабушк")] == ["Позвонить бабушке"]
+
+
+def test_list_notes_keyset_pagination(db_module):
+    """Тест проверяет постраничный вывод заметок по курсору id в обе стороны."""
+    db = db_module
+    uid = 9009
+    ids = [db.add_note(uid, f"заметка {i}") for i in range(5)]
+
+    first = [n["id"] for n in db.list_notes(uid, 2)]
+    assert first == ids[:-3:-1]
+    second = [n["id"] for n in db.list_notes(uid, 2, before_id=first[-1])]
+    assert second == [ids[2], ids[1]]
+    # Листаем обратно к новым — та же первая страница
+    assert [n["id"] for n in db.list_notes(uid, 2, after_id=second[0])] == first
+
+
+def test_count_notes_maintained_by_triggers(db_module):
+    """Тест проверяет счётчик заметок: вставка/удаление и восстановление после рассинхрона."""
+    db = db_module
+    uid = 1010
+    before = db.count_notes(uid)
+    first = db.add_note(uid, "раз")
+    db.add_note(uid, "два")
+    db.delete_note(uid, first)
+    assert db.count_notes(uid) == before + 1
+
+    # Портим счётчик вручную — проверка находит расхождение, пересборка чинит
+    with db._connect() as conn:
+        conn.execute("UPDATE note_counts SET count = 100 WHERE user_id = ?", (uid,))
+    assert {"user_id": uid, "stored": 100, "actual": before + 1} in db.check_note_counts()
+    assert db.rebuild_note_counts() >= 1
+    assert db.count_notes(uid) == before + 1
+    assert db.check_note_counts() == []
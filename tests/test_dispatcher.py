@@ -0,0 +1,94 @@
+# tests/test_dispatcher.py
+import threading
+import time
+from types import SimpleNamespace
+
+from telebot import TeleBot, types
+
+from dispatcher import ShardedDispatcher, install, update_key
+from metrics import metric
+
+
+def _update(update_id: int, user_id: int, text: str = "") -> SimpleNamespace:
+    return SimpleNamespace(update_id=update_id,
+                           message=SimpleNamespace(from_user=SimpleNamespace(id=user_id), text=text))
+
+
+def test_keeps_order_per_user_and_runs_users_in_parallel():
+    """
+    Тест проверяет, что обновления одного пользователя обрабатываются строго
+    по порядку, а медленный пользователь не задерживает остальных.
+    """
+    seen: dict[int, list[int]] = {}
+    active: set[int] = set()
+    lock = threading.Lock()
+
+    def handle(updates):
+        update = updates[0]
+        uid = update.message.from_user.id
+        with lock:
+            # Один пользователь никогда не обрабатывается в двух потоках сразу
+            assert uid not in active
+            active.add(uid)
+        time.sleep(0.2 if uid == 1 else 0.01)
+        with lock:
+            active.discard(uid)
+            seen.setdefault(uid, []).append(update.update_id)
+
+    dispatcher = ShardedDispatcher(handle, workers=4).start()
+    t0 = time.perf_counter()
+    dispatcher.process_new_updates([_update(i, 1 if i % 5 == 0 else 2 + i % 3) for i in range(25)])
+    # Пока медленный пользователь 1 ждёт, остальные уже обслужены
+    deadline = time.perf_counter() + 2
+    while sum(len(v) for k, v in seen.items() if k != 1) < 20 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    fast_done = time.perf_counter() - t0
+    dispatcher.stop()
+
+    assert fast_done < 0.5
+    for uid, ids in seen.items():
+        assert ids == sorted(ids)
+    assert seen[1] == [0, 5, 10, 15, 20]
+    assert metric.latency("dispatch_wait_ms").count >= 25
+    assert dispatcher.depth() == 0
+
+
+def test_handler_error_does_not_stop_shard():
+    handled = []
+
+    def handle(updates):
+        if updates[0].update_id == 1:
+            raise RuntimeError("сбой")
+        handled.append(updates[0].update_id)
+
+    dispatcher = ShardedDispatcher(handle, workers=1).start()
+    dispatcher.process_new_updates([_update(i, 7) for i in range(3)])
+    dispatcher.stop()
+
+    assert handled == [0, 2]
+
+
+def test_install_routes_bot_updates_through_dispatcher():
+    bot = TeleBot("123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11", threaded=False)
+    threads = []
+    done = threading.Event()
+
+    @bot.message_handler(func=lambda m: True)
+    def on_message(message):
+        threads.append(threading.current_thread().name)
+        done.set()
+
+    update = types.Update.de_json({
+        "update_id": 10,
+        "message": {"message_id": 1, "date": 0, "text": "привет",
+                    "chat": {"id": 77, "type": "private"},
+                    "from": {"id": 77, "is_bot": False, "first_name": "U"}},
+    })
+    assert update_key(update) == 77
+
+    dispatcher = install(bot, workers=2)
+    bot.process_new_updates([update])
+    assert done.wait(2)
+    dispatcher.stop()
+
+    assert threads[0].startswith("dispatch-")
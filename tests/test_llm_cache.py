@@ -0,0 +1,66 @@
+# tests/test_llm_cache.py
+import responses
+
+from llm_cache import LLMCache, SQLiteStore, make_key
+from metrics import metric
+from openrouter_client import OpenRouterClient
+
+
+def test_make_key_is_canonical():
+    """Порядок ключей в сообщениях не влияет на хэш, а параметры запроса — влияют."""
+    msgs_a = [{"role": "user", "content": "Привет"}]
+    msgs_b = [{"content": "Привет", "role": "user"}]
+    assert make_key("m", msgs_a, 0.2, 100) == make_key("m", msgs_b, 0.2, 100)
+    assert make_key("m", msgs_a, 0.2, 100) != make_key("m", msgs_a, 0.3, 100)
+    assert make_key("m", msgs_a, 0.2, 100) != make_key("other", msgs_a, 0.2, 100)
+
+
+def test_cache_ttl_lru_and_bypass():
+    cache = LLMCache(ttl_s=60, max_entries=2, max_chars=10, max_temperature=0.3)
+    cache.put("a", {"text": "aaa"})
+    cache.put("b", {"text": "bbb"})
+    assert cache.get("a") == {"text": "aaa"}  # "a" становится самым свежим
+    cache.put("c", {"text": "ccc"})
+    assert cache.get("b") is None  # вытеснен по числу записей
+    cache.put("d", {"text": "dddddddd"})
+    assert len(cache) == 1  # вытеснение по объёму текста
+
+    expired = LLMCache(ttl_s=-1)
+    expired.put("x", {"text": "x"})
+    assert expired.get("x") is None
+
+    assert cache.cacheable(0.2) and not cache.cacheable(0.7)
+
+
+def test_sqlite_tier_survives_new_instance(db_module):
+    LLMCache(store=SQLiteStore()).put("k1", {"text": "из базы"})
+    fresh = LLMCache(store=SQLiteStore())
+    assert fresh.get("k1") == {"text": "из базы"}
+    assert len(fresh) == 1  # поднят в память
+
+
+def test_sqlite_tier_prunes_to_max_rows(db_module):
+    store = SQLiteStore(max_rows=3)
+    for i in range(5):
+        store.put(f"prune{i}", {"text": str(i)}, expires_at=10_000_000_000 + i)
+    assert store.get("prune0") is None
+    assert store.get("prune4") is not None
+
+
+@responses.activate
+def test_client_serves_repeated_low_temperature_calls_from_cache():
+    mock_url = "https://openrouter.ai/api/v1/chat/completions"
+    responses.add(responses.POST, mock_url, json={"choices": [{"message": {"content": "резюме"}}]}, status=200)
+    client = OpenRouterClient(api_key="test-key", cache=LLMCache())
+    msgs = [{"role": "user", "content": "Сделай резюме"}]
+    hits_before = metric.counter("llm_cache_hits_total").get()
+
+    first = client.chat(msgs, "m", temperature=0.2)
+    second = client.chat(msgs, "m", temperature=0.2)
+    client.chat(msgs, "m", temperature=0.9)
+
+    assert first.text == second.text == "резюме"
+    assert second.ms == 0
+    assert len(responses.calls) == 2  # второй вызов — из кэша, третий — в обход
+    assert metric.counter("llm_cache_hits_total").get() == hits_before + 1
+    assert 0 < metric.hit_rate("llm_cache") <= 1
@@ -0,0 +1,85 @@
+# tests/test_main2.py
+import importlib
+import re
+
+import pytest
+
+
+@pytest.fixture()
+def notes_module(db_module, monkeypatch):
+    """Бот заметок (main2.py) поверх временной БД из db_module."""
+    monkeypatch.setenv("TOKEN", "123456:ABC-DEF1234ghIkl-zyx57W2v1u123ew11")
+    return importlib.import_module("main2")
+
+
+def _shown_ids(response: str) -> list[int]:
+    return [int(i) for i in re.findall(r"^#(\d+) _", response, flags=re.M)]
+
+
+def _button_data(kb, prefix: str) -> str | None:
+    buttons = kb.keyboard[0] if kb is not None else []
+    return next((b.callback_data for b in buttons if b.text.startswith(prefix)), None)
+
+
+def _next_data(kb) -> str | None:
+    return _button_data(kb, "Старше")
+
+
+def _open(main2, uid: int, data: str):
+    _, token, page_no = data.split(":")
+    search = main2._get_search(token, int(page_no))
+    assert search is not None
+    return main2._notes_find_page(uid, token, search, int(page_no))
+
+
+def test_note_find_pages_are_stable_while_notes_are_added(db_module, notes_module):
+    """
+    Тест проверяет листание результатов /note_find: новые заметки между
+    страницами меняют bm25, но строки не повторяются и не теряются.
+    """
+    db = db_module
+    main2 = notes_module
+    uid = 9191
+    expected = {db.add_note(uid, f"план поездки {i} " + "слово " * (i % 5)) for i in range(25)}
+
+    token, search = main2._remember_search(uid, "план")
+    response, kb = main2._notes_find_page(uid, token, search)
+    seen = _shown_ids(response)
+    while (data := _next_data(kb)) is not None:
+        # Между загрузками страниц появляются новые подходящие заметки
+        db.add_note(uid, "план план план")
+        response, kb = _open(main2, uid, data)
+        seen += _shown_ids(response)
+
+    assert len(seen) == len(set(seen))
+    assert set(seen) == expected
+
+
+def test_note_find_back_button_returns_to_truncated_page(db_module, notes_module, monkeypatch):
+    """
+    Тест проверяет кнопку "Новее" после страниц, обрезанных по лимиту сообщения:
+    возвращается ровно та страница, что была показана, без пропусков и повторов.
+    """
+    db = db_module
+    main2 = notes_module
+    monkeypatch.setattr(main2, "TELEGRAM_MESSAGE_LIMIT", 700)
+    uid = 9192
+    for i in range(25):
+        db.add_note(uid, f"отпуск {i} " + "подробности " * 10)
+
+    token, search = main2._remember_search(uid, "отпуск")
+    response, kb = main2._notes_find_page(uid, token, search)
+    pages = [_shown_ids(response)]
+    while (data := _next_data(kb)) is not None:
+        response, kb = _open(main2, uid, data)
+        pages.append(_shown_ids(response))
+    assert len(pages) > 3  # страницы короче NOTES_PAGE_SIZE
+
+    for expected in reversed(pages[:-1]):
+        response, kb = _open(main2, uid, _button_data(kb, "◀️"))
+        assert _shown_ids(response) == expected
+    assert _button_data(kb, "◀️") is None
+
+    # Неизвестный токен или ещё не открытая страница — поиск устарел, а не KeyError
+    assert main2._get_search("нет-такого", 0) is None
+    assert main2._get_search(token, 99) is None
@@ -0,0 +1,213 @@
+# tests/test_main_async.py
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from model_router import ModelRouter
+from openrouter_async import AsyncOpenRouterClient, AsyncSingleFlight
+from openrouter_client import ChatResult, OpenRouterError
+from rate_limit import RateLimited, RateLimiter
+from resilience import CircuitBreakers
+
+PRIMARY = "mistralai/mistral-7b-instruct:free"
+BACKUP = "anthropic/claude-3-haiku"
+
+
+class _FakeAsyncClient(AsyncOpenRouterClient):
+    """Асинхронный клиент без сети: по ключу модели send() бросает ошибку или отвечает."""
+
+    def __init__(self, behaviour: dict, **kwargs):
+        super().__init__(api_key="test-key", **kwargs)
+        self.behaviour = behaviour
+        self.calls = []
+
+    async def send(self, body, model, timeout_s=None):
+        self.calls.append(model)
+        action = self.behaviour[model]
+        if isinstance(action, Exception):
+            raise action
+        await asyncio.sleep(action if isinstance(action, float) else 0)
+        return ChatResult(text=str(action), ms=7, model=model, prompt_tokens=3, completion_tokens=2)
+
+
+@pytest.fixture()
+def async_module(main_module):
+    import importlib
+    return importlib.import_module("main_async")
+
+
+def test_route_chat_falls_back_and_updates_shared_state(async_module):
+    """Тест проверяет, что асинхронный путь ведёт статистику роутера и breaker'ы как синхронный."""
+    breakers = CircuitBreakers(failure_threshold=1)
+    client = _FakeAsyncClient({PRIMARY: OpenRouterError("перегружен", 503), BACKUP: "ответ"}, breakers=breakers)
+    router = ModelRouter(breakers=CircuitBreakers())
+
+    result = asyncio.run(async_module.route_chat(
+        [{"role": "user", "content": "q"}], primary=PRIMARY, router=router, client=client,
+    ))
+
+    assert result.model == BACKUP
+    assert client.calls == [PRIMARY, BACKUP]
+    assert router.snapshot()[PRIMARY]["error_rate"] == 1.0
+    assert breakers.states()[PRIMARY] == "open"
+
+    client = _FakeAsyncClient({PRIMARY: OpenRouterError("плохой запрос", 400), BACKUP: "ответ"})
+    with pytest.raises(OpenRouterError):
+        asyncio.run(async_module.route_chat(
+            [{"role": "user", "content": "q"}], primary=PRIMARY, router=router, client=client,
+        ))
+    assert client.calls == [PRIMARY]
+
+
+def test_route_chat_waits_for_limits_in_the_event_loop(async_module):
+    """
+    Тест проверяет асинхронные лимиты: ожидание токена модели не занимает
+    потоки, а запрос, не получивший токен, возвращает квоту пользователя.
+    """
+    client = _FakeAsyncClient({PRIMARY: "ответ", BACKUP: "ответ"})
+    limiter = RateLimiter(model_rpm=600, model_burst=1, user_rpm=60, user_burst=1, max_wait_s=0.5)
+    router = ModelRouter(breakers=CircuitBreakers(), limiter=limiter)
+    router.chain = lambda primary: [PRIMARY]
+    msgs = [{"role": "user", "content": "q"}]
+
+    async def scenario():
+        return await asyncio.gather(*(async_module.route_chat(msgs, primary=PRIMARY, router=router,
+                                                              client=client, user_id=uid) for uid in (1, 2)))
+
+    # Второй запрос ждёт токен модели (0,1 с) в event loop
+    assert [r.model for r in asyncio.run(scenario())] == [PRIMARY, PRIMARY]
+
+    router.limiter = RateLimiter(model_rpm=1, model_burst=1, user_rpm=1, user_burst=1, max_wait_s=0.1)
+    asyncio.run(async_module.route_chat(msgs, primary=PRIMARY, router=router, client=client, user_id=1))
+    with pytest.raises(RateLimited):
+        asyncio.run(async_module.route_chat(msgs, primary=PRIMARY, router=router, client=client, user_id=2))
+    # Токен пользователя 2 не сгорел
+    router.limiter.acquire_user(2, router.limiter.deadline())
+
+
+def test_route_chat_hedges_and_cancels_the_loser(async_module):
+    """Тест проверяет hedged-запрос в asyncio: отвечает быстрая модель, медленная отменяется."""
+    breakers = CircuitBreakers(failure_threshold=1)
+    client = _FakeAsyncClient({PRIMARY: 5.0, BACKUP: "быстрый ответ"}, breakers=breakers)
+    router = ModelRouter(breakers=CircuitBreakers(), hedge=True, hedge_min_delay_ms=50)
+    router.chain = lambda primary: [PRIMARY, BACKUP]
+    for _ in range(5):
+        router.observe(PRIMARY, True, 10)
+
+    async def scenario():
+        t0 = asyncio.get_running_loop().time()
+        result = await async_module.route_chat([{"role": "user", "content": "q"}], primary=PRIMARY,
+                                               router=router, client=client)
+        return result, asyncio.get_running_loop().time() - t0
+
+    result, elapsed = asyncio.run(scenario())
+    assert result.text == "быстрый ответ"
+    assert elapsed < 1
+    # Отменённый запрос не считается сбоем модели
+    assert breakers.states()[PRIMARY] == "closed"
+
+
+def test_async_client_shares_one_request_between_callers():
+    """Тест проверяет склейку одинаковых одновременных запросов в асинхронном клиенте."""
+    client = _FakeAsyncClient({PRIMARY: 0.05}, single_flight=AsyncSingleFlight())
+
+    async def scenario():
+        return await asyncio.gather(*(client.chat([{"role": "user", "content": "q"}], PRIMARY)
+                                      for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert client.calls == [PRIMARY]
+    assert len(results) == 5
+
+
+def test_async_text_message_replies_and_records_turn(async_module, db_module, monkeypatch):
+    """
+    Тест проверяет основной путь: контекст и запись хода идут через пул БД,
+    ответ — через AsyncTeleBot, сообщения одного пользователя — по очереди.
+    """
+    db = db_module
+    uid = 44001
+    db.clear_chat_history(uid)
+    replies = []
+    active = []
+
+    async def fake_route_chat(msgs, primary, **kwargs):
+        active.append(1)
+        assert len(active) == 1  # ходы пользователя не пересекаются
+        await asyncio.sleep(0.01)
+        active.pop()
+        return ChatResult(text=f"ответ на {msgs[-1]['content']}", ms=5, model="m",
+                          prompt_tokens=1, completion_tokens=2)
+
+    async def fake_reply_to(message, text, **kwargs):
+        replies.append(text)
+
+    async def fake_chat_action(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(async_module, "route_chat", fake_route_chat)
+    monkeypatch.setattr(async_module.bot, "reply_to", fake_reply_to)
+    monkeypatch.setattr(async_module.bot, "send_chat_action", fake_chat_action)
+
+    def message(text):
+        return SimpleNamespace(text=text, from_user=SimpleNamespace(id=uid), chat=SimpleNamespace(id=uid))
+
+    async def scenario():
+        await asyncio.gather(*(async_module.on_text_message(message(f"вопрос {i}")) for i in range(3)))
+
+    asyncio.run(scenario())
+
+    assert len(replies) == 3
+    assert all(r.startswith("ответ на вопрос") for r in replies)
+    history = db.get_chat_history(uid)
+    assert len(history) == 6
+    assert [h["role"] for h in history] == ["user", "assistant"] * 3
+
+
+def test_route_chat_cancelled_probe_does_not_strand_breaker(async_module):
+    """Тест проверяет, что отменённый пробный запрос освобождает half_open-автомат."""
+    from resilience import HALF_OPEN
+
+    breakers = CircuitBreakers(failure_threshold=1, reset_timeout_s=0)
+    breaker = breakers.get(PRIMARY)
+    breaker.record_failure()
+    router = ModelRouter(breakers=CircuitBreakers())
+    router.chain = lambda primary: [PRIMARY]
+    client = _FakeAsyncClient({PRIMARY: 10.0}, breakers=breakers)
+
+    async def scenario():
+        task = asyncio.create_task(async_module.route_chat(
+            [{"role": "user", "content": "q"}], primary=PRIMARY, router=router, client=client,
+        ))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+
+    assert breaker.state == HALF_OPEN
+    assert breaker.allows_call()
+
+
+def test_async_text_message_replies_when_context_load_fails(async_module, monkeypatch):
+    """Тест проверяет, что ошибка БД при загрузке контекста не оставляет пользователя без ответа."""
+    replies = []
+
+    def broken_context(user_id):
+        raise TimeoutError("пул соединений SQLite исчерпан")
+
+    async def fake_reply_to(message, text, **kwargs):
+        replies.append(text)
+
+    monkeypatch.setattr(async_module.main, "_load_turn_context", broken_context)
+    monkeypatch.setattr(async_module.bot, "reply_to", fake_reply_to)
+
+    message = SimpleNamespace(text="привет", from_user=SimpleNamespace(id=44002), chat=SimpleNamespace(id=1))
+    asyncio.run(async_module.on_text_message(message))
+
+    assert len(replies) == 1
+    assert "Произошла ошибка" in replies[0]
@@ -1,4 +1,6 @@
 # tests/test_messages.py
+import dataclasses
+
 
 def test_build_messages_includes_character_and_rules(db_module, main_module):
     """
@@ -32,4 +34,138 @@ def test_build_messages_includes_character_and_rules(db_module, main_module):
     assert target_char["name"] in system_prompt
     assert target_char["prompt"] in system_prompt
     assert "Правила:" in system_prompt  # Проверяем, что правила на месте
-    assert "Какой-то вопрос" in msgs[1]["content"]
\ No newline at end of file
+    assert "Какой-то вопрос" in msgs[1]["content"]
+
+def test_build_messages_uses_history_as_content(db_module, main_module):
+    """
+    Тест проверяет, что история из контекста хода попадает в промпт
+    в формате OpenRouter (role/content), между system и текущим вопросом.
+    """
+    db = db_module
+    main = main_module
+    uid = 42002
+    db.clear_chat_history(uid)
+    db.add_to_chat_history(uid, "user", "Привет")
+    db.add_to_chat_history(uid, "assistant", "Здравствуй")
+
+    msgs = main._build_messages(uid, "Как дела?")
+
+    assert [m["role"] for m in msgs] == ["system", "user", "assistant", "user"]
+    assert msgs[1] == {"role": "user", "content": "Привет"}
+    assert msgs[2] == {"role": "assistant", "content": "Здравствуй"}
+
+
+def test_build_messages_fits_history_into_token_budget(db_module, main_module):
+    """
+    Тест проверяет, что история берётся от новых сообщений к старым, пока
+    укладывается в бюджет за вычетом промпта и резерва под ответ.
+    """
+    db = db_module
+    main = main_module
+    uid = 42003
+    db.clear_chat_history(uid)
+    for i in range(10):
+        db.add_to_chat_history(uid, "user", f"сообщение {i} " + "x" * 400)
+
+    ctx = main._load_turn_context(uid)
+    assert all(h["tokens"] == db.estimate_tokens(h["message"]) for h in ctx.history)
+    per_message = ctx.history[0]["tokens"]
+    system_tokens = db.estimate_tokens(main._messages_from_context(ctx, "q")[0]["content"])
+    budget = ctx.reply_max_tokens + system_tokens + db.estimate_tokens("q") + per_message * 3 + 1
+    ctx = dataclasses.replace(ctx, context_budget=budget)
+
+    msgs = main._messages_from_context(ctx, "q")
+
+    assert [m["content"][:12] for m in msgs[1:-1]] == ["сообщение 7 ", "сообщение 8 ", "сообщение 9 "]
+    assert msgs[-1] == {"role": "user", "content": "q"}
+
+
+def test_build_messages_prepends_stored_summary(db_module, main_module):
+    """Тест проверяет, что резюме свёрнутой части идёт в промпт вместо старых сообщений."""
+    db = db_module
+    main = main_module
+    uid = 42004
+    db.clear_chat_history(uid)
+    db.record_turn(uid, "старый вопрос", "старый ответ")
+    _, history = db.get_unsummarized_history(uid)
+    db.save_chat_summary(uid, "говорили о погоде", history[-1]["id"])
+    db.record_turn(uid, "новый вопрос", "новый ответ")
+
+    msgs = main._build_messages(uid, "q")
+
+    assert [m["role"] for m in msgs] == ["system", "system", "user", "assistant", "user"]
+    assert "говорили о погоде" in msgs[1]["content"]
+    assert "старый вопрос" not in str(msgs)
+
+
+def test_estimate_tokens_counts_cyrillic_denser():
+    from db import estimate_tokens, TOKENS_PER_MESSAGE
+    assert estimate_tokens("") == TOKENS_PER_MESSAGE
+    assert estimate_tokens("abcd" * 10) == TOKENS_PER_MESSAGE + 10
+    assert estimate_tokens("абвг" * 10) == TOKENS_PER_MESSAGE + 20
+
+
+def test_streaming_reply_edits_placeholder(db_module, main_module, monkeypatch):
+    """
+    В потоковом режиме бот отправляет заглушку, правит её не чаще заданного
+    интервала, а в конце пишет итоговый текст и сохраняет ход в историю.
+    """
+    from types import SimpleNamespace
+
+    db = db_module
+    main = main_module
+    uid = 42006
+    db.clear_chat_history(uid)
+    db.set_feature_toggle("stream_replies", True)
+
+    class FakeStream:
+        def __init__(self):
+            self.text = ""
+
+        def __iter__(self):
+            for part in ["Раз", ", два", ", три"]:
+                self.text += part
+                yield part
+
+        def result(self):
+            return main.ChatResult(text=self.text, ms=5, model="m", prompt_tokens=1, completion_tokens=3)
+
+    edits = []
+    placeholder = SimpleNamespace(chat=SimpleNamespace(id=1), message_id=77)
+    monkeypatch.setattr(main, "chat_stream", lambda *a, **kw: FakeStream())
+    monkeypatch.setattr(main, "STREAM_EDIT_INTERVAL_S", 0)
+    monkeypatch.setattr(main.bot, "reply_to", lambda *a, **kw: placeholder)
+    monkeypatch.setattr(main.bot, "edit_message_text",
+                        lambda text, chat_id, message_id, parse_mode=None: edits.append((text, parse_mode)))
+
+    message = SimpleNamespace(text="Считай", from_user=SimpleNamespace(id=uid), chat=SimpleNamespace(id=1))
+    try:
+        main.on_text_message(message)
+    finally:
+        db.set_feature_toggle("stream_replies", False)
+
+    assert edits[0] == ("Раз …", None)
+    assert edits[-1][0].startswith("Раз, два, три")
+    assert edits[-1][1] == "Markdown"
+    history = db.get_chat_history(uid)
+    assert [h["message"] for h in history][-2:] == ["Считай", "Раз, два, три"]
+
+
+def test_text_message_replies_when_context_load_fails(main_module, monkeypatch):
+    """Тест проверяет, что ошибка БД при загрузке контекста не оставляет пользователя без ответа."""
+    from types import SimpleNamespace
+
+    main = main_module
+    replies = []
+
+    def broken_context(user_id):
+        raise TimeoutError("пул соединений SQLite исчерпан")
+
+    monkeypatch.setattr(main, "_load_turn_context", broken_context)
+    monkeypatch.setattr(main.bot, "reply_to", lambda message, text, **kw: replies.append(text))
+
+    message = SimpleNamespace(text="привет", from_user=SimpleNamespace(id=42005), chat=SimpleNamespace(id=1))
+    main.on_text_message(message)
+
+    assert len(replies) == 1
+    assert "Произошла ошибка" in replies[0]
@@ -0,0 +1,84 @@
+# tests/test_migrations.py
+import sqlite3
+
+
+def test_init_db_sets_schema_version(db_module):
+    """Тест проверяет, что после init_db схема на последней версии."""
+    db = db_module
+    with db._connect() as conn:
+        assert db._schema_version(conn) == db.SCHEMA_VERSION
+
+
+def test_migrate_legacy_database(tmp_path, monkeypatch):
+    """
+    Тест проверяет обновление базы, созданной до появления миграций
+    (user_version = 0, старая chat_history без новых колонок): данные сохраняются.
+    """
+    import db
+    path = str(tmp_path / "legacy.db")
+    legacy = sqlite3.connect(path)
+    legacy.executescript("""
+        CREATE TABLE chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        INSERT INTO chat_history(user_id, role, message) VALUES (1, 'user', 'старое сообщение');
+    """)
+    legacy.close()
+
+    monkeypatch.setattr(db, "DB_PATH", path)
+    db.init_db()
+
+    assert db.get_chat_history(1) == [{"role": "user", "message": "старое сообщение"}]
+    with db._connect() as conn:
+        assert db._schema_version(conn) == db.SCHEMA_VERSION
+        columns = {r["name"] for r in conn.execute("PRAGMA table_info(chat_history)")}
+        # Оценка токенов посчитана и для старых строк
+        estimate = conn.execute("SELECT token_estimate FROM chat_history").fetchone()[0]
+    assert {"model_key", "latency_ms", "prompt_tokens", "completion_tokens", "token_estimate"} <= columns
+    assert estimate == db.estimate_tokens("старое сообщение")
+    # Повторный запуск ничего не ломает
+    db.init_db()
+    db.close_all()
+
+
+def test_hot_queries_use_indexes(db_module):
+    """
+    Регрессионный тест EXPLAIN QUERY PLAN: все запросы к chat_history и notes
+    из "горячих" функций должны искать по индексу, а не сканировать таблицу.
+    """
+    db = db_module
+    uid = 8008
+    note_id = db.add_note(uid, "для плана запроса")
+    db.add_to_chat_history(uid, "user", "для плана запроса")
+
+    statements = []
+    with db._connect() as conn:
+        # Вложенные вызовы db.* в этом потоке идут через это же соединение
+        conn.set_trace_callback(statements.append)
+        try:
+            db.get_chat_history(uid)
+            db.load_turn_context(uid)
+            db.list_notes(uid)
+            db.find_notes(uid, "план")
+            db.get_note_by_id(uid, note_id)
+            db.update_note(uid, note_id, "для плана запроса")
+            db.delete_note(uid, note_id)
+            db.clear_chat_history(uid)
+        finally:
+            conn.set_trace_callback(None)
+
+        # Строки "-- TRIGGER ..." — это срабатывания триггеров, а не запросы
+        hot = [s for s in statements
+               if ("chat_history" in s or "notes" in s) and not s.lstrip().startswith("--")]
+        assert hot, "Не удалось перехватить запросы"
+        for sql in hot:
+            plan = [r["detail"] for r in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+            if "MATCH" in sql:
+                # Полнотекстовый поиск: FTS-индекс + сортировка найденного по bm25
+                assert any("VIRTUAL TABLE INDEX" in d for d in plan), f"{sql.strip()} -> {plan}"
+                plan = [d for d in plan if "VIRTUAL TABLE INDEX" not in d and "TEMP B-TREE" not in d]
+            assert plan and all(d.startswith("SEARCH") for d in plan), f"{sql.strip()} -> {plan}"
@@ -0,0 +1,85 @@
+# tests/test_model_router.py
+import time
+
+import pytest
+
+from model_router import ModelRouter
+from openrouter_client import ChatResult, OpenRouterError
+from resilience import CircuitBreakers
+
+PRIMARY = "mistralai/mistral-7b-instruct:free"
+BACKUP = "anthropic/claude-3-haiku"
+
+
+def _fake_chat(behaviour: dict, calls: list):
+    """chat_fn, который по ключу модели либо бросает ошибку, либо отвечает (с задержкой)."""
+    def chat_fn(msgs, model, **kwargs):
+        calls.append(model)
+        action = behaviour[model]
+        if isinstance(action, Exception):
+            raise action
+        time.sleep(action)
+        return ChatResult(text=f"ответ {model}", ms=max(int(action * 1000), 1), model=model)
+    return chat_fn
+
+
+def test_router_falls_back_on_rate_limit_but_not_on_client_error(db_module):
+    calls = []
+    router = ModelRouter(chat_fn=_fake_chat({PRIMARY: OpenRouterError("лимит", 429), BACKUP: 0}, calls),
+                         breakers=CircuitBreakers())
+    result = router.chat([{"role": "user", "content": "q"}], primary=PRIMARY)
+    assert result.model == BACKUP
+    assert calls == [PRIMARY, BACKUP]
+    assert router.snapshot()[PRIMARY]["error_rate"] == 1.0
+
+    calls.clear()
+    router = ModelRouter(chat_fn=_fake_chat({PRIMARY: OpenRouterError("плохой запрос", 400), BACKUP: 0}, calls),
+                         breakers=CircuitBreakers())
+    with pytest.raises(OpenRouterError):
+        router.chat([{"role": "user", "content": "q"}], primary=PRIMARY)
+    assert calls == [PRIMARY]
+
+
+def test_router_prefers_healthier_model_and_skips_open_breaker(db_module):
+    breakers = CircuitBreakers(failure_threshold=1, reset_timeout_s=60)
+    router = ModelRouter(chat_fn=lambda *a, **kw: None, breakers=breakers)
+    chain = router.chain(PRIMARY)
+    assert chain[:2] == [PRIMARY, BACKUP]
+    assert router.order(chain)[0] == PRIMARY  # статистики нет — остаётся активная
+
+    for _ in range(10):
+        router.observe(PRIMARY, True, 4000)
+        router.observe(BACKUP, True, 500)
+    assert router.order(chain)[0] == BACKUP
+
+    breakers.get(BACKUP).record_failure()
+    assert BACKUP not in router.order(chain)
+
+
+def test_router_hedges_slow_primary(db_module):
+    calls = []
+    router = ModelRouter(chat_fn=_fake_chat({PRIMARY: 1.0, BACKUP: 0}, calls), breakers=CircuitBreakers(),
+                         hedge=True, hedge_min_delay_ms=50)
+    for _ in range(10):
+        router.observe(PRIMARY, True, 60)
+        router.observe(BACKUP, True, 100)
+
+    t0 = time.perf_counter()
+    result = router.chat([{"role": "user", "content": "q"}], primary=PRIMARY)
+    assert result.model == BACKUP
+    assert time.perf_counter() - t0 < 0.8
+    assert calls == [PRIMARY, BACKUP]
+
+
+def test_router_hedge_falls_back_when_primary_fails_fast(db_module):
+    """Тест проверяет, что быстрая ошибка первой модели при hedging не теряет вторую."""
+    calls = []
+    router = ModelRouter(chat_fn=_fake_chat({PRIMARY: OpenRouterError("перегружен", 503), BACKUP: 0}, calls),
+                         breakers=CircuitBreakers(), hedge=True, hedge_min_delay_ms=500)
+    for _ in range(10):
+        router.observe(PRIMARY, True, 600)
+        router.observe(BACKUP, True, 700)
+
+    result = router.chat([{"role": "user", "content": "q"}], primary=PRIMARY)
+    assert result.model == BACKUP
+    assert calls == [PRIMARY, BACKUP]
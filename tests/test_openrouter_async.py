@@ -0,0 +1,108 @@
+# tests/test_openrouter_async.py
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+from openrouter_async import AsyncOpenRouterClient
+from openrouter_client import OpenRouterError
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Заглушка OpenRouter: /ok — ответ (с задержкой ?delay=сек), /503 и /429 — ошибки."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        path, _, query = self.path.partition("?")
+        if query.startswith("delay="):
+            time.sleep(float(query[6:]))
+        if path in ("/503", "/429"):
+            status, payload = int(path[1:]), b"{}"
+        else:
+            status = 200
+            payload = json.dumps({
+                "choices": [{"message": {"content": f" {body['messages'][-1]['content']} "}}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1},
+            }).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if status == 429:
+            self.send_header("Retry-After", "7")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def stub_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def _client(url: str) -> AsyncOpenRouterClient:
+    return AsyncOpenRouterClient(api_key="test-key", url=url, read_timeout=5)
+
+
+def test_async_client_concurrent_calls_share_one_loop(stub_url):
+    """Десятки медленных запросов идут параллельно в одном event loop."""
+    async def scenario():
+        client = _client(f"{stub_url}/ok?delay=0.3")
+        try:
+            t0 = time.perf_counter()
+            results = await asyncio.gather(*(client.chat([{"role": "user", "content": f"q{i}"}], "m")
+                                             for i in range(40)))
+            return results, time.perf_counter() - t0
+        finally:
+            await client.aclose()
+
+    results, elapsed = asyncio.run(scenario())
+    assert [r.text for r in results] == [f"q{i}" for i in range(40)]
+    assert results[0].prompt_tokens == 1
+    # Последовательно это заняло бы 12 с
+    assert elapsed < 3
+
+
+def _chat_error(url: str, **kwargs) -> OpenRouterError:
+    async def scenario():
+        client = _client(url)
+        try:
+            await client.chat([{"role": "user", "content": "ping"}], "m", **kwargs)
+        finally:
+            await client.aclose()
+
+    with pytest.raises(OpenRouterError) as excinfo:
+        asyncio.run(scenario())
+    return excinfo.value
+
+
+def test_async_client_maps_http_errors(stub_url):
+    error = _chat_error(f"{stub_url}/503")
+    assert error.status_code == 503
+    assert "перегружен" in str(error)
+
+
+def test_async_client_passes_retry_after(stub_url):
+    """Retry-After из 429 доходит до ретраев и circuit breaker'а, как в синхронном клиенте."""
+    error = _chat_error(f"{stub_url}/429")
+    assert error.status_code == 429
+    assert error.retry_after == 7
+
+
+def test_async_client_cancels_on_timeout(stub_url):
+    t0 = time.perf_counter()
+    error = _chat_error(f"{stub_url}/ok?delay=2", timeout_s=0.2)
+    assert "нет ответа" in str(error)
+    assert time.perf_counter() - t0 < 1.5
@@ -1,7 +1,10 @@
 import pytest
 import responses  # Библиотека для мокирования сетевых запросов
 import json
-from openrouter_client import chat_once, OpenRouterError
+import threading
+import time
+from openrouter_client import chat_once, OpenRouterError, OpenRouterClient, SingleFlight, build_payload, is_transient
+from metrics import metric
 
 
 # Используем декоратор, который "перехватывает" все HTTP-запросы
@@ -63,4 +66,197 @@ def test_chat_once_success():
 
         # 3. Проверяем текст ошибки и статус-код
         assert "Сервер OpenRouter перегружен" in str(excinfo.value)
-        assert excinfo.value.status_code == 503
\ No newline at end of file
+        assert excinfo.value.status_code == 503
+
+
+@responses.activate
+def test_client_reuses_session_and_sends_prebuilt_body():
+    """Клиент шлёт заранее сериализованное тело через одну сессию с общими заголовками."""
+    mock_url = "https://openrouter.ai/api/v1/chat/completions"
+    payload = {"choices": [{"message": {"content": " ok "}}], "usage": {"prompt_tokens": 3, "completion_tokens": 1}}
+    responses.add(responses.POST, mock_url, json=payload, status=200)
+
+    client = OpenRouterClient(api_key="test-key", pool_size=2, connect_timeout=1, read_timeout=2)
+    body = build_payload([{"role": "user", "content": "привет"}], "test-model:free")
+    first = client.send(body, "test-model:free")
+    second = client.chat([{"role": "user", "content": "привет"}], "test-model:free")
+    client.close()
+
+    assert first.text == second.text == "ok"
+    assert first.prompt_tokens == 3 and first.completion_tokens == 1
+    sent = responses.calls[0].request
+    assert sent.headers["Authorization"] == "Bearer test-key"
+    assert sent.body == body == responses.calls[1].request.body
+    assert json.loads(sent.body)["messages"][0]["content"] == "привет"
+
+
+def test_client_without_key_raises_401():
+    with pytest.raises(OpenRouterError) as excinfo:
+        OpenRouterClient(api_key=None).chat([{"role": "user", "content": "ping"}], "m")
+    assert excinfo.value.status_code == 401
+
+
+@responses.activate
+def test_client_stream_parses_sse_chunks():
+    """Поток SSE разбирается по фрагментам; usage из последнего события попадает в результат."""
+    mock_url = "https://openrouter.ai/api/v1/chat/completions"
+    events = [
+        ": OPENROUTER PROCESSING",
+        'data: {"choices":[{"delta":{"role":"assistant"}}]}',
+        'data: {"choices":[{"delta":{"content":"При"}}]}',
+        'data: {"choices":[{"delta":{"content":"вет"}}]}',
+        'data: {"choices":[],"usage":{"prompt_tokens":5,"completion_tokens":2}}',
+        "data: [DONE]",
+    ]
+    body = "\n\n".join(events) + "\n\n"
+    responses.add(responses.POST, mock_url, body=body.encode(), status=200, content_type="text/event-stream")
+    ttft_before = metric.latency("llm_ttft_ms").count
+
+    client = OpenRouterClient(api_key="test-key")
+    stream = client.stream([{"role": "user", "content": "ping"}], "test-model:free")
+    chunks = list(stream)
+    result = stream.result()
+
+    assert chunks == ["При", "вет"]
+    assert result.text == "Привет"
+    assert (result.prompt_tokens, result.completion_tokens) == (5, 2)
+    assert stream.ttft_ms is not None
+    assert metric.latency("llm_ttft_ms").count == ttft_before + 1
+    assert json.loads(responses.calls[0].request.body)["stream"] is True
+
+
+@responses.activate
+def test_client_stream_raises_on_http_error():
+    responses.add(responses.POST, "https://openrouter.ai/api/v1/chat/completions", status=429)
+    client = OpenRouterClient(api_key="test-key")
+    with pytest.raises(OpenRouterError) as excinfo:
+        list(client.stream([{"role": "user", "content": "ping"}], "m"))
+    assert excinfo.value.status_code == 429
+
+
+@responses.activate
+def test_client_stream_error_event_with_string_code_is_transient():
+    """Ошибка внутри потока со строковым кодом не ломает is_transient: её можно повторить."""
+    mock_url = "https://openrouter.ai/api/v1/chat/completions"
+    cases = [('"rate_limit_exceeded"', None), ('"502"', 502), ("400", 400)]
+    for code, _ in cases:
+        responses.add(responses.POST, mock_url, status=200, content_type="text/event-stream",
+                      body=f'data: {{"error":{{"code":{code},"message":"сбой"}}}}\n\n'.encode())
+
+    client = OpenRouterClient(api_key="test-key")
+    for _, status in cases:
+        with pytest.raises(OpenRouterError) as excinfo:
+            list(client.stream([{"role": "user", "content": "ping"}], "m"))
+        assert excinfo.value.status_code == status
+        assert is_transient(excinfo.value) == (status != 400)
+
+
+def _run_concurrently(n: int, fn) -> list:
+    """Запускает fn() в n потоках одновременно; возвращает результаты или исключения."""
+    barrier = threading.Barrier(n)
+    out = [None] * n
+
+    def worker(i):
+        barrier.wait()
+        try:
+            out[i] = fn()
+        except Exception as e:
+            out[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return out
+
+
+@responses.activate
+def test_single_flight_coalesces_identical_requests():
+    """Пять одинаковых одновременных запросов — один поход в API, ответ у всех."""
+    def slow_reply(request):
+        time.sleep(0.3)
+        return 200, {}, json.dumps({"choices": [{"message": {"content": "общий ответ"}}]})
+
+    responses.add_callback(responses.POST, "https://openrouter.ai/api/v1/chat/completions", callback=slow_reply)
+    client = OpenRouterClient(api_key="test-key", single_flight=SingleFlight())
+    msgs = [{"role": "user", "content": "что нового?"}]
+
+    results = _run_concurrently(5, lambda: client.chat(msgs, "m"))
+
+    assert [r.text for r in results] == ["общий ответ"] * 5
+    assert len(responses.calls) == 1
+    assert len(client.single_flight) == 0
+
+
+def _wait_until(predicate, timeout_s: float = 2.0) -> None:
+    deadline = time.monotonic() + timeout_s
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_single_flight_propagates_errors_and_times_out():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def failing_leader():
+        release.wait(2)
+        raise OpenRouterError("Сервер OpenRouter перегружен", status_code=503)
+
+    leader = threading.Thread(target=lambda: pytest.raises(OpenRouterError, flight.do, "k", failing_leader, 2))
+    leader.start()
+    _wait_until(lambda: len(flight) == 1)
+    shared_before = metric.counter("llm_singleflight_shared_total").get()
+
+    def release_when_followers_wait():
+        _wait_until(lambda: metric.counter("llm_singleflight_shared_total").get() >= shared_before + 3)
+        release.set()
+
+    releaser = threading.Thread(target=release_when_followers_wait)
+    releaser.start()
+    errors = _run_concurrently(3, lambda: flight.do("k", lambda: "не ведущий", 2))
+    leader.join()
+    releaser.join()
+    assert all(isinstance(e, OpenRouterError) and e.status_code == 503 for e in errors)
+
+    stuck = threading.Thread(target=flight.do, args=("slow", lambda: time.sleep(0.5), 1))
+    stuck.start()
+    _wait_until(lambda: len(flight) == 1)
+    with pytest.raises(OpenRouterError, match="нет ответа"):
+        flight.do("slow", lambda: None, timeout_s=0.1)
+    stuck.join()
+
+
+def test_single_flight_followers_keep_error_type_and_retry_after():
+    """Тест проверяет, что ожидающие получают ошибку того же класса и с тем же retry_after, что ведущий."""
+    from openrouter_client import ModelUnavailableError
+
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def failing_leader():
+        release.wait(2)
+        raise ModelUnavailableError("Модель временно недоступна", status_code=503, retry_after=7)
+
+    leader = threading.Thread(target=lambda: pytest.raises(ModelUnavailableError, flight.do, "k", failing_leader, 2))
+    leader.start()
+    _wait_until(lambda: len(flight) == 1)
+    shared_before = metric.counter("llm_singleflight_shared_total").get()
+    follower_errors = []
+
+    def follower():
+        try:
+            flight.do("k", lambda: "не ведущий", 2)
+        except OpenRouterError as e:
+            follower_errors.append(e)
+
+    t = threading.Thread(target=follower)
+    t.start()
+    _wait_until(lambda: metric.counter("llm_singleflight_shared_total").get() >= shared_before + 1)
+    release.set()
+    leader.join()
+    t.join()
+
+    (error,) = follower_errors
+    assert isinstance(error, ModelUnavailableError)
+    assert (error.status_code, error.retry_after) == (503, 7)
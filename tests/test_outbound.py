@@ -0,0 +1,164 @@
+# tests/test_outbound.py
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+from metrics import metric
+from outbound import BULK, INTERACTIVE, OutboundQueue, install, install_async
+
+
+def _too_many_requests(retry_after: float) -> ApiTelegramException:
+    return ApiTelegramException("sendMessage", None, {
+        "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": retry_after},
+    })
+
+
+def test_per_chat_limit_keeps_order_and_spaces_sends():
+    sent = []
+    outbound = OutboundQueue(global_rps=1000, chat_rps=10, chat_burst=1, workers=4).start()
+    try:
+        t0 = time.perf_counter()
+        futures = [outbound.submit("a", lambda i=i: sent.append((i, time.perf_counter())) or i) for i in range(5)]
+        assert [f.result(5) for f in futures] == [0, 1, 2, 3, 4]
+    finally:
+        outbound.stop()
+
+    assert [i for i, _ in sent] == [0, 1, 2, 3, 4]
+    # Ведро чата: 10 сообщений/с без запаса — пять отправок занимают не меньше 0,4 с
+    assert sent[-1][1] - t0 >= 0.35
+
+
+def test_interactive_replies_overtake_broadcast():
+    """
+    Тест проверяет приоритет: пока идёт рассылка, ответ пользователю уходит
+    раньше оставшихся сообщений рассылки.
+    """
+    order = []
+    started, gate = threading.Event(), threading.Event()
+    outbound = OutboundQueue(global_rps=1000, workers=1).start()
+    try:
+        first = outbound.submit(0, lambda: started.set() or gate.wait(5) and order.append("bulk-0"), BULK)
+        # Единственный поток отправки занят первым сообщением рассылки
+        assert started.wait(5)
+        rest = [outbound.submit(i, lambda i=i: order.append(f"bulk-{i}"), BULK) for i in range(1, 4)]
+        reply = outbound.submit(100, lambda: order.append("reply"), INTERACTIVE)
+        gate.set()
+        for f in [first, *rest, reply]:
+            f.result(5)
+    finally:
+        outbound.stop()
+
+    assert order == ["bulk-0", "reply", "bulk-1", "bulk-2", "bulk-3"]
+
+
+def test_retries_after_429_without_reordering_chat():
+    calls = []
+    failed = []
+    before = metric.counter("outbound_429_total").get()
+
+    def flaky():
+        calls.append(("first", time.perf_counter()))
+        if not failed:
+            failed.append(True)
+            raise _too_many_requests(0.2)
+        return "ok"
+
+    outbound = OutboundQueue(global_rps=1000, chat_burst=5, workers=2).start()
+    try:
+        t0 = time.perf_counter()
+        first = outbound.submit("c", flaky)
+        second = outbound.submit("c", lambda: calls.append(("second", time.perf_counter())) or "ok2")
+        assert first.result(5) == "ok"
+        assert second.result(5) == "ok2"
+    finally:
+        outbound.stop()
+
+    assert [name for name, _ in calls] == ["first", "first", "second"]
+    # Повтор выждал retry_after
+    assert calls[1][1] - t0 >= 0.2
+    assert metric.counter("outbound_429_total").get() == before + 1
+
+
+def test_install_routes_bot_sends_through_queue():
+    threads = []
+
+    class FakeBot:
+        def send_message(self, chat_id, text, **kwargs):
+            threads.append(threading.current_thread().name)
+            return f"{chat_id}:{text}"
+
+        def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+            threads.append(threading.current_thread().name)
+            return f"edit {chat_id}:{text}"
+
+        # Остальные методы отправки обёртка не вызывает
+        send_photo = send_document = copy_message = forward_message = send_message
+
+    bot = FakeBot()
+    outbound = install(bot, OutboundQueue(global_rps=1000, workers=2))
+    try:
+        assert bot.send_message(5, "привет") == "5:привет"
+        assert bot.edit_message_text("правка", chat_id=5, message_id=1) == "edit 5:правка"
+        future = bot.send_message(6, "рассылка", priority=BULK, wait=False)
+        assert isinstance(future, Future)
+        assert future.result(5) == "6:рассылка"
+        # Правка inline-сообщения без чата идёт напрямую
+        assert bot.edit_message_text("inline", inline_message_id="x") == "edit None:inline"
+    finally:
+        outbound.stop()
+
+    assert all(name.startswith("outbound-") for name in threads[:3])
+    assert threads[3] == threading.current_thread().name
+
+
+def test_install_async_routes_coroutine_sends_through_queue():
+    """
+    Тест проверяет, что отправки AsyncTeleBot идут через очередь: 429
+    асинхронного клиента повторяется, а event loop при этом не блокируется.
+    """
+    asyncio_helper = pytest.importorskip("telebot.asyncio_helper")
+    sent = []
+
+    class FakeAsyncBot:
+        async def send_message(self, chat_id, text, **kwargs):
+            if not sent:
+                sent.append("429")
+                raise asyncio_helper.ApiTelegramException("sendMessage", None, {
+                    "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 0.05},
+                })
+            sent.append(text)
+            return f"{chat_id}:{text}"
+
+        send_photo = send_document = copy_message = forward_message = send_message
+
+        async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+            return text
+
+    bot = FakeAsyncBot()
+    outbound = install_async(bot, OutboundQueue(global_rps=1000, workers=2))
+    before = metric.counter("outbound_429_total").get()
+
+    async def scenario():
+        ticks = []
+
+        async def ticker():
+            for _ in range(3):
+                ticks.append(1)
+                await asyncio.sleep(0.01)
+
+        reply, _ = await asyncio.gather(bot.send_message(7, "привет"), ticker())
+        return reply, ticks
+
+    try:
+        reply, ticks = asyncio.run(scenario())
+    finally:
+        outbound.stop()
+
+    assert reply == "7:привет"
+    assert sent == ["429", "привет"]
+    assert len(ticks) == 3
+    assert metric.counter("outbound_429_total").get() == before + 1
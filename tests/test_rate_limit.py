@@ -0,0 +1,108 @@
+# tests/test_rate_limit.py
+import threading
+import time
+
+import pytest
+
+from model_router import ModelRouter
+from openrouter_client import ChatResult
+from rate_limit import FairQueue, RateLimited, RateLimiter, TokenBucket
+from resilience import CircuitBreakers
+
+PRIMARY = "mistralai/mistral-7b-instruct:free"
+BACKUP = "anthropic/claude-3-haiku"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_refills_up_to_burst():
+    clock = FakeClock()
+    bucket = TokenBucket(rate_per_s=2, burst=2, clock=clock)
+    assert bucket.try_acquire() and bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert bucket.time_until(1) == pytest.approx(0.5)
+    clock.now += 10
+    assert bucket.time_until(2) == 0
+    assert bucket.try_acquire(2) and not bucket.try_acquire()
+
+
+def test_fair_queue_serves_users_round_robin():
+    """Запросы второго пользователя не ждут, пока обслужат всю очередь первого."""
+    queue = FairQueue("m", TokenBucket(rate_per_s=20, burst=1))
+    served = []
+
+    def request(user, label):
+        queue.acquire(user, time.monotonic() + 5)
+        served.append(label)
+
+    queue.acquire("A", time.monotonic() + 5)  # забираем единственный токен
+    threads = [threading.Thread(target=request, args=("A", f"A{i}")) for i in range(4)]
+    for t in threads:
+        t.start()
+    deadline = time.monotonic() + 2
+    while queue.depth() < 4 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    b = threading.Thread(target=request, args=("B", "B"))
+    b.start()
+    for t in threads + [b]:
+        t.join()
+    assert served.index("B") <= 1
+
+
+def test_fair_queue_rejects_immediately_when_deadline_is_unreachable():
+    queue = FairQueue("m", TokenBucket(rate_per_s=1 / 60, burst=1))
+    queue.acquire("A", time.monotonic() + 1)
+    t0 = time.monotonic()
+    with pytest.raises(RateLimited) as excinfo:
+        queue.acquire("B", time.monotonic() + 1)
+    assert time.monotonic() - t0 < 0.5
+    assert excinfo.value.retry_after > 50
+    assert queue.depth() == 0
+
+
+def test_router_skips_exhausted_model_and_limits_chatty_user(db_module):
+    calls = []
+
+    def chat_fn(msgs, model, **kwargs):
+        calls.append(model)
+        return ChatResult(text="ok", ms=1, model=model)
+
+    limiter = RateLimiter(model_rpm=1, model_burst=1, user_rpm=1, user_burst=2, max_wait_s=0.5)
+    router = ModelRouter(chat_fn=chat_fn, breakers=CircuitBreakers(), limiter=limiter)
+    msgs = [{"role": "user", "content": "q"}]
+
+    assert router.chat(msgs, primary=PRIMARY, user_id=1).model == PRIMARY
+    # Квота первой модели исчерпана — ответ от запасной
+    assert router.chat(msgs, primary=PRIMARY, user_id=2).model == BACKUP
+    # Обе модели исчерпаны — сразу RateLimited, в API ничего не уходит
+    with pytest.raises(RateLimited):
+        router.chat(msgs, primary=PRIMARY, user_id=3)
+    assert calls == [PRIMARY, BACKUP]
+
+    # Второй запрос пользователя 1 прошёл бы по его лимиту, третий — уже нет
+    limiter_user = RateLimiter(model_rpm=600, model_burst=10, user_rpm=1, user_burst=2, max_wait_s=0.5)
+    router = ModelRouter(chat_fn=chat_fn, breakers=CircuitBreakers(), limiter=limiter_user)
+    router.chat(msgs, primary=PRIMARY, user_id=1)
+    router.chat(msgs, primary=PRIMARY, user_id=1)
+    with pytest.raises(RateLimited) as excinfo:
+        router.chat(msgs, primary=PRIMARY, user_id=1)
+    assert excinfo.value.scope == "пользователь"
+    router.chat(msgs, primary=PRIMARY, user_id=2)
+
+
+def test_admit_refunds_user_token_when_model_is_exhausted(db_module):
+    limiter = RateLimiter(model_rpm=1, model_burst=1, user_rpm=1, user_burst=1, max_wait_s=0.1)
+    router = ModelRouter(chat_fn=lambda *a, **k: None, breakers=CircuitBreakers(), limiter=limiter)
+    router.admit(PRIMARY, user_id=1)
+
+    with pytest.raises(RateLimited) as excinfo:
+        router.admit(PRIMARY, user_id=2)
+    assert excinfo.value.scope == PRIMARY
+    # Токен пользователя 2 вернулся: запрос к другой модели проходит
+    router.admit(BACKUP, user_id=2)
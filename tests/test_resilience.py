@@ -0,0 +1,120 @@
+# tests/test_resilience.py
+import random
+
+import pytest
+import responses
+
+from metrics import metric
+from openrouter_client import ModelUnavailableError, OpenRouterClient, OpenRouterError
+from resilience import (
+    CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers, CircuitOpenError, RetryPolicy, parse_retry_after,
+)
+
+MOCK_URL = "https://openrouter.ai/api/v1/chat/completions"
+OK_PAYLOAD = {"choices": [{"message": {"content": "ok"}}]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_parse_retry_after_seconds_and_date():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0  # дата в прошлом
+    assert parse_retry_after("garbage") is None
+
+
+def test_decorrelated_jitter_stays_within_bounds():
+    policy = RetryPolicy(base_delay_s=0.5, max_delay_s=4, rnd=random.Random(1))
+    prev = None
+    for _ in range(50):
+        delay = policy.next_delay(prev)
+        assert 0.5 <= delay <= 4
+        assert delay <= max(0.5, (prev or 0.5) * 3)
+        prev = delay
+    assert policy.next_delay(prev, retry_after=7) == 7
+
+
+def test_breaker_opens_sheds_and_recovers_via_half_open_probe():
+    clock = FakeClock()
+    breaker = CircuitBreaker("m", failure_threshold=2, reset_timeout_s=10, clock=clock)
+    shed_before = metric.counter("llm_breaker_shed_total").get()
+
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert metric.counter("llm_breaker_shed_total").get() == shed_before + 1
+
+    clock.now = 11
+    breaker.before_call()  # пробный вызов
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # второй одновременный — отклонён
+    breaker.record_failure()
+    assert breaker.state == OPEN
+
+    clock.now = 22
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+@responses.activate
+def test_client_retries_transient_errors_honoring_retry_after():
+    responses.add(responses.POST, MOCK_URL, status=429, headers={"Retry-After": "2"})
+    responses.add(responses.POST, MOCK_URL, status=502)
+    responses.add(responses.POST, MOCK_URL, json=OK_PAYLOAD, status=200)
+    sleeps = []
+    client = OpenRouterClient(api_key="k", retry=RetryPolicy(max_attempts=3, base_delay_s=0.1, sleep=sleeps.append))
+    retries_before = metric.counter("llm_retries_total").get()
+
+    assert client.chat([{"role": "user", "content": "hi"}], "m").text == "ok"
+    assert len(responses.calls) == 3
+    assert sleeps[0] == 2.0 and 0.1 <= sleeps[1] <= 6.0
+    assert metric.counter("llm_retries_total").get() == retries_before + 2
+
+
+@responses.activate
+def test_client_does_not_retry_client_errors_and_fails_fast_when_open():
+    responses.add(responses.POST, MOCK_URL, status=400)
+    client = OpenRouterClient(api_key="k", retry=RetryPolicy(max_attempts=3, sleep=lambda s: None),
+                              breakers=CircuitBreakers(failure_threshold=1, reset_timeout_s=60))
+    with pytest.raises(OpenRouterError) as excinfo:
+        client.chat([{"role": "user", "content": "hi"}], "m")
+    assert excinfo.value.status_code == 400 and len(responses.calls) == 1
+    assert client.breakers.get("m").state == CLOSED  # 400 — не сбой модели
+
+    responses.replace(responses.POST, MOCK_URL, status=503)
+    with pytest.raises(ModelUnavailableError):
+        client.chat([{"role": "user", "content": "again"}], "m")
+    # Первая попытка — 503 и размыкание, повтор отклонён без обращения к API
+    assert len(responses.calls) == 2
+    assert client.breakers.states() == {"m": OPEN}
+
+
+def test_breaker_guard_releases_probe_on_exit_without_outcome():
+    """
+    Тест проверяет, что пробный вызов, прерванный без исхода (отмена задачи,
+    KeyboardInterrupt), не оставляет цепь навсегда в half_open.
+    """
+    clock = FakeClock()
+    breaker = CircuitBreaker("m", failure_threshold=1, reset_timeout_s=10, clock=clock)
+    breaker.record_failure()
+    clock.now = 11
+
+    with pytest.raises(KeyboardInterrupt):
+        breaker.call(lambda: (_ for _ in ()).throw(KeyboardInterrupt()), is_failure=lambda e: True)
+    assert breaker.state == HALF_OPEN
+    assert breaker.allows_call()
+
+    with breaker.guard(is_failure=lambda e: True):
+        pass
+    assert breaker.state == CLOSED
@@ -0,0 +1,125 @@
+# tests/test_summarizer.py
+from openrouter_client import ChatResult
+from summarizer import Summarizer
+
+
+class _FakeChat:
+    """Запоминает промпты свёртки и отвечает пронумерованным резюме."""
+
+    def __init__(self):
+        self.prompts = []
+
+    def __call__(self, msgs, primary, **kwargs):
+        self.prompts.append(msgs[-1]["content"])
+        return ChatResult(text=f"резюме {len(self.prompts)}", ms=1, model=primary,
+                          prompt_tokens=1, completion_tokens=1)
+
+
+def _add_turns(db, uid, start, count):
+    for i in range(start, start + count):
+        db.record_turn(uid, f"вопрос {i}", f"ответ {i}")
+
+
+def test_fold_summarizes_old_turns_incrementally(db_module):
+    """
+    Тест проверяет, что свёртка оставляет последние сообщения как есть,
+    а вторая свёртка получает прежнее резюме и только новые ходы.
+    """
+    db = db_module
+    uid = 43001
+    chat = _FakeChat()
+    summarizer = Summarizer(chat_fn=chat, trigger_tokens=20, keep_rows=2)
+    _add_turns(db, uid, 0, 4)
+
+    assert summarizer.fold(uid, "m")
+    summary, history = db.get_unsummarized_history(uid)
+    assert summary["summary"] == "резюме 1"
+    assert [h["message"] for h in history] == ["вопрос 3", "ответ 3"]
+    assert "ответ 2" in chat.prompts[0] and "ответ 3" not in chat.prompts[0]
+
+    _add_turns(db, uid, 4, 2)
+    assert summarizer.fold(uid, "m")
+    assert "резюме 1" in chat.prompts[1]
+    assert "вопрос 0" not in chat.prompts[1] and "вопрос 4" in chat.prompts[1]
+
+    ctx = db.load_turn_context(uid)
+    assert ctx.summary == "резюме 2"
+    assert [h["message"] for h in ctx.history] == ["вопрос 5", "ответ 5"]
+
+
+def test_fold_skips_short_history(db_module):
+    db = db_module
+    uid = 43002
+    chat = _FakeChat()
+    _add_turns(db, uid, 0, 1)
+
+    assert not Summarizer(chat_fn=chat, trigger_tokens=1000).fold(uid, "m")
+    assert chat.prompts == []
+    assert db.get_chat_summary(uid) is None
+
+
+def test_clear_history_drops_summary(db_module):
+    """Тест проверяет, что /clear удаляет резюме и свёртка не воскрешает его."""
+    db = db_module
+    uid = 43003
+    _add_turns(db, uid, 0, 2)
+    _, history = db.get_unsummarized_history(uid)
+    last_id = history[-1]["id"]
+    assert db.save_chat_summary(uid, "старое резюме", last_id)
+
+    db.clear_chat_history(uid)
+
+    assert db.get_chat_summary(uid) is None
+    # Свёртка, начатая до /clear, не должна записать резюме удалённых строк
+    assert not db.save_chat_summary(uid, "опоздавшее резюме", last_id)
+    assert db.get_chat_summary(uid) is None
+
+
+def test_fold_drains_backlog_longer_than_window(db_module):
+    """
+    Тест проверяет, что при несвёрнутом хвосте длиннее max_rows свёртка идёт
+    от старых строк к новым и ни одна строка не проскакивает мимо резюме.
+    """
+    db = db_module
+    uid = 43004
+    chat = _FakeChat()
+    summarizer = Summarizer(chat_fn=chat, trigger_tokens=10_000, keep_rows=2, max_rows=4)
+    _add_turns(db, uid, 0, 7)
+
+    assert summarizer.fold(uid, "m")
+    # 14 строк: окна по 4 строки, последние 2 остаются как есть
+    assert len(chat.prompts) == 3
+    folded = "\n".join(chat.prompts)
+    for i in range(6):
+        assert f"вопрос {i}" in folded and f"ответ {i}" in folded
+    assert "вопрос 0" in chat.prompts[0] and "вопрос 2" in chat.prompts[1]
+    _, history = db.get_unsummarized_history(uid)
+    assert [h["message"] for h in history] == ["вопрос 6", "ответ 6"]
+
+
+def test_full_summary_keeps_recent_turns_verbatim(db_module):
+    """
+    Тест проверяет /summarize_and_save: в заметку попадает весь диалог, но
+    резюме в БД не охватывает последние keep_rows сообщений — следующие ходы
+    по-прежнему видят их дословно.
+    """
+    db = db_module
+    uid = 43005
+    chat = _FakeChat()
+    summarizer = Summarizer(chat_fn=chat, trigger_tokens=10_000, keep_rows=2, max_rows=4)
+    _add_turns(db, uid, 0, 3)
+
+    text = summarizer.full_summary(uid, "m")
+
+    # Порог не достигнут, но старые ходы свёрнуты; хвост — только в тексте заметки
+    assert text == "резюме 2"
+    assert "вопрос 2" not in chat.prompts[0]
+    assert "резюме 1" in chat.prompts[1] and "вопрос 2" in chat.prompts[1]
+    assert db.get_chat_summary(uid)["summary"] == "резюме 1"
+    ctx = db.load_turn_context(uid)
+    assert ctx.summary == "резюме 1"
+    assert [h["message"] for h in ctx.history] == ["вопрос 2", "ответ 2"]
+
+    # Без новых ходов после свёртки хвост остаётся прежним и снова дописывается к заметке
+    assert summarizer.full_summary(uid, "m") == "резюме 3"
+    assert db.get_chat_summary(uid)["summary"] == "резюме 1"
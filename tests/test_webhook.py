@@ -0,0 +1,113 @@
+# tests/test_webhook.py
+import json
+import socket
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from webhook import SECRET_HEADER, WebhookServer
+
+SECRET = "s3cret"
+
+# Записанное обновление Telegram (личное сообщение)
+UPDATE = {
+    "update_id": 501,
+    "message": {
+        "message_id": 9, "date": 1700000000, "text": "привет",
+        "chat": {"id": 77, "type": "private", "first_name": "U"},
+        "from": {"id": 77, "is_bot": False, "first_name": "U"},
+    },
+}
+
+
+def _post(server: WebhookServer, payload, secret: str = SECRET, path: str = "/telegram") -> int:
+    host, port = server.address
+    req = urllib.request.Request(
+        f"http://{host}:{port}{path}", data=json.dumps(payload).encode(),
+        headers={SECRET_HEADER: secret, "Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+@pytest.fixture()
+def received():
+    return {"updates": [], "event": threading.Event()}
+
+
+def _server(received, **kwargs) -> WebhookServer:
+    def handle(updates):
+        received["updates"].extend(updates)
+        received["event"].set()
+    return WebhookServer(handle, SECRET, host="127.0.0.1", port=0, **kwargs)
+
+
+def test_webhook_accepts_update_and_hands_it_to_handler(received):
+    server = _server(received).start()
+    try:
+        assert _post(server, UPDATE) == 200
+        assert received["event"].wait(5)
+    finally:
+        server.stop()
+
+    update = received["updates"][0]
+    assert update.update_id == 501
+    assert update.message.text == "привет"
+    assert update.message.from_user.id == 77
+
+
+def test_webhook_rejects_wrong_secret_and_path(received):
+    server = _server(received).start()
+    try:
+        assert _post(server, UPDATE, secret="wrong") == 403
+        assert _post(server, UPDATE, path="/other") == 404
+    finally:
+        server.stop()
+    assert received["updates"] == []
+
+
+def test_webhook_answers_503_when_queue_is_full(received):
+    """
+    Тест проверяет обратное давление: обработчики не запущены, очередь на одно
+    обновление — второе получает 503, и Telegram доставит его повторно.
+    """
+    server = _server(received, queue_size=1)
+    threading.Thread(target=server._httpd.serve_forever, daemon=True).start()
+    try:
+        assert _post(server, UPDATE) == 200
+        assert _post(server, dict(UPDATE, update_id=502)) == 503
+        assert server.depth() == 1
+    finally:
+        server._httpd.shutdown()
+        server._httpd.server_close()
+
+
+def test_webhook_closes_keep_alive_connection_on_rejected_request(received):
+    """
+    Тест проверяет, что тело отклонённого запроса не разбирается как следующий
+    запрос: сервер отвечает один раз и закрывает keep-alive соединение.
+    """
+    server = _server(received).start()
+    host, port = server.address
+    # Тело выглядит как ещё один HTTP-запрос
+    smuggled = b"GET /healthz HTTP/1.1\r\nHost: x\r\n\r\n"
+    try:
+        with socket.create_connection((host, port), timeout=5) as sock:
+            sock.sendall(
+                b"POST /telegram HTTP/1.1\r\nHost: x\r\n" + f"{SECRET_HEADER}: wrong\r\n".encode()
+                + f"Content-Length: {len(smuggled)}\r\n\r\n".encode() + smuggled
+            )
+            data = b""
+            while chunk := sock.recv(4096):
+                data += chunk
+    finally:
+        server.stop()
+
+    assert data.startswith(b"HTTP/1.1 403")
+    assert b"Connection: close" in data
+    assert data.count(b"HTTP/1.1") == 1
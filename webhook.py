@@ -0,0 +1,203 @@
+# webhook.py
+"""
+Режим webhook: Telegram сам присылает обновления POST-запросами.
+
+Встроенный ThreadingHTTPServer слушает WEBHOOK_HOST:WEBHOOK_PORT (обычно за
+reverse proxy с TLS) и на каждый запрос:
+  * проверяет путь и заголовок X-Telegram-Bot-Api-Secret-Token (hmac.compare_digest);
+  * сразу отвечает 200 и кладёт JSON обновления в ограниченную очередь;
+  * при переполнении очереди отвечает 503 — Telegram повторит доставку позже.
+Потоки-обработчики разбирают очередь и передают обновления в
+bot.process_new_updates (в main.py это диспетчер по пользователям).
+
+Режим выбирается переменной BOT_MODE=webhook; локально можно проверить так:
+  curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \\
+       -d @update.json http://127.0.0.1:8080/telegram
+"""
+import hmac
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+from telebot import types
+
+from metrics import metric
+
+log = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес, который регистрируется в Telegram (без пути), например https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# Telegram присылает обновления размером в килобайты; больше — явно не он
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", str(1024 * 1024)))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+_STOP = object()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def do_POST(self):
+        hook = self.server.hook
+        # Отказ до чтения тела закрывает соединение: иначе непрочитанные байты
+        # keep-alive соединения разобрались бы как следующий запрос
+        if self.path.split("?", 1)[0] != hook.path:
+            self._reply(404, close=True)
+            return
+        given = self.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(given.encode(), hook.secret.encode()):
+            metric.counter("webhook_rejected_total").inc()
+            self._reply(403, close=True)
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = 0
+        if length <= 0 or length > hook.max_body:
+            self._reply(413 if length > 0 else 400, close=True)
+            return
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._reply(400)
+            return
+        if not hook.enqueue(payload):
+            # Telegram повторит доставку; так очередь не растёт без предела
+            self._reply(503, retry_after=1)
+            return
+        self._reply(200)
+
+    def do_GET(self):
+        # Проверка живости для балансировщика
+        if self.path == "/healthz":
+            self._reply(200, body=f"ok {self.server.hook.depth()}".encode())
+        else:
+            self._reply(404)
+
+    def _reply(self, status: int, body: bytes = b"", retry_after: int | None = None, close: bool = False) -> None:
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        if close:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug("webhook: " + fmt, *args)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    hook: "WebhookServer"
+
+
+class WebhookServer:
+    """HTTP-приёмник обновлений с ограниченной очередью и потоками-обработчиками."""
+
+    def __init__(self, handle: Callable[[list], None], secret: str, host: str = WEBHOOK_HOST,
+                 port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 workers: int = WEBHOOK_WORKERS, max_body: int = WEBHOOK_MAX_BODY, decode: bool = True):
+        self._handle = handle
+        # decode=False — обработчик получает JSON обновлений как есть (см. cluster.py)
+        self.decode = decode
+        self.secret = secret
+        self.path = path
+        self.max_body = max_body
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._workers = max(workers, 1)
+        self._threads: list[threading.Thread] = []
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.hook = self
+        self._depth = metric.gauge("webhook_queue_depth")
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._httpd.server_address[:2]
+
+    def enqueue(self, payload: dict) -> bool:
+        try:
+            self._queue.put_nowait((time.perf_counter(), payload))
+        except queue.Full:
+            metric.counter("webhook_queue_full_total").inc()
+            return False
+        self._depth.inc()
+        metric.counter("webhook_updates_total").inc()
+        return True
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> "WebhookServer":
+        """Запускает обработчики и HTTP-сервер в фоновых потоках."""
+        for i in range(self._workers):
+            t = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._httpd.serve_forever, name="webhook-http", daemon=True)
+        t.start()
+        self._threads.append(t)
+        return self
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            enqueued_at, payload = item
+            self._depth.dec()
+            metric.latency("webhook_wait_ms").observe(int((time.perf_counter() - enqueued_at) * 1000))
+            try:
+                self._handle([types.Update.de_json(payload) if self.decode else payload])
+            except Exception as e:
+                metric.counter("webhook_errors_total").inc()
+                log.error(f"Ошибка обработки обновления {payload.get('update_id')}: {e}", exc_info=True)
+
+    def stop(self, timeout: float | None = 10.0) -> None:
+        """Перестаёт принимать запросы и дорабатывает очередь."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        for _ in range(self._workers):
+            self._queue.put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+
+def run_webhook(bot, handle: Callable[[list], None] | None = None, decode: bool = True) -> None:
+    """
+    Регистрирует webhook (если задан WEBHOOK_URL) и обслуживает запросы до
+    Ctrl+C. handle по умолчанию — bot.process_new_updates.
+    """
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=webhook задайте WEBHOOK_SECRET в .env")
+    server = WebhookServer(handle or bot.process_new_updates, WEBHOOK_SECRET, decode=decode).start()
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    host, port = server.address
+    log.info(f"Webhook слушает http://{host}:{port}{WEBHOOK_PATH}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()